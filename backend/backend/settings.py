@@ -15,8 +15,64 @@ environ.Env.read_env(env_file)
 
 SECRET_KEY = env('SECRET_KEY')
 MASTER_KEY = env('MASTER_KEY')
+# Master keys wrapping user keys, newest first. To rotate, prepend the new
+# key, deploy, run `manage.py rotate_master_key`, then drop the old key.
+# MASTER_KEY itself is still the BLIND_INDEX_KEY default, so pin
+# BLIND_INDEX_KEY before retiring it.
+MASTER_KEYS = env.list('MASTER_KEYS', default=[MASTER_KEY])
 DEBUG = env('DEBUG')
 
+# Unwrapped user keys are cached per worker (see utils/keyring.py)
+USER_KEY_CACHE_SIZE = env.int('USER_KEY_CACHE_SIZE', default=1024)
+USER_KEY_CACHE_TTL = env.int('USER_KEY_CACHE_TTL', default=300)  # seconds
+
+# AES-GCM engine: "auto" benchmarks pycryptodome vs cryptography at first use
+AES_ENGINE = env('AES_ENGINE', default='auto')
+
+# Opt-in thread pool for decrypting large result sets (0 = always serial).
+# Requests below the threshold (number of values) stay serial.
+DECRYPTION_POOL_SIZE = env.int('DECRYPTION_POOL_SIZE', default=0)
+DECRYPTION_PARALLEL_THRESHOLD = env.int('DECRYPTION_PARALLEL_THRESHOLD', default=500)
+
+# Free text at least this many bytes is compressed before encryption.
+# "auto" uses zstd when the zstandard package is installed, else zlib;
+# "none" stores new values uncompressed (existing ones still decrypt).
+ENCRYPTION_COMPRESSION = env('ENCRYPTION_COMPRESSION', default='auto')
+ENCRYPTION_COMPRESSION_THRESHOLD = env.int('ENCRYPTION_COMPRESSION_THRESHOLD', default=256)
+
+# Secret for HMAC blind indexes on encrypted columns. Changing it requires
+# re-indexing every Patient, so it is kept separate from MASTER_KEY rotation.
+BLIND_INDEX_KEY = env('BLIND_INDEX_KEY', default=MASTER_KEY)
+
+# Cache backend from CACHE_URL, e.g. redis://127.0.0.1:6379/1. The default
+# is per process, which suits single-process development only.
+CACHES = {'default': env.cache('CACHE_URL', default='locmemcache://')}
+SHARED_CACHE = CACHES['default']['BACKEND'].rsplit('.', 1)[-1] not in ('LocMemCache', 'DummyCache')
+
+# Seconds to cache each doctor's / family head's accessible patient ids
+# (utils/access.py). Signals drop entries on change, which only reaches
+# every worker through a shared cache, so without one grants aren't cached
+# (0) and a revoked access request takes effect at once.
+ACCESS_GRANT_CACHE_TTL = env.int('ACCESS_GRANT_CACHE_TTL', default=300 if SHARED_CACHE else 0)
+
+# Seconds to keep vitals analytics (patients/analytics.py). New readings
+# change the cache key; edits to old ones show up when the entry expires.
+VITALS_ANALYTICS_CACHE_TTL = env.int('VITALS_ANALYTICS_CACHE_TTL', default=3600)
+
+# Days of vitals kept as rows; `manage.py archive_vitals` packs older ones
+# into the columnar archive (patients/archive.py).
+VITALS_RETENTION_DAYS = env.int('VITALS_RETENTION_DAYS', default=365)
+
+# Per-request SQL and crypto metrics (utils/instrumentation.py). Requests
+# slower than SLOW_REQUEST_MS are logged with EXPLAIN plans of their slowest
+# queries (unset disables, 0 logs everything). Server-Timing headers reveal
+# internals, so they are only sent in DEBUG unless enabled explicitly.
+SQL_INSTRUMENTATION = env.bool('SQL_INSTRUMENTATION', default=True)
+SERVER_TIMING_HEADERS = env.bool('SERVER_TIMING_HEADERS', default=DEBUG)
+SLOW_REQUEST_MS = env.int('SLOW_REQUEST_MS', default=500)
+SLOW_REQUEST_TOP_QUERIES = env.int('SLOW_REQUEST_TOP_QUERIES', default=5)
+SLOW_REQUEST_EXPLAIN = env.bool('SLOW_REQUEST_EXPLAIN', default=True)
+
 # Allow frontend React host
 ALLOWED_HOSTS = ["127.0.0.1", "localhost"]
 
@@ -41,12 +97,15 @@ INSTALLED_APPS = [
     'patients',
     'doctors',
     'families',
+    'jobs',
 ]
 
 # ---------------------------- #
 #         MIDDLEWARE           #
 # ---------------------------- #
 MIDDLEWARE = [
+    # Outermost, so its timings cover every other middleware
+    'utils.instrumentation.QueryInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
 
@@ -143,8 +202,21 @@ REST_FRAMEWORK = {
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend"
     ],
+    "DEFAULT_PAGINATION_CLASS": "utils.pagination.KeysetPagination",
+    "PAGE_SIZE": 50,
 }
 
+# Upper bound for ?page_size= on list endpoints
+MAX_PAGE_SIZE = 200
+
+# Rows fetched and decrypted per batch by the NDJSON chart export
+EXPORT_CHUNK_SIZE = 500
+
+# Bulk exports (doctors/jobs.py): output directory, patients per shard file, worker processes
+EXPORT_ROOT = BASE_DIR / "exports"
+BULK_EXPORT_SHARD_SIZE = 200
+BULK_EXPORT_WORKERS = 4
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=30),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=90),
@@ -0,0 +1,119 @@
+# doctors/jobs.py
+import gzip
+import json
+import os
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.db import connections
+from jobs.models import Job
+from jobs.registry import register
+from utils.export import export_chunks, to_ndjson
+from .models import AccessRequest
+
+# Seconds between heartbeats while a shard is written; well under run_jobs --stale-after
+HEARTBEAT_SECONDS = 30
+
+
+def export_scope(params):
+    """
+    Sorted ids of the patients a bulk export covers: those with an approved
+    access request to params["doctor_id"], or to any doctor at params["hospital"].
+    """
+    grants = AccessRequest.objects.filter(is_approved=True)
+    if params.get("doctor_id"):
+        grants = grants.filter(doctor_id=params["doctor_id"])
+    else:
+        grants = grants.filter(doctor__hospital=params["hospital"])
+    return list(grants.order_by("patient_id").values_list("patient_id", flat=True).distinct())
+
+
+def export_dir(job_id):
+    return Path(settings.EXPORT_ROOT) / f"job-{job_id}"
+
+
+def shard_name(index):
+    return f"shard-{index:05d}.ndjson.gz"
+
+
+def _init_worker():
+    # Spawned workers (macOS, Windows) start without Django; for forked ones this is a no-op.
+    # Forked ones drop the inherited decryption pool in utils.encryption's fork hook.
+    django.setup()
+
+
+def export_shard(directory, index, patient_ids, job_id=None):
+    """
+    Write the charts of `patient_ids` to one gzip NDJSON shard, returning
+    (index, records). The file is renamed into place only once complete.
+    With `job_id`, that job gets a heartbeat every HEARTBEAT_SECONDS so a
+    long shard isn't taken for a lost worker and requeued.
+    """
+    path = Path(directory) / shard_name(index)
+    # Per process, in case a requeued job overlaps this one
+    partial = path.with_name(f"{path.name}.{os.getpid()}.part")
+    records = 0
+    beat = time.monotonic()
+    with gzip.open(partial, "wt", encoding="utf-8") as out:
+        for chunk in export_chunks(patient_ids):
+            out.write(to_ndjson(chunk))
+            records += len(chunk)
+            if job_id is not None and time.monotonic() - beat >= HEARTBEAT_SECONDS:
+                Job(pk=job_id).heartbeat()
+                beat = time.monotonic()
+    os.replace(partial, path)
+    return index, records
+
+
+@register("bulk_export")
+def bulk_export(job):
+    """
+    Dump the charts of every patient in export_scope(job.params) to
+    EXPORT_ROOT/job-<id>/ as gzip NDJSON shards of BULK_EXPORT_SHARD_SIZE
+    patients, written by a pool of BULK_EXPORT_WORKERS processes. The first
+    run records each shard's patient-id bounds in the checkpoint and every
+    finished shard is checkpointed, so a rerun only redoes unfinished shards.
+    """
+    directory = export_dir(job.pk)
+    directory.mkdir(parents=True, exist_ok=True)
+    patient_ids = export_scope(job.params)
+    if "shards" not in job.checkpoint:
+        size = getattr(settings, "BULK_EXPORT_SHARD_SIZE", 200)
+        shards = [[patient_ids[i], patient_ids[min(i + size, len(patient_ids)) - 1]]
+                  for i in range(0, len(patient_ids), size)]
+        job.save_checkpoint(progress=0, shards=shards, total=len(patient_ids), done={})
+
+    done = job.checkpoint["done"]
+    pending = {}
+    for index, (first, last) in enumerate(job.checkpoint["shards"]):
+        if str(index) not in done:
+            pending[index] = patient_ids[bisect_left(patient_ids, first):bisect_right(patient_ids, last)]
+
+    def finished(index, records):
+        done[str(index)] = {"patients": len(pending[index]), "records": records}
+        job.save_checkpoint(progress=job.progress + len(pending[index]), done=done)
+
+    workers = getattr(settings, "BULK_EXPORT_WORKERS", 4)
+    if workers <= 1 or len(pending) <= 1:
+        for index, ids in pending.items():
+            finished(*export_shard(directory, index, ids, job.pk))
+    else:
+        # Forked workers must open their own database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=_init_worker) as pool:
+            futures = [pool.submit(export_shard, directory, index, ids, job.pk) for index, ids in pending.items()]
+            for future in as_completed(futures):
+                finished(*future.result())
+
+    manifest = {
+        "job": job.pk,
+        "scope": job.params,
+        "patients": job.checkpoint["total"],
+        "shards": [{"file": shard_name(int(index)), **counts} for index, counts in sorted(
+            done.items(), key=lambda item: int(item[0]))],
+    }
+    (directory / "manifest.json").write_text(json.dumps(manifest, indent=2))
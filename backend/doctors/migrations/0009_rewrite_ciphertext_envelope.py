@@ -0,0 +1,26 @@
+# Rewrites Encounter and ClinicalNote ciphertext into the versioned envelope,
+# reusing the frozen helper from the matching patients migration.
+
+from importlib import import_module
+
+from django.db import migrations
+
+envelope = import_module("patients.migrations.0009_rewrite_ciphertext_envelope")
+
+
+def forwards(apps, schema_editor):
+    envelope.rewrite_model(apps.get_model("doctors", "Encounter"), ["reason", "summary"], "patient.user")
+    envelope.rewrite_model(apps.get_model("doctors", "ClinicalNote"),
+                           ["subjective", "objective", "assessment", "plan", "note"], "encounter.patient.user")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0008_clinicalnote'),
+        ('patients', '0009_rewrite_ciphertext_envelope'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:25
+#
+# Text to binary by explicit copy rather than PostgreSQL's implicit cast,
+# reusing the operations from the matching patients migration (see there).
+
+from importlib import import_module
+
+import utils.fields
+from django.db import migrations
+
+binary = import_module("patients.migrations.0010_encrypted_binary_columns")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0009_rewrite_ciphertext_envelope'),
+    ]
+
+    operations = [
+        *binary.binary_column('doctors', 'clinicalnote', 'assessment',
+                              utils.fields.EncryptedBinaryField(blank=True, null=True)),
+        *binary.binary_column('doctors', 'clinicalnote', 'note', utils.fields.EncryptedBinaryField(blank=True, null=True)),
+        *binary.binary_column('doctors', 'clinicalnote', 'objective',
+                              utils.fields.EncryptedBinaryField(blank=True, null=True)),
+        *binary.binary_column('doctors', 'clinicalnote', 'plan', utils.fields.EncryptedBinaryField(blank=True, null=True)),
+        *binary.binary_column('doctors', 'clinicalnote', 'subjective',
+                              utils.fields.EncryptedBinaryField(blank=True, null=True)),
+        *binary.binary_column('doctors', 'encounter', 'reason', utils.fields.EncryptedBinaryField(blank=True, null=True)),
+        *binary.binary_column('doctors', 'encounter', 'summary', utils.fields.EncryptedBinaryField(blank=True, null=True)),
+    ]
@@ -0,0 +1,27 @@
+# Converts Encounter and ClinicalNote envelopes from base64 text to raw bytes,
+# reusing the resumable batch helper from the matching patients migration.
+
+from importlib import import_module
+
+from django.db import migrations
+
+binary = import_module("patients.migrations.0011_convert_ciphertext_to_binary")
+
+
+def forwards(apps, schema_editor):
+    binary.convert_table(apps.get_model("doctors", "Encounter"), ["reason", "summary"])
+    binary.convert_table(apps.get_model("doctors", "ClinicalNote"),
+                         ["subjective", "objective", "assessment", "plan", "note"])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('doctors', '0010_encrypted_binary_columns'),
+        ('patients', '0011_convert_ciphertext_to_binary'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Builds the keyword index for existing Encounter and ClinicalNote rows,
+# reusing the helper from the matching patients migration.
+
+from importlib import import_module
+
+from django.db import migrations
+
+search_tokens = import_module("patients.migrations.0013_search_tokens")
+
+
+def forwards(apps, schema_editor):
+    search_tokens.index_model(apps, apps.get_model("doctors", "Encounter"), ["reason", "summary"], "patient.user")
+    search_tokens.index_model(apps, apps.get_model("doctors", "ClinicalNote"),
+                              ["subjective", "objective", "assessment", "plan", "note"], "encounter.patient.user")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0011_convert_ciphertext_to_binary'),
+        ('patients', '0013_search_tokens'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
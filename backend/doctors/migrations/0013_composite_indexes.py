@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0012_search_tokens'),
+        ('patients', '0014_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='accessrequest',
+            index=models.Index(fields=['doctor', 'is_approved', 'patient'], name='doctors_acc_doctor__6180de_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='accessrequest',
+            index=models.Index(fields=['patient', 'is_approved'], name='doctors_acc_patient_9ac9d8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='clinicalnote',
+            index=models.Index(fields=['encounter', 'created_at'], name='doctors_cli_encount_1e394c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='encounter',
+            index=models.Index(fields=['patient', 'date'], name='doctors_enc_patient_45de2c_idx'),
+        ),
+    ]
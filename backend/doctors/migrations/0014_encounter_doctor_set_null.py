@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doctors', '0013_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='encounter',
+            name='doctor',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='encounters', to='doctors.doctor'),
+        ),
+    ]
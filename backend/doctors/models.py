@@ -1,9 +1,11 @@
 from django.db import models
 from django.conf import settings
+from django.contrib.contenttypes.fields import GenericRelation
 from django.utils import timezone
 from patients.models import Patient
 from datetime import timedelta
-from utils.encryption import AESCipher, is_base64
+from utils.fields import EncryptedBinaryField
+from utils.models import EncryptedModelMixin, EncryptedQuerySet
 import random
 
 # Create your models here.
@@ -35,6 +37,11 @@ class AccessRequest(models.Model):
                 name='unique_doctor_patient_request'
             )
         ]
+        indexes = [
+            # Grant lookups read patient_id straight from the index
+            models.Index(fields=["doctor", "is_approved", "patient"]),
+            models.Index(fields=["patient", "is_approved"]),
+        ]
 
     def generate_otp(self):
         # Generate and store a 6-digit OTP with 10-min expiry
@@ -56,50 +63,29 @@ class AccessRequest(models.Model):
         return f"Access Request by {self.doctor.name} for Patient {self.patient}"
 
 
-class Encounter(models.Model):
+class Encounter(EncryptedModelMixin, models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="encounters")
-    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name="encounters")
+    # Part of the patient's chart, so it outlives the doctor's account (see users/jobs.py purge_user)
+    doctor = models.ForeignKey(Doctor, on_delete=models.SET_NULL, related_name="encounters", null=True, blank=True)
     date = models.DateTimeField(auto_now_add=True)
-    reason = models.TextField(blank=True, null=True)
-    summary = models.TextField(blank=True, null=True)
+    reason = EncryptedBinaryField(blank=True, null=True)
+    summary = EncryptedBinaryField(blank=True, null=True)
+    search_tokens = GenericRelation("patients.SearchToken")
+
+    objects = EncryptedQuerySet.as_manager()
+
+    ENCRYPTED_FIELDS = ['reason', 'summary']
+    KEY_OWNER = 'patient__user'
+    SEARCH_FIELDS = ['reason', 'summary']
+
+    class Meta:
+        indexes = [models.Index(fields=["patient", "date"])]
 
     @property
     def user(self):
         # Shortcut to access user from patient
         return getattr(self.patient, "user", None)
     
-    def _get_user_key_bytes(self) -> bytes:
-        """
-        Return bytes key for AES. Ensure your `get_user_key()` returns appropriate bytes.
-        If it returns hex or str, adapt accordingly.
-        """
-        # Example: assume user.get_user_key() returns a bytes object of correct length.
-        if self.user and hasattr(self.user, "get_user_key"):
-            return self.user.get_user_key()
-        return None
-    
-    def save(self, *args, **kwargs):
-        key = self._get_user_key_bytes()
-        if key:
-            cipher = AESCipher(key)
-            for field in ['reason', 'summary']:
-                val = getattr(self, field, None)
-                if val and not is_base64(val):
-                    setattr(self, field, cipher.encrypt(val))
-        super().save(*args, **kwargs)
-
-    # decrypted properties (never modify DB)
-    def _decrypt_field(self, encrypted_value):
-        key = self._get_user_key_bytes()
-        if not encrypted_value or not key:
-            return None
-        cipher = AESCipher(key)
-        try:
-            return cipher.decrypt(encrypted_value)
-        except Exception:
-            # MAC check failed or corrupted value
-            return "[Decryption Error]"
-
     @property
     def reason_decrypted(self):
         return self._decrypt_field(self.reason)
@@ -112,52 +98,30 @@ class Encounter(models.Model):
         return f"Encounter on {self.date} between Dr. {self.doctor} and Patient {self.patient}"
 
     
-class ClinicalNote(models.Model):
+class ClinicalNote(EncryptedModelMixin, models.Model):
     encounter = models.ForeignKey(Encounter, on_delete=models.CASCADE, related_name="clinical_notes")
-    subjective = models.TextField(blank=True, null=True)
-    objective = models.TextField(blank=True, null=True)
-    assessment = models.TextField(blank=True, null=True)
-    plan = models.TextField(blank=True, null=True)
-    note = models.TextField(blank=True, null=True)
+    subjective = EncryptedBinaryField(blank=True, null=True)
+    objective = EncryptedBinaryField(blank=True, null=True)
+    assessment = EncryptedBinaryField(blank=True, null=True)
+    plan = EncryptedBinaryField(blank=True, null=True)
+    note = EncryptedBinaryField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    search_tokens = GenericRelation("patients.SearchToken")
+
+    objects = EncryptedQuerySet.as_manager()
+
+    ENCRYPTED_FIELDS = ['subjective', 'objective', 'assessment', 'plan', 'note']
+    KEY_OWNER = 'encounter__patient__user'
+    SEARCH_FIELDS = ENCRYPTED_FIELDS
+
+    class Meta:
+        indexes = [models.Index(fields=["encounter", "created_at"])]
 
     @property
     def user(self):
         # Shortcut to access user from patient
         return getattr(self.encounter.patient, "user", None)
     
-    def _get_user_key_bytes(self) -> bytes:
-        """
-        Return bytes key for AES. Ensure your `get_user_key()` returns appropriate bytes.
-        If it returns hex or str, adapt accordingly.
-        """
-        # Example: assume user.get_user_key() returns a bytes object of correct length.
-        if self.user and hasattr(self.user, "get_user_key"):
-            return self.user.get_user_key()
-        return None
-    
-    def save(self, *args, **kwargs):
-        key = self._get_user_key_bytes()
-        if key:
-            cipher = AESCipher(key)
-            for field in ['subjective', 'objective', 'assessment', 'plan', 'note']:
-                val = getattr(self, field, None)
-                if val and not is_base64(val):
-                    setattr(self, field, cipher.encrypt(val))
-        super().save(*args, **kwargs)
-
-    # decrypted properties (never modify DB)
-    def _decrypt_field(self, encrypted_value):
-        key = self._get_user_key_bytes()
-        if not encrypted_value or not key:
-            return None
-        cipher = AESCipher(key)
-        try:
-            return cipher.decrypt(encrypted_value)
-        except Exception:
-            # MAC check failed or corrupted value
-            return "[Decryption Error]"
-
     @property
     def subjective_decrypted(self):
         return self._decrypt_field(self.subjective)
@@ -1,6 +1,9 @@
 from rest_framework import serializers
 from django.db import IntegrityError
 from .models import Doctor, AccessRequest, Encounter, ClinicalNote
+from .jobs import shard_name
+from jobs.models import Job
+from utils.serializers import BatchDecryptListSerializer, SparseFieldsMixin
 from datetime import date
 import re
 
@@ -142,14 +145,17 @@ class AccessRequestVerifySerializer(serializers.Serializer):
         access_request.save()
         return access_request
 
-class EncounterSerializer(serializers.ModelSerializer):
+class EncounterSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     reason = serializers.SerializerMethodField()
     summary = serializers.SerializerMethodField()
     
     class Meta:
         model = Encounter
         fields = '__all__'
+        list_serializer_class = BatchDecryptListSerializer
         read_only_fields = ['date']
+        # Only a purged doctor account leaves an encounter without a doctor
+        extra_kwargs = {'doctor': {'required': True, 'allow_null': False}}
 
     def validate_date(self, value):
         # Ensure event date is not in the future
@@ -195,7 +201,7 @@ class EncounterSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
-class ClinicalNoteSerializer(serializers.ModelSerializer):
+class ClinicalNoteSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     subjective = serializers.SerializerMethodField()
     objective = serializers.SerializerMethodField()
     assessment = serializers.SerializerMethodField()
@@ -205,6 +211,7 @@ class ClinicalNoteSerializer(serializers.ModelSerializer):
     class Meta:
         model = ClinicalNote
         fields = '__all__'
+        list_serializer_class = BatchDecryptListSerializer
         read_only_fields = ['created_at']
 
     def validate_created_at(self, value):
@@ -270,3 +277,27 @@ class ClinicalNoteSerializer(serializers.ModelSerializer):
 
         instance.save()
         return instance
+
+
+class BulkExportSerializer(serializers.ModelSerializer):
+    """Status of a bulk_export job (see doctors/jobs.py)."""
+    hospital = serializers.CharField(write_only=True, required=False)
+    total = serializers.SerializerMethodField()
+    shards = serializers.SerializerMethodField()
+    files = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ['id', 'hospital', 'params', 'status', 'progress', 'total', 'shards', 'files', 'error',
+                  'created_at', 'started_at', 'finished_at']
+        read_only_fields = ['params', 'status', 'progress', 'error', 'created_at', 'started_at', 'finished_at']
+
+    def get_total(self, obj):
+        # Patients in scope; known once the job has started
+        return obj.checkpoint.get("total")
+
+    def get_shards(self, obj):
+        return {"done": len(obj.checkpoint.get("done", {})), "total": len(obj.checkpoint.get("shards", []))}
+
+    def get_files(self, obj):
+        return [shard_name(int(index)) for index in sorted(obj.checkpoint.get("done", {}), key=int)]
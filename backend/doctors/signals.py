@@ -1,6 +1,7 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from .models import Doctor
+from utils.access import invalidate
+from .models import AccessRequest, Doctor
 
 @receiver(post_save, sender=Doctor)
 def update_linked_patient(sender, instance, created, **kwargs):
@@ -9,3 +10,16 @@ def update_linked_patient(sender, instance, created, **kwargs):
         if user.role == "doctor" and not user.linked_doctor:
             user.linked_doctor = instance
             user.save(update_fields=["linked_doctor"])
+
+
+@receiver([post_save, post_delete], sender=AccessRequest)
+def invalidate_doctor_grants(sender, instance, **kwargs):
+    # Approval, revocation or deletion changes what the doctor can see
+    invalidate("doctor", instance.doctor_id)
+
+
+@receiver([post_save, post_delete], sender=Doctor)
+def drop_doctor_grants(sender, instance, created=False, **kwargs):
+    # A new profile can reuse a deleted one's id (e.g. SQLite), so start it clean too
+    if created or kwargs["signal"] is post_delete:
+        invalidate("doctor", instance.pk)
@@ -1,3 +1,366 @@
-from django.test import TestCase
+import gzip
+import json
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from doctors.models import AccessRequest
+from patients.models import Patient
+from jobs.models import Job
+from jobs.worker import run_job
+from rest_framework.test import APITestCase
+from utils import testing
+from utils.access import accessible_patient_ids, can_access
+
+
+class DoctorQueryBudgetTests(testing.QueryBudgetTestCase):
+    urlconf = "doctors.urls"
+
+    def setUp(self):
+        self.doctor = testing.make_doctor()
+        self.user = self.doctor.user
+        self.patient = testing.make_patient()
+        testing.grant_access(self.doctor, self.patient)
+        self.encounter = testing.make_encounter(self.patient, self.doctor)
+        self.login(self.user)
+
+    def grow_doctors(self, n):
+        for _ in range(n):
+            testing.make_doctor()
+
+    def grow_access_requests(self, n):
+        for _ in range(n):
+            testing.grant_access(self.doctor, testing.make_patient())
+
+    def grow_cohort(self, n):
+        for _ in range(n):
+            patient = testing.make_patient()
+            testing.grant_access(self.doctor, patient)
+            testing.make_vital(patient)
+
+    def grow_encounters(self, n):
+        for _ in range(n):
+            testing.make_encounter(self.patient, self.doctor)
+
+    def grow_notes(self, n):
+        for _ in range(n):
+            testing.make_note(self.encounter)
+
+    def grow_exports(self, n):
+        for _ in range(n):
+            Job.enqueue("bulk_export", created_by=self.user, doctor_id=self.doctor.pk)
+
+    def new_doctor_user(self):
+        user = testing.make_user("doctor")
+        self.login(user)
+        return ()
+
+    def new_doctor(self):
+        doctor = testing.make_doctor()
+        self.login(doctor.user)
+        return (doctor,)
+
+    def new_access_request(self):
+        access_request = testing.grant_access(self.doctor, testing.make_patient(), approved=False)
+        access_request.generate_otp()
+        return (access_request,)
+
+    def budget_cases(self):
+        access_request = testing.grant_access(self.doctor, testing.make_patient())
+        note = testing.make_note(self.encounter)
+        export = Job.enqueue("bulk_export", created_by=self.user, doctor_id=self.doctor.pk)
+        return {
+            ("", "get"): {"request": lambda: self.client.get("/v1/doctors/"), "grow": self.grow_doctors},
+            ("", "post"): {
+                "setup": self.new_doctor_user,
+                "request": lambda: self.client.post("/v1/doctors/", {
+                    "name": testing.unique_name("Dr"), "specialty": "Cardiology", "contact_number": "9876543210",
+                    "hospital": "City Hospital"}, format="json"),
+                "grow": self.grow_doctors,
+            },
+            ("<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"/v1/doctors/{self.doctor.pk}/"), "grow": self.grow_doctors,
+            },
+            ("<int:pk>/", "patch"): {
+                "request": lambda: self.client.patch(f"/v1/doctors/{self.doctor.pk}/", {
+                    "hospital": testing.unique_name("Hospital")}, format="json"),
+                "grow": self.grow_doctors,
+            },
+            ("<int:pk>/", "delete"): {
+                "setup": self.new_doctor,
+                "request": lambda doctor: self.client.delete(f"/v1/doctors/{doctor.pk}/"),
+                "grow": self.grow_doctors,
+            },
+            ("analytics/", "get"): {
+                "setup": self.cold_cache,
+                "request": lambda: self.client.get("/v1/doctors/analytics/"), "grow": self.grow_cohort,
+            },
+            ("access-requests/", "get"): {
+                "request": lambda: self.client.get("/v1/doctors/access-requests/"),
+                "grow": self.grow_access_requests,
+            },
+            ("access-requests/", "post"): {
+                "setup": lambda: (testing.make_patient(),),
+                "request": lambda patient: self.client.post("/v1/doctors/access-requests/", {
+                    "doctor": self.doctor.pk, "patient": patient.pk}, format="json"),
+                "grow": self.grow_access_requests,
+            },
+            ("access-requests/<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"/v1/doctors/access-requests/{access_request.pk}/"),
+                "grow": self.grow_access_requests,
+            },
+            ("access-requests/<int:pk>/", "delete"): {
+                "setup": self.new_access_request,
+                "request": lambda request: self.client.delete(f"/v1/doctors/access-requests/{request.pk}/"),
+                "grow": self.grow_access_requests,
+            },
+            ("access-requests/<int:pk>/verify-otp/", "post"): {
+                "setup": self.new_access_request,
+                "request": lambda request: self.client.post(
+                    f"/v1/doctors/access-requests/{request.pk}/verify-otp/", {"otp": request.otp}, format="json"),
+                "grow": self.grow_access_requests,
+            },
+            ("access-requests/<int:pk>/resend-otp/", "post"): {
+                "setup": lambda: (testing.grant_access(self.doctor, testing.make_patient(), approved=False),),
+                "request": lambda request: self.client.post(f"/v1/doctors/access-requests/{request.pk}/resend-otp/"),
+                "grow": self.grow_access_requests,
+            },
+            ("encounters/", "get"): {
+                "request": lambda: self.client.get("/v1/doctors/encounters/"), "grow": self.grow_encounters,
+            },
+            ("encounters/", "post"): {
+                "request": lambda: self.client.post("/v1/doctors/encounters/", {
+                    "patient": self.patient.pk, "doctor": self.doctor.pk, "reason": "Fever and chills",
+                    "summary": "Viral fever"}, format="json"),
+                "grow": self.grow_encounters,
+            },
+            ("encounters/<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"/v1/doctors/encounters/{self.encounter.pk}/"),
+                "grow": self.grow_encounters,
+            },
+            ("encounters/<int:pk>/", "patch"): {
+                "request": lambda: self.client.patch(f"/v1/doctors/encounters/{self.encounter.pk}/", {
+                    "summary": "Asthma confirmed"}, format="json"),
+                "grow": self.grow_encounters,
+            },
+            ("encounters/<int:pk>/", "delete"): {
+                "setup": lambda: (testing.make_encounter(self.patient, self.doctor),),
+                "request": lambda encounter: self.client.delete(f"/v1/doctors/encounters/{encounter.pk}/"),
+                "grow": self.grow_encounters,
+            },
+            ("exports/", "get"): {"request": lambda: self.client.get("/v1/doctors/exports/"), "grow": self.grow_exports},
+            ("exports/", "post"): {
+                "request": lambda: self.client.post("/v1/doctors/exports/", {}, format="json"),
+                "grow": self.grow_exports,
+            },
+            ("exports/<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"/v1/doctors/exports/{export.pk}/"), "grow": self.grow_exports,
+            },
+            ("encounters/clinical-notes/", "get"): {
+                "request": lambda: self.client.get("/v1/doctors/encounters/clinical-notes/"), "grow": self.grow_notes,
+            },
+            ("encounters/clinical-notes/", "post"): {
+                "request": lambda: self.client.post("/v1/doctors/encounters/clinical-notes/", {
+                    "encounter": self.encounter.pk, "subjective": "Dry cough", "plan": "Steam inhalation"},
+                    format="json"),
+                "grow": self.grow_notes,
+            },
+            ("encounters/clinical-notes/<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"/v1/doctors/encounters/clinical-notes/{note.pk}/"),
+                "grow": self.grow_notes,
+            },
+            ("encounters/clinical-notes/<int:pk>/", "patch"): {
+                "request": lambda: self.client.patch(f"/v1/doctors/encounters/clinical-notes/{note.pk}/", {
+                    "plan": "Continue inhaler"}, format="json"),
+                "grow": self.grow_notes,
+            },
+            ("encounters/clinical-notes/<int:pk>/", "delete"): {
+                "setup": lambda: (testing.make_note(self.encounter),),
+                "request": lambda note: self.client.delete(f"/v1/doctors/encounters/clinical-notes/{note.pk}/"),
+                "grow": self.grow_notes,
+            },
+        }
+
+
+@override_settings(ACCESS_GRANT_CACHE_TTL=300)
+class AccessPolicyTests(TestCase):
+    def setUp(self):
+        self.doctor = testing.make_doctor()
+        self.user = self.doctor.user
+        self.user.refresh_from_db()
+        self.patient = testing.make_patient()
+
+    def test_grants_follow_access_requests(self):
+        access_request = testing.grant_access(self.doctor, self.patient, approved=False)
+        self.assertFalse(can_access(self.user, [self.patient.pk]))
+        access_request.is_approved = True
+        access_request.save()
+        self.assertTrue(can_access(self.user, [self.patient.pk]))
+        with self.assertNumQueries(0):
+            self.assertEqual(accessible_patient_ids(self.user), {self.patient.pk})
+        access_request.delete()
+        self.assertFalse(can_access(self.user, [self.patient.pk]))
+
+    @override_settings(ACCESS_GRANT_CACHE_TTL=0)
+    def test_uncached_without_a_shared_cache(self):
+        access_request = testing.grant_access(self.doctor, self.patient)
+        with self.assertNumQueries(1):
+            self.assertTrue(can_access(self.user, [self.patient.pk]))
+        # As if revoked by another worker: no signal reaches this process
+        AccessRequest.objects.filter(pk=access_request.pk).update(is_approved=False)
+        self.assertFalse(can_access(self.user, [self.patient.pk]))
+
+    def test_family_head_sees_verified_members(self):
+        head = self.patient.user
+        head.refresh_from_db()
+        member = testing.add_member(testing.make_family(self.patient), verified=False)
+        self.assertEqual(accessible_patient_ids(head), {self.patient.pk})
+        member.is_verified = True
+        member.save()
+        self.assertEqual(accessible_patient_ids(head), {self.patient.pk, member.patient_id})
+        self.assertFalse(can_access(head, [member.patient_id, self.patient.pk + 1000]))
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class PaginationTests(APITestCase):
+    def setUp(self):
+        self.doctor = testing.make_doctor()
+        self.patient = testing.make_patient()
+        testing.grant_access(self.doctor, self.patient)
+        self.encounters = [testing.make_encounter(self.patient, self.doctor) for _ in range(5)]
+        self.client.force_authenticate(self.doctor.user)
+
+    def test_cursor_walks_every_encounter_newest_first(self):
+        seen, url = [], "/v1/doctors/encounters/?page_size=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data["results"]), 2)
+            seen += [row["id"] for row in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(seen, [encounter.pk for encounter in reversed(self.encounters)])
+
+    def test_cursor_orders_by_patient_name_with_id_tie_breaker(self):
+        other = testing.make_patient()
+        testing.grant_access(self.doctor, other)
+        self.encounters += [testing.make_encounter(other, self.doctor) for _ in range(3)]
+        Patient.objects.filter(pk=self.patient.pk).update(last_name="Rao")
+        Patient.objects.filter(pk=other.pk).update(last_name="Das")
+        expected = [e.pk for e in sorted(self.encounters, key=lambda e: (e.patient_id != other.pk, e.pk))]
+
+        seen, url = [], "/v1/doctors/encounters/?ordering=patient__last_name&page_size=3"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen += [row["id"] for row in response.data["results"]]
+            previous, url = response.data["previous"], response.data["next"]
+        self.assertEqual(seen, expected)
+        # And back again from the last page
+        back = []
+        while previous:
+            response = self.client.get(previous)
+            back = [row["id"] for row in response.data["results"]] + back
+            previous = response.data["previous"]
+        self.assertEqual(back, expected[:6])
+
+    def test_page_size_is_capped(self):
+        with self.settings(MAX_PAGE_SIZE=3):
+            response = self.client.get("/v1/doctors/encounters/?page_size=1000")
+        self.assertEqual(len(response.data["results"]), 3)
+        self.assertIsNotNone(response.data["next"])
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+                   BULK_EXPORT_SHARD_SIZE=2, BULK_EXPORT_WORKERS=1)
+class BulkExportTests(APITestCase):
+    def setUp(self):
+        self.doctor = testing.make_doctor()
+        self.patients = [testing.make_patient() for _ in range(5)]
+        for patient in self.patients:
+            testing.grant_access(self.doctor, patient)
+            testing.make_history(patient)
+        testing.grant_access(self.doctor, testing.make_patient(), approved=False)
+        self.client.force_authenticate(self.doctor.user)
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+
+    def run_export(self, job):
+        with self.settings(EXPORT_ROOT=self.root.name):
+            self.assertTrue(run_job(job))
+        job.refresh_from_db()
+        return Path(self.root.name) / f"job-{job.pk}"
+
+    def read_shard(self, path):
+        with gzip.open(path, "rt") as shard:
+            return [json.loads(line) for line in shard]
+
+    def test_export_writes_shards_and_reports_progress(self):
+        response = self.client.post("/v1/doctors/exports/", {}, format="json")
+        self.assertEqual(response.status_code, 201)
+        job = Job.objects.get(pk=response.data["id"])
+        self.assertEqual(job.params, {"doctor_id": self.doctor.pk})
+        directory = self.run_export(job)
+
+        status = self.client.get(f"/v1/doctors/exports/{job.pk}/").data
+        self.assertEqual((status["status"], status["progress"], status["total"]), ("done", 5, 5))
+        self.assertEqual(status["shards"], {"done": 3, "total": 3})
+        records = [record for name in status["files"] for record in self.read_shard(directory / name)]
+        self.assertEqual(sorted(r["data"]["id"] for r in records if r["type"] == "patient"),
+                         [patient.pk for patient in self.patients])
+        self.assertEqual({r["data"]["description"] for r in records if r["type"] == "medical_history"},
+                         {"Peanut allergy"})
+        manifest = json.loads((directory / "manifest.json").read_text())
+        self.assertEqual(sum(shard["records"] for shard in manifest["shards"]), len(records))
+
+    def test_rerun_redoes_only_unfinished_shards(self):
+        job = Job.enqueue("bulk_export", created_by=self.doctor.user, doctor_id=self.doctor.pk)
+        directory = self.run_export(job)
+        # As if the worker died while writing shard 1
+        (directory / "shard-00001.ndjson.gz").unlink()
+        done = job.checkpoint["done"]
+        lost = done.pop("1")
+        job.save_checkpoint(progress=job.progress - lost["patients"], done=done)
+        kept = (directory / "shard-00000.ndjson.gz").stat().st_mtime_ns
+
+        self.run_export(job)
+        self.assertEqual(job.progress, 5)
+        self.assertTrue((directory / "shard-00001.ndjson.gz").exists())
+        self.assertEqual((directory / "shard-00000.ndjson.gz").stat().st_mtime_ns, kept)
+
+    def test_heartbeat_while_writing_a_shard(self):
+        job = Job.enqueue("bulk_export", created_by=self.doctor.user, doctor_id=self.doctor.pk)
+        with patch("doctors.jobs.HEARTBEAT_SECONDS", 0), patch.object(Job, "heartbeat", autospec=True) as heartbeat:
+            directory = self.run_export(job)
+        self.assertTrue(heartbeat.called)
+        self.assertEqual({beat.args[0].pk for beat in heartbeat.call_args_list}, {job.pk})
+        self.assertEqual(list(directory.glob("*.part")), [])
+
+    def test_hospital_export_is_staff_only(self):
+        response = self.client.post("/v1/doctors/exports/", {"hospital": self.doctor.hospital}, format="json")
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class CohortAnalyticsTests(APITestCase):
+    def setUp(self):
+        self.doctor = testing.make_doctor()
+        self.patients = [testing.make_patient() for _ in range(3)]
+        for patient, rate in zip(self.patients, (60, 70, 80)):
+            testing.grant_access(self.doctor, patient)
+            testing.make_vital(patient, heart_rate_bpm=rate)
+            testing.make_vital(patient, heart_rate_bpm=rate + 10, height_cm=None, weight_kg=None)
+        testing.grant_access(self.doctor, testing.make_patient(), approved=False)
+        self.client.force_authenticate(self.doctor.user)
+
+    def test_summarises_approved_patients(self):
+        data = self.client.get("/v1/doctors/analytics/").data
+        self.assertEqual((data["patients"], data["readings"]), (3, 6))
+        self.assertEqual([row["patient"] for row in data["per_patient"]], sorted(p.pk for p in self.patients))
+        heart_rate = data["metrics"]["heart_rate_bpm"]
+        self.assertEqual((heart_rate["patients"], heart_rate["mean"], heart_rate["p50"]), (3, 75.0, 75.0))
+        self.assertEqual(data["bmi"], {"patients": 3, "mean": round(70 / 1.7 ** 2, 2)})
+
+    def test_doctors_only(self):
+        self.client.force_authenticate(self.patients[0].user)
+        self.assertEqual(self.client.get("/v1/doctors/analytics/").status_code, 403)
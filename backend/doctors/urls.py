@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import DoctorViewSet, AccessRequestViewSet, EncounterViewSet, ClinicalNoteViewSet
+from .views import DoctorViewSet, AccessRequestViewSet, EncounterViewSet, ClinicalNoteViewSet, BulkExportViewSet
 
 doctor_list = DoctorViewSet.as_view({
     'get': 'list',
@@ -10,6 +10,9 @@ doctor_detail = DoctorViewSet.as_view({
     'patch': 'partial_update',
     'delete': 'destroy',
 })
+doctor_analytics = DoctorViewSet.as_view({
+    'get': 'analytics',
+})
 
 access_request_list = AccessRequestViewSet.as_view({
     'get': 'list',
@@ -50,9 +53,19 @@ clinical_note_detail = ClinicalNoteViewSet.as_view({
     'delete': 'destroy',
 })
 
+bulk_export_list = BulkExportViewSet.as_view({
+    'get': 'list',
+    'post': 'create',
+})
+
+bulk_export_detail = BulkExportViewSet.as_view({
+    'get': 'retrieve',
+})
+
 urlpatterns = [
     path('', doctor_list, name='doctor-list'),
     path('<int:pk>/', doctor_detail, name='doctor-detail'),
+    path('analytics/', doctor_analytics, name='doctor-analytics'),
 
     path('access-requests/', access_request_list, name='access-request-list'),
     path('access-requests/<int:pk>/', access_request_detail, name='access-request-detail'),
@@ -64,4 +77,7 @@ urlpatterns = [
 
     path('encounters/clinical-notes/', clinical_note_list, name='clinical-note-list'),
     path('encounters/clinical-notes/<int:pk>/', clinical_note_detail, name='clinical-note-detail'),
+
+    path('exports/', bulk_export_list, name='bulk-export-list'),
+    path('exports/<int:pk>/', bulk_export_detail, name='bulk-export-detail'),
 ]
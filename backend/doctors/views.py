@@ -8,8 +8,12 @@ from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied
 from .serializers import DoctorSerializer, Doctor, AccessRequestCreateSerializer, AccessRequestVerifySerializer, AccessRequest, EncounterSerializer, Encounter, ClinicalNoteSerializer, ClinicalNote
+from .serializers import BulkExportSerializer, Job
+from patients import analytics
 from utils.permissions import IsOwnerOrReadOnly
-from families.models import FamilyMember
+from utils.access import accessible_patient_ids, can_access
+from utils.filters import KeywordSearchFilter
+from utils.views import DecryptionKeysMixin, SparseFieldsetMixin
 
 # Create your views here.
 class DoctorViewSet(viewsets.ModelViewSet):
@@ -18,14 +22,45 @@ class DoctorViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     filterset_fields = ['specialty', 'hospital']
     ordering_fields = ['id', 'name', 'hospital']
+    ordering = ['-id']
     search_fields = ['id', 'name', 'hospital', 'contact_number']
     permission_classes = [IsAuthenticated, IsOwnerOrReadOnly]
+    query_budget = {
+        'list': 2,
+        'create': 4,
+        'retrieve': 2,
+        'partial_update': 4,
+        'destroy': 6,
+        'analytics': 6,
+    }
+
+    @action(detail=False, methods=["get"])
+    def analytics(self, request):
+        """
+        Vitals analytics (patients.analytics) across every patient who has
+        approved the doctor's access request: cohort distributions of the
+        per-patient means and slopes, followed by each patient's summary.
+        """
+        if request.user.role != "doctor":
+            raise PermissionDenied("Only doctors have a patient cohort.")
+        _, trend_days = analytics.parse_params(request.query_params)
+        patient_ids = sorted(accessible_patient_ids(request.user))
+        return Response(analytics.cached("cohort", patient_ids, (trend_days,),
+                                         lambda: analytics.cohort_analytics(patient_ids, trend_days)))
 
 
 class AccessRequestViewSet(viewsets.ModelViewSet):
     queryset = AccessRequest.objects.all()
     serializer_class = AccessRequestCreateSerializer
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 3,
+        'create': 7,
+        'retrieve': 3,
+        'destroy': 4,
+        'verify_otp': 4,
+        'resend_otp': 4,
+    }
 
     def get_queryset(self):
         user = self.request.user
@@ -82,7 +117,7 @@ class AccessRequestViewSet(viewsets.ModelViewSet):
         user = request.user
 
         # Only the doctor who created this request can resend the OTP
-        if not hasattr(user, "doctor_profile") or access_request.doctor != user.doctor_profile:
+        if not hasattr(user, "doctor_profile") or access_request.doctor_id != user.doctor_profile.pk:
             return Response(
                 {"detail": "Only the doctor who created this request can resend OTP."},
                 status=status.HTTP_403_FORBIDDEN
@@ -110,14 +145,21 @@ class AccessRequestViewSet(viewsets.ModelViewSet):
         )
 
 
-class EncounterViewSet(viewsets.ModelViewSet):
+class EncounterViewSet(SparseFieldsetMixin, DecryptionKeysMixin, viewsets.ModelViewSet):
     serializer_class = EncounterSerializer
     queryset = Encounter.objects.all()
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, KeywordSearchFilter, OrderingFilter]
     filterset_fields = ['patient']
-    ordering_fields = ['id', 'patient__first_name', 'patient__last_name']
-    search_fields = ['id']
+    ordering_fields = ['id', 'date', 'patient__first_name', 'patient__last_name']
+    ordering = ['-date', '-id']
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 3,
+        'create': 9,
+        'retrieve': 3,
+        'partial_update': 9,
+        'destroy': 7,
+    }
 
     def get_queryset(self):
         """
@@ -126,25 +168,9 @@ class EncounterViewSet(viewsets.ModelViewSet):
         Family Heads can see their family members' records.
         """
         user = self.request.user
-        if user.role == 'patient':
-            # Family head can see vitals for patients they have approved access to
-            approved_patient_ids = FamilyMember.objects.filter(
-                family__head_of_family=user.linked_patient, is_verified=True
-            ).values_list('patient_id', flat=True)
-
-            patient_id = user.linked_patient.id
-            approved_patient_ids = list(approved_patient_ids) + [patient_id]
-
-            return self.queryset.filter(patient_id__in=approved_patient_ids)
-        elif user.role == 'doctor':
-            doctor = user.linked_doctor.id
-
-            # Doctor can see encounters for patients they have approved access to
-            approved_patient_ids = AccessRequest.objects.filter(
-                doctor=doctor, is_approved=True
-            ).values_list('patient_id', flat=True)
-
-            return self.queryset.filter(patient_id__in=approved_patient_ids)
+        if user.role in ('patient', 'doctor'):
+            # Patients: themselves and, as family head, verified members; doctors: approved requests
+            return self.queryset.filter(patient_id__in=accessible_patient_ids(user))
         else:
             return Encounter.objects.none()
 
@@ -161,11 +187,7 @@ class EncounterViewSet(viewsets.ModelViewSet):
         
         doctor = user.doctor_profile
         # Check if doctor has approved access for the patient
-        has_access = AccessRequest.objects.filter(
-            doctor=doctor,
-            patient=patient,
-            is_approved=True
-        ).exists()
+        has_access = can_access(user, [patient.pk])
 
         if not has_access:
             raise PermissionDenied("You do not have approved access to this patient.")
@@ -181,10 +203,10 @@ class EncounterViewSet(viewsets.ModelViewSet):
             raise PermissionDenied("Only doctors are allowed to update encounter.")
 
         doctor = user.doctor_profile
-        encounter = self.get_object()
+        encounter = serializer.instance
 
         # Ensure doctor is the owner of the encounter
-        if encounter.doctor != doctor:
+        if encounter.doctor_id != doctor.pk:
             raise PermissionDenied("You can only update encounters you have created.")
 
         # Remove 'patient' and 'doctor' from update data if present
@@ -192,11 +214,7 @@ class EncounterViewSet(viewsets.ModelViewSet):
         serializer.validated_data.pop('doctor', None)
 
         # Ensure doctor still has approved access to this encounter’s patient
-        has_access = AccessRequest.objects.filter(
-            doctor=doctor,
-            patient=encounter.patient,
-            is_approved=True
-        ).exists()
+        has_access = can_access(user, [encounter.patient_id])
 
         if not has_access:
             raise PermissionDenied("You do not have approved access to this patient.")
@@ -214,15 +232,11 @@ class EncounterViewSet(viewsets.ModelViewSet):
         doctor = user.doctor_profile
 
         # Only the doctor who created the encounter can delete it
-        if instance.doctor != doctor:
+        if instance.doctor_id != doctor.pk:
             raise PermissionDenied("You can only delete encounters you have created.")
 
         # Doctor must still have approved access to the patient
-        has_access = AccessRequest.objects.filter(
-            doctor=doctor,
-            patient=instance.patient,
-            is_approved=True
-        ).exists()
+        has_access = can_access(user, [instance.patient_id])
 
         if not has_access:
             raise PermissionDenied("You do not have approved access to this patient.")
@@ -231,14 +245,21 @@ class EncounterViewSet(viewsets.ModelViewSet):
         instance.delete()
 
 
-class ClinicalNoteViewSet(viewsets.ModelViewSet):
+class ClinicalNoteViewSet(SparseFieldsetMixin, DecryptionKeysMixin, viewsets.ModelViewSet):
     serializer_class = ClinicalNoteSerializer
     queryset = ClinicalNote.objects.all()
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, KeywordSearchFilter, OrderingFilter]
     filterset_fields = ['encounter__patient']
-    ordering_fields = ['id', 'encounter__patient__first_name', 'encounter__patient__last_name']
-    search_fields = ['id']
+    ordering_fields = ['id', 'created_at', 'encounter__patient__first_name', 'encounter__patient__last_name']
+    ordering = ['-created_at', '-id']
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 3,
+        'create': 9,
+        'retrieve': 3,
+        'partial_update': 10,
+        'destroy': 7,
+    }
 
     def get_queryset(self):
         """
@@ -247,27 +268,11 @@ class ClinicalNoteViewSet(viewsets.ModelViewSet):
         Family Heads can see their family members' records.
         """
         user = self.request.user
-        if user.role == 'patient':
-            # Family head can see vitals for patients they have approved access to
-            approved_patient_ids = FamilyMember.objects.filter(
-                family__head_of_family=user.linked_patient, is_verified=True
-            ).values_list('patient_id', flat=True)
-
-            patient_id = user.linked_patient.id
-            approved_patient_ids = list(approved_patient_ids) + [patient_id]
-
-            return self.queryset.filter(encounter__patient_id__in=approved_patient_ids)
-        elif user.role == 'doctor':
-            doctor = user.linked_doctor.id
-
-            # Doctor can see encounters for patients they have approved access to
-            approved_patient_ids = AccessRequest.objects.filter(
-                doctor=doctor, is_approved=True
-            ).values_list('patient_id', flat=True)
-
-            return self.queryset.filter(encounter__patient_id__in=approved_patient_ids)
+        if user.role in ('patient', 'doctor'):
+            # Patients: themselves and, as family head, verified members; doctors: approved requests
+            return self.queryset.filter(encounter__patient_id__in=accessible_patient_ids(user))
         else:
-            return Encounter.objects.none()
+            return ClinicalNote.objects.none()
 
     def perform_create(self, serializer):
         user = self.request.user
@@ -284,15 +289,11 @@ class ClinicalNoteViewSet(viewsets.ModelViewSet):
             raise PermissionDenied("Encounter information is required to create a clinical note.")
 
         # Ensure doctor created that encounter
-        if encounter.doctor != doctor:
+        if encounter.doctor_id != doctor.pk:
             raise PermissionDenied("You can only add clinical notes to encounters you created.")
 
         # Ensure the encounter’s access is still valid
-        has_access = AccessRequest.objects.filter(
-            doctor=doctor,
-            patient=encounter.patient,
-            is_approved=True
-        ).exists()
+        has_access = can_access(user, [encounter.patient_id])
 
         if not has_access:
             raise PermissionDenied("You do not have approved access to this patient.")
@@ -308,19 +309,15 @@ class ClinicalNoteViewSet(viewsets.ModelViewSet):
             raise PermissionDenied("Only doctors are allowed to update clinical notes.")
 
         doctor = user.doctor_profile
-        note = self.get_object()
+        note = serializer.instance
         encounter = note.encounter  # Linked encounter
 
         # Ensure the doctor created the encounter for this clinical note
-        if encounter.doctor != doctor:
+        if encounter.doctor_id != doctor.pk:
             raise PermissionDenied("You can only update clinical notes for encounters you created.")
 
         # Ensure the doctor still has approved access to the patient
-        has_access = AccessRequest.objects.filter(
-            doctor=doctor,
-            patient=encounter.patient,
-            is_approved=True
-        ).exists()
+        has_access = can_access(user, [encounter.patient_id])
 
         if not has_access:
             raise PermissionDenied("You do not have approved access to this patient.")
@@ -343,18 +340,45 @@ class ClinicalNoteViewSet(viewsets.ModelViewSet):
         doctor = user.doctor_profile
 
         # Only the doctor who created the encounter can delete it
-        if instance.encounter.doctor != doctor:
+        if instance.encounter.doctor_id != doctor.pk:
             raise PermissionDenied("You can only delete clinical notes you have created.")
 
         # Doctor must still have approved access to the patient
-        has_access = AccessRequest.objects.filter(
-            doctor=doctor,
-            patient=instance.encounter.patient,
-            is_approved=True
-        ).exists()
+        has_access = can_access(user, [instance.encounter.patient_id])
 
         if not has_access:
             raise PermissionDenied("You do not have approved access to this patient.")
 
         # If all checks pass, delete
         instance.delete()
+
+
+class BulkExportViewSet(viewsets.ModelViewSet):
+    """
+    Queue a bulk chart export (doctors/jobs.py) and poll its progress. A
+    doctor exports their own approved patients; staff may pass `hospital`
+    to export the patients of every doctor there.
+    """
+    serializer_class = BulkExportSerializer
+    permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 2,
+        'create': 2,
+        'retrieve': 2,
+    }
+
+    def get_queryset(self):
+        return Job.objects.filter(kind="bulk_export", created_by=self.request.user)
+
+    def perform_create(self, serializer):
+        user = self.request.user
+        hospital = serializer.validated_data.pop("hospital", None)
+        if hospital:
+            if not user.is_staff:
+                raise PermissionDenied("Only staff can export a whole hospital.")
+            params = {"hospital": hospital}
+        elif user.role == "doctor" and user.linked_doctor_id:
+            params = {"doctor_id": user.linked_doctor_id}
+        else:
+            raise PermissionDenied("Only doctors can export their patients.")
+        serializer.save(kind="bulk_export", params=params, created_by=user)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('families', '0003_familymember_is_verified_and_more'),
+        ('patients', '0014_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='familymember',
+            index=models.Index(fields=['family', 'is_verified', 'patient'], name='families_fa_family__5446f5_idx'),
+        ),
+    ]
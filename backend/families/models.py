@@ -24,5 +24,9 @@ class FamilyMember(models.Model):
     relationship = models.CharField(max_length=20, choices=RELATIONSHIP_CHOICES)
     is_verified = models.BooleanField(default=False)
 
+    class Meta:
+        # Family heads' grant lookups read patient_id straight from the index
+        indexes = [models.Index(fields=["family", "is_verified", "patient"])]
+
     def __str__(self):
         return f"{self.patient} member of {self.family}"
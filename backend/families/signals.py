@@ -0,0 +1,19 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from utils.access import invalidate
+from .models import Family, FamilyMember
+
+
+@receiver([post_save, post_delete], sender=FamilyMember)
+def invalidate_head_grants(sender, instance, **kwargs):
+    # Adding, verifying or removing a member changes what the family head can see
+    if FamilyMember.family.is_cached(instance):
+        head_id = instance.family.head_of_family_id
+    else:
+        head_id = Family.objects.filter(pk=instance.family_id).values_list("head_of_family_id", flat=True).first()
+    invalidate("patient", head_id)
+
+
+@receiver([post_save, post_delete], sender=Family)
+def invalidate_family_grants(sender, instance, **kwargs):
+    invalidate("patient", instance.head_of_family_id)
@@ -1,3 +1,60 @@
-from django.test import TestCase
+from utils import testing
 
-# Create your tests here.
+
+class FamilyQueryBudgetTests(testing.QueryBudgetTestCase):
+    urlconf = "families.urls"
+
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.user = self.patient.user
+        self.family = testing.make_family(self.patient)
+        self.login(self.user)
+
+    def grow_families(self, n):
+        # A patient heads at most one family
+        for _ in range(n):
+            testing.make_family(testing.make_patient())
+
+    def grow_members(self, n):
+        for _ in range(n):
+            testing.add_member(self.family)
+
+    def new_patient(self):
+        patient = testing.make_patient()
+        self.login(patient.user)
+        return ()
+
+    def budget_cases(self):
+        member = testing.add_member(self.family)
+        return {
+            ("", "get"): {"request": lambda: self.client.get("/v1/families/"), "grow": self.grow_families},
+            ("", "post"): {
+                "setup": self.new_patient,
+                "request": lambda: self.client.post("/v1/families/", {
+                    "name": "Shah Family", "description": "Joint family"}, format="json"),
+                "grow": self.grow_families,
+            },
+            ("<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"/v1/families/{self.family.pk}/"), "grow": self.grow_families,
+            },
+            ("<int:pk>/", "patch"): {
+                "request": lambda: self.client.patch(f"/v1/families/{self.family.pk}/", {
+                    "description": "Extended family"}, format="json"),
+                "grow": self.grow_families,
+            },
+            ("members/", "get"): {"request": lambda: self.client.get("/v1/families/members/"), "grow": self.grow_members},
+            ("members/", "post"): {
+                "setup": lambda: (testing.make_patient(),),
+                "request": lambda patient: self.client.post("/v1/families/members/", {
+                    "family": self.family.pk, "patient": patient.pk, "relationship": "spouse"}, format="json"),
+                "grow": self.grow_members,
+            },
+            ("members/<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"/v1/families/members/{member.pk}/"), "grow": self.grow_members,
+            },
+            ("members/<int:pk>/", "delete"): {
+                "setup": lambda: (testing.add_member(self.family),),
+                "request": lambda member: self.client.delete(f"/v1/families/members/{member.pk}/"),
+                "grow": self.grow_members,
+            },
+        }
@@ -9,11 +9,17 @@ class FamilyViewSet(viewsets.ModelViewSet):
     queryset = Family.objects.all()
     serializer_class = FamilySerializer
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 2,
+        'create': 3,
+        'retrieve': 2,
+        'partial_update': 5,
+    }
 
     def get_queryset(self):
         user = self.request.user
         if user.role == 'patient':
-            patient_id = user.linked_patient.id
+            patient_id = user.linked_patient_id
             return Family.objects.filter(head_of_family__id=patient_id)
         else:
             return Family.objects.none()
@@ -27,11 +33,11 @@ class FamilyViewSet(viewsets.ModelViewSet):
 
     def perform_update(self, serializer):
         user = self.request.user
-        family = self.get_object()  # current vital being updated
+        family = serializer.instance  # current vital being updated
 
         # Patient can only update their own vitals
         if user.role == "patient":
-            if family.head_of_family == user.linked_patient:
+            if family.head_of_family_id == user.linked_patient_id:
                 serializer.validated_data.pop('head_of_family', None)
                 serializer.save()
                 return
@@ -46,12 +52,18 @@ class FamilyMemberViewSet(viewsets.ModelViewSet):
     queryset = FamilyMember.objects.all()
     serializer_class = FamilyMemberSerializer
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 2,
+        'create': 5,
+        'retrieve': 2,
+        'destroy': 4,
+    }
 
     def get_queryset(self):
         # Allow only the head of a family to view members.
         user = self.request.user
         if user.role == 'patient':
-            patient_id = user.linked_patient.id
+            patient_id = user.linked_patient_id
             return FamilyMember.objects.filter(family__head_of_family__id=patient_id)
         else:
             return FamilyMember.objects.none()
@@ -65,7 +77,7 @@ class FamilyMemberViewSet(viewsets.ModelViewSet):
             raise PermissionDenied("Only patients are allowed to add Family members.")
     
         # Only head of the family can add members
-        if family.head_of_family != user.linked_patient:
+        if family.head_of_family_id != user.linked_patient_id:
             raise PermissionDenied("Only the head of this family can add members.")
 
         serializer.save()
@@ -78,7 +90,7 @@ class FamilyMemberViewSet(viewsets.ModelViewSet):
             raise PermissionDenied("Only patients are allowed to delete Family members.")
 
         # Only head of the family can delete members
-        if instance.family.head_of_family != user.linked_patient:
+        if instance.family.head_of_family_id != user.linked_patient_id:
             raise PermissionDenied("Only the head of this family can remove members.")
 
         instance.delete()
@@ -0,0 +1,15 @@
+from django.contrib import admin
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "status", "progress", "attempts", "created_at", "finished_at")
+    list_filter = ("kind", "status")
+    readonly_fields = ("kind", "params", "checkpoint", "progress", "attempts", "error", "created_by",
+                       "created_at", "updated_at", "started_at", "finished_at")
+    actions = ["retry"]
+
+    @admin.action(description="Retry selected jobs from their checkpoint")
+    def retry(self, request, queryset):
+        queryset.exclude(status="running").update(status="pending")
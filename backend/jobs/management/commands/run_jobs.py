@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand
+from jobs.worker import claim_next_job, requeue_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs (key rotation re-encryption, purges, exports)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("kinds", nargs="*", help="Only run jobs of these kinds")
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+        parser.add_argument("--poll", type=float, default=5, help="Seconds between queue checks (default 5)")
+        parser.add_argument("--stale-after", type=int, default=600,
+                            help="Requeue running jobs with no checkpoint for this many seconds (default 600)")
+
+    def handle(self, *args, **options):
+        while True:
+            requeued = requeue_stale_jobs(options["stale_after"])
+            if requeued:
+                self.stdout.write(f"Requeued {requeued} stale job(s)")
+            job = claim_next_job(options["kinds"] or None)
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll"])
+                continue
+            self.stdout.write(f"Running {job}")
+            ok = run_job(job)
+            style = self.style.SUCCESS if ok else self.style.ERROR
+            self.stdout.write(style(f"Job {job.pk} {'done' if ok else 'failed'}"))
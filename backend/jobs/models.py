@@ -0,0 +1,44 @@
+from django.db import models
+from django.conf import settings
+from django.utils import timezone
+
+
+class Job(models.Model):
+    """
+    A unit of background work run by `manage.py run_jobs`. Handlers are
+    registered per `kind` (see jobs/registry.py) and record their progress in
+    `checkpoint`, so a job interrupted mid-way resumes where it stopped.
+    """
+    STATUS_CHOICES = [("pending", "Pending"), ("running", "Running"), ("done", "Done"), ("failed", "Failed")]
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending", db_index=True)
+    checkpoint = models.JSONField(default=dict, blank=True)
+    progress = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL,
+                                   related_name="jobs", null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    @classmethod
+    def enqueue(cls, kind, created_by=None, **params):
+        return cls.objects.create(kind=kind, params=params, created_by=created_by)
+
+    def save_checkpoint(self, progress=None, **state):
+        # Persist handler state without touching the status columns
+        self.checkpoint.update(state)
+        if progress is not None:
+            self.progress = progress
+        Job.objects.filter(pk=self.pk).update(checkpoint=self.checkpoint, progress=self.progress,
+                                              updated_at=timezone.now())
+
+    def heartbeat(self):
+        # Keep requeue_stale_jobs off a long step without touching the checkpoint
+        Job.objects.filter(pk=self.pk).update(updated_at=timezone.now())
+
+    def __str__(self):
+        return f"{self.kind} job {self.pk} ({self.status})"
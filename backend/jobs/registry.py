@@ -0,0 +1,13 @@
+# jobs/registry.py
+JOB_HANDLERS = {}
+
+
+def register(kind):
+    """
+    Register `func(job)` as the handler for jobs of `kind`. Handlers must be
+    safe to re-run from job.checkpoint after an interruption.
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
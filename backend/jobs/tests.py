@@ -0,0 +1,44 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.utils import timezone
+from jobs.models import Job
+from jobs.worker import claim_next_job, requeue_stale_jobs, run_job
+
+
+class WorkerTests(TestCase):
+    def test_claims_oldest_pending_job_once(self):
+        first, second = Job.enqueue("purge_user", user_id=1), Job.enqueue("purge_user", user_id=2)
+        self.assertEqual(claim_next_job().pk, first.pk)
+        self.assertEqual(claim_next_job().pk, second.pk)
+        self.assertIsNone(claim_next_job())
+        self.assertIsNone(claim_next_job(kinds=["bulk_export"]))
+
+    def test_failure_keeps_checkpoint_for_the_rerun(self):
+        job = Job.enqueue("purge_user", user_id=1)
+
+        def handler(job):
+            job.save_checkpoint(progress=3, step=1)
+            raise RuntimeError("boom")
+
+        with patch.dict("jobs.registry.JOB_HANDLERS", {"purge_user": handler}), self.assertLogs("jobs.worker"):
+            self.assertFalse(run_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.progress, job.checkpoint), ("failed", 1, 3, {"step": 1}))
+        self.assertIn("RuntimeError: boom", job.error)
+
+    def test_requeues_jobs_that_stopped_checkpointing(self):
+        stale, live = Job.enqueue("purge_user", user_id=1), Job.enqueue("purge_user", user_id=2)
+        Job.objects.update(status="running")
+        Job.objects.filter(pk=stale.pk).update(updated_at=timezone.now() - timedelta(minutes=20))
+        self.assertEqual(requeue_stale_jobs(600), 1)
+        self.assertEqual(dict(Job.objects.values_list("pk", "status")), {stale.pk: "pending", live.pk: "running"})
+
+    def test_heartbeat_keeps_a_running_job_claimed(self):
+        job = Job.enqueue("purge_user", user_id=1)
+        Job.objects.filter(pk=job.pk).update(status="running", updated_at=timezone.now() - timedelta(minutes=20))
+        job.heartbeat()
+        self.assertEqual(requeue_stale_jobs(600), 0)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.checkpoint), ("running", {}))
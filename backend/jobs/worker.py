@@ -0,0 +1,44 @@
+# jobs/worker.py
+import logging
+import traceback
+from datetime import timedelta
+
+from django.utils import timezone
+from jobs.models import Job
+from jobs.registry import JOB_HANDLERS
+
+logger = logging.getLogger(__name__)
+
+
+def requeue_stale_jobs(stale_after):
+    # A running job that stopped checkpointing lost its worker; let another resume it
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return Job.objects.filter(status="running", updated_at__lt=cutoff).update(status="pending")
+
+
+def claim_next_job(kinds=None):
+    """
+    Atomically move the oldest pending job to running and return it, or None.
+    The conditional update makes concurrent workers skip each other's jobs.
+    """
+    candidates = Job.objects.filter(status="pending", kind__in=kinds or JOB_HANDLERS).order_by("id")
+    for job in candidates.only("id")[:10]:
+        claimed = Job.objects.filter(pk=job.pk, status="pending").update(
+            status="running", started_at=timezone.now(), updated_at=timezone.now())
+        if claimed:
+            return Job.objects.get(pk=job.pk)
+    return None
+
+
+def run_job(job):
+    job.attempts += 1
+    Job.objects.filter(pk=job.pk).update(attempts=job.attempts)
+    try:
+        JOB_HANDLERS[job.kind](job)
+    except Exception:
+        logger.exception("Job %s failed", job.pk)
+        Job.objects.filter(pk=job.pk).update(status="failed", error=traceback.format_exc(),
+                                             finished_at=timezone.now())
+        return False
+    Job.objects.filter(pk=job.pk).update(status="done", error=None, finished_at=timezone.now())
+    return True
@@ -1,4 +1,6 @@
 from django.contrib import admin
+from django.db.models import Q
+from utils.encryption import blind_index
 from .models import Patient, Vital, MedicalHistory
 
 @admin.register(Patient)
@@ -7,9 +9,12 @@ class CustomPatientAdmin(admin.ModelAdmin):
     list_display = ("id", "first_name", "last_name", "gender", "contact_number_display")
     list_filter = ("gender",)
     ordering = ("id", "first_name", "last_name")
-    search_fields = ("first_name", "last_name", "contact_number", "aadhar_number")
+    search_fields = ("first_name", "last_name")
     readonly_fields = ("contact_number_display", "aadhar_display")
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_decryption_keys()
+
     fieldsets = (
         (None, {
             "fields": ("first_name", "last_name", "gender",
@@ -18,6 +23,16 @@ class CustomPatientAdmin(admin.ModelAdmin):
         }),
     )
 
+    def get_search_results(self, request, queryset, search_term):
+        # Also match the exact Aadhar/contact number through the blind indexes
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            results |= queryset.filter(
+                Q(aadhar_number_index=blind_index("aadhar_number", search_term)) |
+                Q(contact_number_index=blind_index("contact_number", search_term))
+            )
+        return results, may_have_duplicates
+
     def contact_number_display(self, obj):
         return obj.contact_number_decrypted or "—"
     contact_number_display.short_description = "Contact Number"
@@ -37,7 +52,7 @@ class CustomVitalsAdmin(admin.ModelAdmin):
     readonly_fields = ("recorded_at",)
     list_filter = ("patient__gender",)
     ordering = ("id", "patient__first_name", "patient__last_name")
-    search_fields = ("patient__first_name", "patient__last_name", "patient__contact_number", "patient__aadhar_number")
+    search_fields = ("patient__first_name", "patient__last_name")
 
 @admin.register(MedicalHistory)
 class CustomMedicalHistoryAdmin(admin.ModelAdmin):
@@ -47,6 +62,9 @@ class CustomMedicalHistoryAdmin(admin.ModelAdmin):
         "type_of_display", "description_display", "diagnosis_code_display",
         "status_display", "notes_display"
     )
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_decryption_keys()
     
     fieldsets = (
         (None, {
@@ -0,0 +1,230 @@
+# patients/analytics.py
+"""
+Vitals analytics computed with NumPy. Readings are read with a single
+values_list() into column arrays (NaN where a metric is missing), joined
+with the archived columns and sorted by patient and time, and every figure
+is a vectorized pass over those columns: per-patient sums, extremes and
+least-squares slopes are ufunc.reduceat() over each patient's run of rows,
+so a cohort costs the same handful of passes as one patient.
+
+Results are cached (VITALS_ANALYTICS_CACHE_TTL) under a key built from the
+newest recorded_at of the readings involved, together with their count and
+highest id so back-filled readings also miss. New readings therefore never
+serve stale figures; an edit to an existing reading shows once the entry
+expires.
+"""
+import hashlib
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+from rest_framework.exceptions import ValidationError
+from .archive import archived_columns, from_micros, to_micros
+from .models import Vital, VitalArchive
+
+CACHE_PREFIX = "vitals-analytics"
+ROLLING_METRICS = ["heart_rate_bpm", "blood_pressure"]
+# Query parameter: (default, smallest, largest)
+PARAMS = {"window": (7, 2, 500), "trend_days": (30, 1, 3650)}
+ROLLING_POINTS = 100
+ANOMALY_Z = 3.0
+ANOMALY_MIN_READINGS = 10
+ANOMALY_LIMIT = 20
+MICROS_PER_DAY = 86_400_000_000
+
+
+def _number(value, digits=2):
+    # JSON-friendly float: NaN and infinities become None
+    return round(float(value), digits) if np.isfinite(value) else None
+
+
+def parse_params(query_params):
+    """(window, trend_days) from the query string, 400 when out of range."""
+    values = []
+    for name, (default, low, high) in PARAMS.items():
+        try:
+            value = int(query_params.get(name, default))
+        except (TypeError, ValueError):
+            value = None
+        if value is None or not low <= value <= high:
+            raise ValidationError({name: f"Use a whole number from {low} to {high}."})
+        values.append(value)
+    return tuple(values)
+
+
+def load_columns(patient_ids):
+    """
+    (patient ids, recorded_at in epoch microseconds, values) for every
+    reading of `patient_ids`, archived ones included, ordered by patient and
+    time; `values` has one float column per Vital.METRICS entry.
+    """
+    rows = list(Vital.objects.filter(patient_id__in=patient_ids).order_by("patient_id", "recorded_at", "id")
+                .values_list("patient_id", "recorded_at", *Vital.METRICS))
+    archived = archived_columns(patient_ids)
+    patients = np.concatenate([np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+                               archived["patient"]])
+    times = np.concatenate([np.fromiter((to_micros(row[1]) for row in rows), dtype=np.int64, count=len(rows)),
+                            archived["recorded_at"]])
+    values = np.concatenate([np.array([row[2:] for row in rows], dtype=np.float64).reshape(len(rows), len(Vital.METRICS)),
+                             np.column_stack([archived[metric] for metric in Vital.METRICS])])
+    order = np.lexsort((times, patients))
+    return patients[order], times[order], values[order]
+
+
+def bmi(values):
+    """Body-mass index of every reading, NaN where height or weight is missing."""
+    heights = values[:, Vital.METRICS.index("height_cm")] / 100
+    weights = values[:, Vital.METRICS.index("weight_kg")]
+    return weights / heights ** 2
+
+
+def rolling_mean(values, window):
+    """Trailing mean over each `window` consecutive values; the first window - 1 positions have none."""
+    if len(values) < window:
+        return np.empty(0)
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    return (sums[window:] - sums[:-window]) / window
+
+
+def _statistics(patients, times, values, trend_days):
+    # Arrays of per-patient (rows) by metric (columns) figures, plus the per-reading outlier mask
+    ids, starts, counts = np.unique(patients, return_index=True, return_counts=True)
+    valid = ~np.isnan(values)
+    n = np.add.reduceat(valid, starts).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(np.where(valid, values, 0.0), starts) / n
+        deviation = np.where(valid, values - np.repeat(mean, counts, axis=0), 0.0)
+        std = np.sqrt(np.add.reduceat(deviation ** 2, starts) / n)
+        low = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+        high = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+
+        # Least-squares slope over the trend window: cov(t, v) / var(t) per patient and metric
+        latest = np.maximum.reduceat(times, starts)
+        recent = valid & (times >= np.repeat(latest, counts) - trend_days * MICROS_PER_DAY)[:, None]
+        days = np.broadcast_to(((times - times.min()) / MICROS_PER_DAY)[:, None], values.shape)
+        m = np.add.reduceat(recent, starts).astype(np.float64)
+        t_mean = np.add.reduceat(np.where(recent, days, 0.0), starts) / m
+        v_mean = np.add.reduceat(np.where(recent, values, 0.0), starts) / m
+        dt = np.where(recent, days - np.repeat(t_mean, counts, axis=0), 0.0)
+        dv = np.where(recent, values - np.repeat(v_mean, counts, axis=0), 0.0)
+        slope = np.add.reduceat(dt * dv, starts) / np.add.reduceat(dt ** 2, starts)
+
+        z = deviation / np.repeat(std, counts, axis=0)
+    outliers = valid & (np.abs(z) > ANOMALY_Z) & (np.repeat(n, counts, axis=0) >= ANOMALY_MIN_READINGS)
+
+    # Latest BMI: the value at the last row of each run that has both height and weight
+    bmis = bmi(values)
+    last_bmi = np.maximum.reduceat(np.where(np.isnan(bmis), -1, np.arange(len(bmis))), starts)
+    return {
+        "ids": ids, "counts": counts, "first": times[starts], "latest": latest,
+        "bmi": np.where(last_bmi >= 0, bmis[last_bmi], np.nan),
+        "n": n, "mean": mean, "std": std, "min": low, "max": high, "slope": slope,
+        "anomalies": np.add.reduceat(outliers, starts), "z": z, "outliers": outliers,
+    }
+
+
+def summarise(patients, times, values, trend_days):
+    """
+    Per-patient statistics for the columns from load_columns(), as a list of
+    dicts ordered by patient id. Slopes are per day, fitted over each
+    patient's last `trend_days` days of readings; anomalies are readings
+    more than ANOMALY_Z standard deviations from the patient's mean.
+    """
+    if not len(patients):
+        return []
+    return _rows(_statistics(patients, times, values, trend_days))
+
+
+def _rows(stats):
+    return [{
+        "patient": int(patient),
+        "readings": int(stats["counts"][i]),
+        "first_recorded_at": from_micros(stats["first"][i]),
+        "last_recorded_at": from_micros(stats["latest"][i]),
+        "bmi": _number(stats["bmi"][i]),
+        "metrics": {metric: {
+            "count": int(stats["n"][i, j]),
+            "mean": _number(stats["mean"][i, j]),
+            "std": _number(stats["std"][i, j]),
+            "min": _number(stats["min"][i, j]),
+            "max": _number(stats["max"][i, j]),
+            "slope_per_day": _number(stats["slope"][i, j], 4),
+            "anomalies": int(stats["anomalies"][i, j]),
+        } for j, metric in enumerate(Vital.METRICS)},
+    } for i, patient in enumerate(stats["ids"])]
+
+
+def patient_analytics(patient_id, window, trend_days):
+    """summarise() for one patient plus rolling means and the most recent anomalous readings."""
+    patients, times, values = load_columns([patient_id])
+    summary, recent = {"patient": int(patient_id), "readings": 0}, []
+    if len(patients):
+        stats = _statistics(patients, times, values, trend_days)
+        [summary] = _rows(stats)
+        rows, columns = np.nonzero(stats["outliers"])
+        for row, column in sorted(zip(rows, columns), reverse=True)[:ANOMALY_LIMIT]:
+            recent.append({"recorded_at": from_micros(times[row]), "metric": Vital.METRICS[column],
+                           "value": _number(values[row, column]), "z": _number(stats["z"][row, column])})
+
+    rolling = {}
+    for metric in ROLLING_METRICS:
+        column = values[:, Vital.METRICS.index(metric)]
+        present = ~np.isnan(column)
+        means = rolling_mean(column[present], window)[-ROLLING_POINTS:]
+        stamps = times[present][present.sum() - len(means):]
+        rolling[metric] = [{"recorded_at": from_micros(t), "mean": _number(v)} for t, v in zip(stamps, means)]
+    return {**summary, "window": window, "rolling": rolling, "recent_anomalies": recent}
+
+
+def cohort_analytics(patient_ids, trend_days):
+    """summarise() for every patient in `patient_ids` plus cohort-wide distributions of the patient means."""
+    patients, times, values = load_columns(patient_ids)
+    if not len(patients):
+        return {"patients": len(patient_ids), "patients_with_readings": 0, "readings": 0,
+                "bmi": {"patients": 0, "mean": None}, "metrics": {}, "per_patient": []}
+    stats = _statistics(patients, times, values, trend_days)
+    cohort = {}
+    for j, metric in enumerate(Vital.METRICS):
+        means = stats["mean"][:, j][stats["n"][:, j] > 0]
+        slopes = stats["slope"][:, j][np.isfinite(stats["slope"][:, j])]
+        p10, p50, p90 = np.percentile(means, [10, 50, 90]) if len(means) else (np.nan,) * 3
+        cohort[metric] = {
+            "patients": len(means),
+            "mean": _number(means.mean()) if len(means) else None,
+            "p10": _number(p10), "p50": _number(p50), "p90": _number(p90),
+            "mean_slope_per_day": _number(slopes.mean(), 4) if len(slopes) else None,
+            "patients_with_anomalies": int((stats["anomalies"][:, j] > 0).sum()),
+        }
+    bmis = stats["bmi"][~np.isnan(stats["bmi"])]
+    return {
+        "patients": len(patient_ids),
+        "patients_with_readings": len(stats["ids"]),
+        "readings": len(patients),
+        "bmi": {"patients": len(bmis), "mean": _number(bmis.mean()) if len(bmis) else None},
+        "metrics": cohort,
+        "per_patient": _rows(stats),
+    }
+
+
+def cached(kind, patient_ids, params, compute):
+    """
+    compute() memoised under the newest recorded_at, row count and highest
+    id of the readings of `patient_ids`, and the newest reading and total
+    count of their archives (archive_vitals moves and merges readings);
+    costs two aggregate queries per hit.
+    """
+    stamp = Vital.objects.filter(patient_id__in=patient_ids).aggregate(
+        latest=Max("recorded_at"), rows=Count("id"), last_id=Max("id"))
+    archived = VitalArchive.objects.filter(patient_id__in=patient_ids).aggregate(
+        latest=Max("last_recorded_at"), rows=Sum("count"), blobs=Count("id"))
+    scope = hashlib.sha1(",".join(map(str, sorted(patient_ids))).encode()).hexdigest()
+    latest = stamp["latest"].isoformat() if stamp["latest"] else "-"
+    archived_latest = archived["latest"].isoformat() if archived["latest"] else "-"
+    key = (f"{CACHE_PREFIX}:{kind}:{scope}:{':'.join(map(str, params))}:{latest}:{stamp['rows']}:{stamp['last_id']}"
+           f":{archived_latest}:{archived['rows'] or 0}:{archived['blobs']}")
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, getattr(settings, "VITALS_ANALYTICS_CACHE_TTL", 3600))
+    return result
@@ -0,0 +1,293 @@
+# patients/archive.py
+"""
+Cold tier for old vitals. Readings older than VITALS_RETENTION_DAYS are
+packed per patient and calendar month into a VitalArchive row and the raw
+rows are deleted, so the hot table only ever holds the retention window.
+
+A blob is a small header followed by zlib-compressed column arrays: the
+reading ids and recorded_at (epoch microseconds) delta-encoded, then one
+float64 column per metric with NaN for a missing value.
+
+Rollups are left alone because they already count the archived readings.
+The reads that used the raw rows cover the archive too:
+- TieredVitals, for the vitals list
+- latest_archived()
+- archived_columns(), for analytics
+- iter_archived_vitals(), for exports
+
+Archived readings are read-only.
+"""
+import operator
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import Vital, VitalArchive
+
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<BI")  # format version, readings
+COLUMNS = {"id": "<i8", "recorded_at": "<i8", **{metric: "<f8" for metric in Vital.METRICS}}
+DELTA_COLUMNS = {"id", "recorded_at"}
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def to_micros(when):
+    return (when - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+def pack(columns):
+    """Serialise a {column: array} dict of equal-length COLUMNS into a blob."""
+    count = len(columns["id"])
+    body = b"".join(
+        np.ascontiguousarray(np.diff(columns[name], prepend=0) if name in DELTA_COLUMNS else columns[name],
+                             dtype=dtype).tobytes()
+        for name, dtype in COLUMNS.items())
+    return HEADER.pack(FORMAT_VERSION, count) + zlib.compress(body, 9)
+
+
+def unpack(data):
+    """Inverse of pack()."""
+    data = bytes(data)
+    version, count = HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unknown vitals archive format {version}")
+    body = zlib.decompress(data[HEADER.size:])
+    columns, offset = {}, 0
+    for name, dtype in COLUMNS.items():
+        column = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+        offset += column.nbytes
+        columns[name] = np.cumsum(column) if name in DELTA_COLUMNS else column
+    return columns
+
+
+def _select(columns, mask):
+    return {name: column[mask] for name, column in columns.items()}
+
+
+def _columns(rows):
+    # (id, recorded_at, *metrics) tuples in time order -> COLUMNS arrays
+    values = np.array([row[2:] for row in rows], dtype=np.float64).reshape(len(rows), len(Vital.METRICS))
+    return {
+        "id": np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+        "recorded_at": np.fromiter((to_micros(row[1]) for row in rows), dtype=np.int64, count=len(rows)),
+        **{metric: values[:, j] for j, metric in enumerate(Vital.METRICS)},
+    }
+
+
+def retention_cutoff(days=None, now=None):
+    """Start of the local day `days` (default VITALS_RETENTION_DAYS) ago; older readings are archived."""
+    days = days if days is not None else getattr(settings, "VITALS_RETENTION_DAYS", 365)
+    when = timezone.localtime((now or timezone.now()) - timedelta(days=days))
+    # Whole days, so no hourly or daily rollup bucket is split between the tiers
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def archive_patient(patient_id, before):
+    """
+    Move the patient's readings recorded before `before` into their
+    monthly archives, merging with any already there. Returns the number
+    of readings archived.
+    """
+    with transaction.atomic():
+        rows = list(Vital.objects.filter(patient_id=patient_id, recorded_at__lt=before)
+                    .order_by("recorded_at", "id").values_list("id", "recorded_at", *Vital.METRICS))
+        if not rows:
+            return 0
+        tz = timezone.get_current_timezone()
+        months = {}
+        for row in rows:
+            month = timezone.localtime(row[1], tz).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            months.setdefault(month, []).append(row)
+        existing = {archive.month: archive for archive in
+                    VitalArchive.objects.select_for_update().filter(patient_id=patient_id, month__in=list(months))}
+        for month, month_rows in months.items():
+            columns = _columns(month_rows)
+            archive = existing.get(month)
+            if archive is not None:
+                old = unpack(archive.data)
+                columns = {name: np.concatenate([old[name], columns[name]]) for name in COLUMNS}
+                columns = _select(columns, np.lexsort((columns["id"], columns["recorded_at"])))
+            else:
+                archive = VitalArchive(patient_id=patient_id, month=month)
+            archive.first_recorded_at = from_micros(columns["recorded_at"][0])
+            archive.last_recorded_at = from_micros(columns["recorded_at"][-1])
+            archive.count = len(columns["id"])
+            archive.data = pack(columns)
+            archive.save()
+        # Bounded by id too, so a reading back-filled meanwhile is left for the next run
+        Vital.objects.filter(patient_id=patient_id, recorded_at__lt=before,
+                             pk__lte=max(row[0] for row in rows)).delete()
+    return len(rows)
+
+
+def archive_old_vitals(before=None, after_patient=0, on_patient=None):
+    """
+    Archive every patient's readings older than `before` (default
+    retention_cutoff()), one transaction per patient in id order starting
+    after `after_patient`. on_patient(patient_id, archived) follows each.
+    Returns the number of readings archived.
+    """
+    before = before or retention_cutoff()
+    patient_ids = (Vital.objects.filter(recorded_at__lt=before, patient_id__gt=after_patient)
+                   .order_by("patient_id").values_list("patient_id", flat=True).distinct())
+    total = 0
+    for patient_id in list(patient_ids):
+        archived = archive_patient(patient_id, before)
+        total += archived
+        if on_patient:
+            on_patient(patient_id, archived)
+    return total
+
+
+def to_vitals(patient_id, columns):
+    """Unsaved Vital instances, with their original ids, for archived columns."""
+    fields = {metric: Vital._meta.get_field(metric) for metric in Vital.METRICS}
+    vitals = []
+    for i in range(len(columns["id"])):
+        values = {metric: None if np.isnan(value := columns[metric][i]) else field.to_python(float(value))
+                  for metric, field in fields.items()}
+        vitals.append(Vital(pk=int(columns["id"][i]), patient_id=patient_id,
+                            recorded_at=from_micros(columns["recorded_at"][i]), **values))
+    return vitals
+
+
+def archived_columns(patient_ids, start=None, end=None):
+    """
+    COLUMNS plus a "patient" column for the archived readings of
+    `patient_ids` recorded in [start, end), ordered by patient and time.
+    """
+    archives = VitalArchive.objects.filter(patient_id__in=patient_ids)
+    if start is not None:
+        archives = archives.filter(last_recorded_at__gte=start)
+    if end is not None:
+        archives = archives.filter(first_recorded_at__lt=end)
+    parts = []
+    for patient_id, data in archives.order_by("patient_id", "month").values_list("patient_id", "data"):
+        columns = unpack(data)
+        parts.append({**columns, "patient": np.full(len(columns["id"]), patient_id, dtype=np.int64)})
+    dtypes = {**COLUMNS, "patient": "<i8"}
+    columns = {name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtype=dtype)
+               for name, dtype in dtypes.items()}
+    mask = np.ones(len(columns["id"]), dtype=bool)
+    if start is not None:
+        mask &= columns["recorded_at"] >= to_micros(start)
+    if end is not None:
+        mask &= columns["recorded_at"] < to_micros(end)
+    return _select(columns, mask)
+
+
+def iter_archived_vitals(patient_ids):
+    # One blob in memory at a time, for exports
+    archives = VitalArchive.objects.filter(patient_id__in=patient_ids).order_by("patient_id", "month")
+    for archive in archives.iterator(chunk_size=10):
+        yield from to_vitals(archive.patient_id, unpack(archive.data))
+
+
+def latest_archived(patient_id):
+    """The patient's newest archived reading, or None."""
+    archive = VitalArchive.objects.filter(patient_id=patient_id).order_by("-last_recorded_at").first()
+    if archive is None:
+        return None
+    return to_vitals(patient_id, _select(unpack(archive.data), slice(-1, None)))[0]
+
+
+class TieredVitals:
+    """
+    A patient's hot readings (`queryset`) continued into their archive,
+    with just enough of the QuerySet API for KeysetPagination: order_by(),
+    filter() with exact/lt/lte/gt/gte on recorded_at or id (Q objects
+    included, for the cursor's seek), and slicing. Blobs are unpacked in
+    time order and only until the slice is filled, so a page costs one
+    extra metadata query plus the blobs it actually reaches.
+    """
+    LOOKUPS = {"exact": operator.eq, "lt": operator.lt, "lte": operator.le, "gt": operator.gt, "gte": operator.ge}
+
+    def __init__(self, queryset, patient_id, ordering=("-recorded_at", "-id"), conditions=()):
+        self.queryset = queryset
+        self.patient_id = patient_id
+        self.ordering = tuple(ordering)
+        self.conditions = tuple(conditions)
+
+    def order_by(self, *ordering):
+        return TieredVitals(self.queryset.order_by(*ordering), self.patient_id, ordering, self.conditions)
+
+    def filter(self, *args, **kwargs):
+        condition = Q(*args, **kwargs)
+        return TieredVitals(self.queryset.filter(condition), self.patient_id, self.ordering,
+                            self.conditions + (condition,))
+
+    @staticmethod
+    def _lookup(key, value):
+        name, _, lookup = key.partition("__")
+        return name, lookup or "exact", Vital._meta.get_field(name).to_python(value)
+
+    def _mask(self, condition, columns):
+        """Evaluate a Q over unpacked columns."""
+        masks = []
+        for child in condition.children:
+            if isinstance(child, Q):
+                masks.append(self._mask(child, columns))
+                continue
+            name, lookup, value = self._lookup(*child)
+            masks.append(self.LOOKUPS[lookup](columns[name], to_micros(value) if name == "recorded_at" else value))
+        combine = np.logical_and if condition.connector == Q.AND else np.logical_or
+        mask = combine.reduce(masks) if masks else np.ones(len(columns["id"]), dtype=bool)
+        return ~mask if condition.negated else mask
+
+    def _sorted(self, vitals):
+        for order in reversed(self.ordering):
+            vitals.sort(key=operator.attrgetter(order.lstrip("-")), reverse=order.startswith("-"))
+        return vitals
+
+    def _archives(self):
+        archives = VitalArchive.objects.filter(patient_id=self.patient_id).defer("data")
+        # Blobs are skipped on the bounds every row must meet: top-level ANDed recorded_at lookups
+        bounds = [child for condition in self.conditions if condition.connector == Q.AND and not condition.negated
+                  for child in condition.children if not isinstance(child, Q)]
+        for name, lookup, value in (self._lookup(*bound) for bound in bounds):
+            if name != "recorded_at":
+                continue
+            if lookup in ("lt", "lte"):
+                archives = archives.filter(**{f"first_recorded_at__{lookup}": value})
+            elif lookup in ("gt", "gte"):
+                archives = archives.filter(**{f"last_recorded_at__{lookup}": value})
+            else:
+                archives = archives.filter(first_recorded_at__lte=value, last_recorded_at__gte=value)
+        return list(archives.order_by("-month" if self.ordering[0] == "-recorded_at" else "month"))
+
+    def _unpack(self, archive, limit):
+        # Only the readings that could fall among the first `limit` in the ordering become Vitals
+        columns = unpack(archive.data)
+        mask = np.ones(archive.count, dtype=bool)
+        for condition in self.conditions:
+            mask &= self._mask(condition, columns)
+        columns = _select(columns, mask)
+        key = columns[self.ordering[0].lstrip("-")]
+        if len(key) > limit:
+            descending = self.ordering[0].startswith("-")
+            threshold = np.sort(key)[-limit if descending else limit - 1]
+            columns = _select(columns, key >= threshold if descending else key <= threshold)
+        return to_vitals(self.patient_id, columns)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.stop is None:
+            raise TypeError("TieredVitals supports bounded slices only")
+        vitals = list(self.queryset[:item.stop])
+        descending = self.ordering[0].startswith("-")
+        for archive in self._archives():
+            if self.ordering[0].lstrip("-") == "recorded_at" and len(vitals) >= item.stop:
+                # The slice is full once its last reading comes before anything in this blob
+                edge = vitals[item.stop - 1].recorded_at
+                if edge > archive.last_recorded_at if descending else edge < archive.first_recorded_at:
+                    break
+            vitals = self._sorted(vitals + self._unpack(archive, item.stop))
+        return vitals[item]
@@ -0,0 +1,151 @@
+# patients/ingest.py
+"""
+Batch ingestion of vitals readings pushed by devices. Each batch of
+INGEST_BATCH_SIZE rows is validated a column at a time against the
+VitalsSerializer limits: values are parsed into numpy columns (JSON numbers
+directly, anything else through the serializer's own field, so "72" is
+accepted as it is by the API) and the range and pairing checks are array
+operations rather than a serializer per row. Valid rows are written with
+bulk_create and folded into the rollups once per batch, and invalid rows
+are reported by their position in the upload.
+"""
+import functools
+import json
+from itertools import islice
+
+import numpy as np
+from django.db import models, transaction
+from django.utils import timezone
+from rest_framework import serializers
+from utils.filters import parse_instant
+from .models import Vital
+from .rollups import add_readings
+from .serializers import HEIGHT_WEIGHT_PAIRED, VITAL_LIMITS, VitalsSerializer
+
+INGEST_BATCH_SIZE = 5000
+INTEGER_METRICS = {metric for metric in Vital.METRICS
+                   if isinstance(Vital._meta.get_field(metric), models.IntegerField)}
+_INVALID_JSON = object()
+PLAIN_INT_LIMIT = 2 ** 31 - 1  # ints up to the column's range need no parsing
+
+
+def _decode(item):
+    # NDJSON lines arrive as text, JSON arrays as already-parsed values
+    if not isinstance(item, str):
+        return item
+    try:
+        return json.loads(item)
+    except ValueError:
+        return _INVALID_JSON
+
+
+@functools.cache
+def _metric_fields():
+    fields = VitalsSerializer().fields
+    return {metric: fields[metric] for metric in VITAL_LIMITS}
+
+
+def _is_plain(value, integer):
+    # A JSON number needing no parsing; bigger ints get the field's max_value check
+    kind = type(value)
+    return (kind is int and -PLAIN_INT_LIMIT <= value <= PLAIN_INT_LIMIT) or (kind is float and not integer)
+
+
+def _parse_column(values, integer, field):
+    """
+    Parse one metric's values. Returns (present, column, invalid): whether
+    each value was given, the parsed values as float64 and the field's
+    error message for each value it rejected.
+    """
+    plain = np.array([_is_plain(value, integer) for value in values], dtype=bool)
+    present = np.array([value is not None for value in values], dtype=bool)
+    column = np.array([value if is_plain else np.nan for value, is_plain in zip(values, plain.tolist())],
+                      dtype=np.float64)
+    invalid = {}
+    # Strings, bools and 72.0 for an integer: parse them as VitalsSerializer would
+    for i in np.flatnonzero(present & ~plain).tolist():
+        try:
+            column[i] = field.run_validation(values[i])
+        except serializers.ValidationError as exc:
+            invalid[i] = str(exc.detail[0])
+    return present, column, invalid
+
+
+def validate_batch(rows):
+    """
+    Validate decoded rows column by column. Returns (readings, errors):
+    field dicts for the valid rows, and {row index: {field: [messages]}}.
+    """
+    errors = {}
+
+    def fail(indexes, field, message):
+        for index in indexes:
+            errors.setdefault(index, {}).setdefault(field, []).append(message)
+
+    fail([i for i, row in enumerate(rows) if row is _INVALID_JSON], "non_field_errors", "Invalid JSON.")
+    fail([i for i, row in enumerate(rows) if row is not _INVALID_JSON and not isinstance(row, dict)],
+         "non_field_errors", "Expected an object.")
+    rows = [row if isinstance(row, dict) else {} for row in rows]
+
+    columns = {}
+    fields = _metric_fields()
+    for metric, (low, high, low_allowed, message) in VITAL_LIMITS.items():
+        present, column, invalid = _parse_column([row.get(metric) for row in rows], metric in INTEGER_METRICS,
+                                                 fields[metric])
+        for index, error in invalid.items():
+            fail([index], metric, error)
+        valid = present.copy()
+        valid[list(invalid)] = False
+        # NaN compares false, so it is out of range as in VitalsSerializer
+        in_range = (column >= low if low_allowed else column > low) & (column <= high)
+        fail(np.flatnonzero(valid & ~in_range).tolist(), metric, message)
+        columns[metric] = (valid, column)
+
+    # VitalsSerializer only checks the pairing once every field is valid
+    checked = np.ones(len(rows), dtype=bool)
+    checked[list(errors)] = False
+    (height_given, heights), (weight_given, weights) = columns["height_cm"], columns["weight_kg"]
+    unpaired = (height_given & (heights != 0)) != (weight_given & (weights != 0))
+    fail(np.flatnonzero(checked & unpaired).tolist(), "non_field_errors", HEIGHT_WEIGHT_PAIRED)
+
+    now = timezone.now()
+    times = []
+    for i, row in enumerate(rows):
+        value = row.get("recorded_at")
+        if value is None:
+            instant = now
+        else:
+            instant = parse_instant(value) if isinstance(value, str) else None
+        if instant is None:
+            fail([i], "recorded_at", "Use an ISO 8601 datetime.")
+        times.append(instant)
+
+    keep = [i for i in range(len(rows)) if i not in errors]
+    parsed = {}
+    for metric, (given, column) in columns.items():
+        cast = int if metric in INTEGER_METRICS else float
+        parsed[metric] = [cast(value) if is_given else None
+                          for value, is_given in zip(column[keep].tolist(), given[keep].tolist())]
+    readings = [{"recorded_at": times[i], **{metric: parsed[metric][n] for metric in parsed}}
+                for n, i in enumerate(keep)]
+    return readings, errors
+
+
+def ingest(patient_id, items, batch_size=None):
+    """
+    Insert every valid reading in `items` (dicts or NDJSON lines) for the
+    patient in one transaction. Returns (created, [{"row": n, "errors": {...}}]).
+    """
+    batch_size = batch_size or INGEST_BATCH_SIZE
+    created, errors = 0, []
+    items = iter(items)
+    offset = 0
+    with transaction.atomic():
+        while batch := list(islice(items, batch_size)):
+            readings, batch_errors = validate_batch([_decode(item) for item in batch])
+            vitals = Vital.objects.bulk_create([Vital(patient_id=patient_id, **reading) for reading in readings])
+            add_readings(vitals)
+            created += len(vitals)
+            errors += [{"row": offset + index, "errors": batch_errors[index]} for index in sorted(batch_errors)]
+            offset += len(batch)
+    return created, errors
@@ -0,0 +1,21 @@
+# patients/jobs.py
+from django.utils.dateparse import parse_datetime
+from jobs.registry import register
+from .archive import archive_old_vitals, retention_cutoff
+
+
+@register("archive_vitals")
+def archive_vitals(job):
+    """
+    Move readings older than the retention window (params["days"], default
+    VITALS_RETENTION_DAYS) into the vitals archive. The cutoff is fixed on
+    the first run and the checkpoint records the last patient archived, so a
+    rerun carries on from the next one.
+    """
+    if "before" not in job.checkpoint:
+        job.save_checkpoint(before=retention_cutoff(job.params.get("days")).isoformat(), last_patient=0)
+
+    def archived(patient_id, readings):
+        job.save_checkpoint(progress=job.progress + readings, last_patient=patient_id)
+
+    archive_old_vitals(parse_datetime(job.checkpoint["before"]), job.checkpoint["last_patient"], archived)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from jobs.models import Job
+from patients.archive import archive_old_vitals, retention_cutoff
+
+
+class Command(BaseCommand):
+    help = ("Pack vitals older than the retention window into the columnar archive and delete the raw rows "
+            "(run it daily, e.g. from cron)")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, help="Retention window in days (default VITALS_RETENTION_DAYS)")
+        parser.add_argument("--queue", action="store_true",
+                            help="Queue an archive_vitals job for `manage.py run_jobs` instead of running here")
+
+    def handle(self, *args, **options):
+        params = {"days": options["days"]} if options["days"] is not None else {}
+        if options["queue"]:
+            job = Job.enqueue("archive_vitals", **params)
+            self.stdout.write(f"Queued job {job.pk}")
+            return
+        before = retention_cutoff(options["days"])
+        total = archive_old_vitals(before)
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} reading(s) recorded before {before:%Y-%m-%d}"))
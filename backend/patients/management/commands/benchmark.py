@@ -0,0 +1,56 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from utils.benchmarks import BENCHMARKS, find_regressions, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Run the crypto/serialization benchmark suite and write the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("names", nargs="*", help=f"Benchmarks to run (default: all). Available: {', '.join(BENCHMARKS)}")
+        parser.add_argument("--output", help="Write results to this JSON file")
+        parser.add_argument("--compare", help="Baseline JSON from an earlier run; fail on regressions")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="Allowed slowdown vs the baseline before failing (default 0.2 = 20%%)")
+        parser.add_argument("--rows", type=int, help="Override the row/operation count of every benchmark")
+        parser.add_argument("--payload-size", type=int, help="Override the plaintext size in bytes")
+        parser.add_argument("--rounds", type=int, default=3)
+        parser.add_argument("--use-current-db", action="store_true",
+                            help="Run against the configured database instead of a throwaway test database")
+
+    def handle(self, *args, **options):
+        unknown = set(options["names"]) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+        overrides = {"rounds": options["rounds"]}
+        if options["rows"]:
+            overrides["n"] = options["rows"]
+        if options["payload_size"]:
+            overrides["payload_size"] = options["payload_size"]
+
+        if options["use_current_db"]:
+            report = run_benchmarks(options["names"] or None, **overrides)
+        else:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                report = run_benchmarks(options["names"] or None, **overrides)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+            regressions = find_regressions(baseline.get("results", {}), report["results"], options["tolerance"])
+            for regression in regressions:
+                self.stderr.write(f"Regression in {regression['benchmark']}: "
+                                  f"{regression['before']} -> {regression['after']} us/op ({regression['change']})")
+            if regressions:
+                raise CommandError(f"{len(regressions)} benchmark(s) regressed beyond {options['tolerance']:.0%}")
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from utils.index_advisor import advise, sample, seed
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the queries behind typical API requests and report full table scans"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=200, help="Patients to seed the throwaway database with")
+        parser.add_argument("--use-current-db", action="store_true",
+                            help="Run against the configured database instead of a seeded test database")
+        parser.add_argument("--fail-on-scan", action="store_true", help="Exit non-zero when any full scan is found")
+
+    def handle(self, *args, **options):
+        if options["use_current_db"]:
+            results = self.advise()
+        else:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                seed(options["rows"])
+                results = self.advise()
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        scans = 0
+        for result in results:
+            status = "SCAN" if result["scans"] else "ok"
+            self.stdout.write(f"{status:4} {result['role']:7} GET {result['path']} -> {result['status']}, "
+                              f"{result['queries']} queries")
+            for table, sql in result["scans"]:
+                self.stdout.write(f"       full scan of {table}: {sql[:300]}")
+            if options["verbosity"] > 1:
+                for sql, rows in result["plans"]:
+                    self.stdout.write(f"     {sql[:300]}")
+                    self.stdout.write("\n".join(f"       {row}" for row in rows))
+            scans += len(result["scans"])
+
+        if scans and options["fail_on_scan"]:
+            raise CommandError(f"{scans} full table scan(s) on the request paths above")
+
+    def advise(self):
+        context = sample()
+        if context is None:
+            raise CommandError("Need an approved access request to sample a doctor and patient from")
+        return advise(*context)
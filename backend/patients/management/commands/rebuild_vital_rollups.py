@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from patients.rollups import rebuild_all
+
+
+class Command(BaseCommand):
+    help = "Recompute every hourly and daily vitals rollup from the raw readings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        total = rebuild_all(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {total} reading(s)"))
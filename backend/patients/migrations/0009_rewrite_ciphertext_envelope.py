@@ -0,0 +1,75 @@
+# Rewrites encrypted columns from the bare nonce + tag + ciphertext layout to
+# the versioned envelope (see utils/encryption.py). The crypto is frozen here
+# so later changes to AESCipher can't alter what this migration writes.
+
+import base64
+import os
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.db import migrations
+
+ENVELOPE_HEADER = b"\xa7\xe5\x01\x01"  # magic, format v1, key version 1
+ENVELOPE_PREFIX = base64.b64encode(ENVELOPE_HEADER[:3]).decode()
+NONCE_SIZE = 12
+TAG_SIZE = 16
+BATCH_SIZE = 500
+
+
+def _to_envelope(aead, value):
+    try:
+        raw = base64.b64decode(value, validate=True)
+        nonce, tag, ciphertext = raw[:NONCE_SIZE], raw[NONCE_SIZE:NONCE_SIZE + TAG_SIZE], raw[NONCE_SIZE + TAG_SIZE:]
+        plaintext = aead.decrypt(nonce, ciphertext + tag, None)
+    except Exception:
+        # The old is_base64/b64decode heuristics let some plaintext through unencrypted
+        plaintext = value.encode("utf-8")
+    nonce = os.urandom(NONCE_SIZE)
+    sealed = aead.encrypt(nonce, plaintext, ENVELOPE_HEADER)
+    return base64.b64encode(ENVELOPE_HEADER + nonce + sealed[-TAG_SIZE:] + sealed[:-TAG_SIZE]).decode()
+
+
+def rewrite_model(model, fields, owner_path):
+    fernet = Fernet(settings.MASTER_KEY.encode())
+    ciphers = {}
+    pending = []
+    for obj in model.objects.select_related(owner_path.replace(".", "__")).iterator(chunk_size=BATCH_SIZE):
+        owner = obj
+        for attr in owner_path.split("."):
+            owner = getattr(owner, attr, None)
+        if owner is None or not owner.user_key:
+            continue
+        if owner.pk not in ciphers:
+            ciphers[owner.pk] = AESGCM(base64.b64decode(fernet.decrypt(owner.user_key.encode())))
+        changed = False
+        for field in fields:
+            value = getattr(obj, field)
+            if value and not value.startswith(ENVELOPE_PREFIX):
+                setattr(obj, field, _to_envelope(ciphers[owner.pk], value))
+                changed = True
+        if changed:
+            pending.append(obj)
+        if len(pending) >= BATCH_SIZE:
+            model.objects.bulk_update(pending, fields)
+            pending = []
+    if pending:
+        model.objects.bulk_update(pending, fields)
+
+
+def forwards(apps, schema_editor):
+    rewrite_model(apps.get_model("patients", "Patient"), ["contact_number", "aadhar_number"], "user")
+    rewrite_model(apps.get_model("patients", "MedicalHistory"),
+                  ["type_of", "description", "diagnosis_code", "status", "notes"], "patient.user")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0008_alter_medicalhistory_diagnosis_code_and_more'),
+        ('users', '0008_rename_expires_at_customuser_otp_expires_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
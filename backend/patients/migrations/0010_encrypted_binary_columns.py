@@ -0,0 +1,99 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:25
+#
+# Moves the encrypted columns from text to binary. Most rows hold base64
+# envelope text (0011 turns those into raw bytes), but 0009 skipped owners
+# without a key, so some still hold plaintext. An in-place AlterField
+# relies on PostgreSQL's implicit `USING col::bytea`, which reads
+# backslashes in that plaintext as escapes and fails or mangles the value.
+# Each column is instead copied into a new binary column with
+# value.encode(), and the new column then replaces the old one.
+
+import base64
+
+import utils.fields
+from django.db import migrations, models
+
+ENVELOPE_MAGIC = b"\xa7\xe5"
+BATCH_SIZE = 1000
+
+
+def to_bytes(value):
+    return value.encode("utf-8")
+
+
+def to_text(value):
+    # Envelopes made raw by 0011 go back to the base64 text 0009 wrote
+    value = bytes(value)
+    return base64.b64encode(value).decode() if value.startswith(ENVELOPE_MAGIC) else value.decode("utf-8")
+
+
+def copy_column(model, source, target, convert):
+    last_pk = 0
+    while rows := list(model.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", source)[:BATCH_SIZE]):
+        model.objects.bulk_update(
+            [model(pk=pk, **{target: None if value is None else convert(value)}) for pk, value in rows], [target])
+        last_pk = rows[-1][0]
+
+
+def binary_column(app_label, model_name, name, field, relaxed=None):
+    """
+    Operations replacing text column `name` with the binary `field`, copying
+    every value across. A NOT NULL or unique text column also needs
+    `relaxed`, the same column without those constraints, so that on
+    reversal it can be re-added empty and only constrained once the values
+    are copied back.
+    """
+    temp = f"{name}_binary"
+
+    def forwards(apps, schema_editor):
+        copy_column(apps.get_model(app_label, model_name), name, temp, to_bytes)
+
+    def backwards(apps, schema_editor):
+        copy_column(apps.get_model(app_label, model_name), temp, name, to_text)
+
+    return [
+        migrations.AddField(
+            model_name=model_name,
+            name=temp,
+            field=utils.fields.EncryptedBinaryField(blank=True, null=True),
+        ),
+        *([migrations.AlterField(model_name=model_name, name=name, field=relaxed)] if relaxed else []),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(
+            model_name=model_name,
+            name=name,
+        ),
+        migrations.RenameField(
+            model_name=model_name,
+            old_name=temp,
+            new_name=name,
+        ),
+        migrations.AlterField(
+            model_name=model_name,
+            name=name,
+            field=field,
+        ),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0009_rewrite_ciphertext_envelope'),
+    ]
+
+    operations = [
+        *binary_column('patients', 'medicalhistory', 'description', utils.fields.EncryptedBinaryField(),
+                       relaxed=models.TextField(null=True)),
+        *binary_column('patients', 'medicalhistory', 'diagnosis_code',
+                       utils.fields.EncryptedBinaryField(blank=True, null=True)),
+        *binary_column('patients', 'medicalhistory', 'notes', utils.fields.EncryptedBinaryField(blank=True, null=True)),
+        *binary_column('patients', 'medicalhistory', 'status', utils.fields.EncryptedBinaryField(),
+                       relaxed=models.CharField(max_length=256, null=True)),
+        *binary_column('patients', 'medicalhistory', 'type_of', utils.fields.EncryptedBinaryField(),
+                       relaxed=models.CharField(max_length=256, null=True)),
+        *binary_column('patients', 'patient', 'aadhar_number', utils.fields.EncryptedBinaryField(unique=True),
+                       relaxed=models.CharField(max_length=512, null=True)),
+        *binary_column('patients', 'patient', 'contact_number',
+                       utils.fields.EncryptedBinaryField(blank=True, null=True)),
+    ]
@@ -0,0 +1,67 @@
+# Converts envelopes still stored as base64 text into raw bytes.
+# Runs non-atomically in committed batches; rows already converted are
+# skipped, so re-running after an interruption resumes where it stopped.
+
+import base64
+
+from django.db import connection, migrations, transaction
+
+LEGACY_PREFIX = b"p+UB"  # base64 of the envelope magic + format version
+BATCH_SIZE = 1000
+
+
+def _legacy_bytes(value):
+    if isinstance(value, memoryview):
+        value = bytes(value)
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if value and value.startswith(LEGACY_PREFIX):
+        return value
+    return None
+
+
+def convert_table(model, fields):
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(model._meta.get_field(f).column) for f in fields)
+    last_pk = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, {columns} FROM {table} WHERE id > %s ORDER BY id LIMIT %s",
+                [last_pk, BATCH_SIZE],
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            break
+        # Rows grouped by which of their columns still hold text, one bulk_update per group
+        groups = {}
+        for pk, *values in rows:
+            updates = {}
+            for field, value in zip(fields, values):
+                legacy = _legacy_bytes(value)
+                if legacy is not None:
+                    updates[field] = base64.b64decode(legacy)
+            if updates:
+                groups.setdefault(tuple(updates), []).append(model(pk=pk, **updates))
+        with transaction.atomic():
+            for changed, objs in groups.items():
+                model.objects.bulk_update(objs, changed)
+        last_pk = rows[-1][0]
+
+
+def forwards(apps, schema_editor):
+    convert_table(apps.get_model("patients", "Patient"), ["contact_number", "aadhar_number"])
+    convert_table(apps.get_model("patients", "MedicalHistory"),
+                  ["type_of", "description", "diagnosis_code", "status", "notes"])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('patients', '0010_encrypted_binary_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
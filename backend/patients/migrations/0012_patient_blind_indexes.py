@@ -0,0 +1,121 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:26
+# Adds HMAC blind indexes for Patient contact and Aadhar numbers and fills
+# them for existing rows. Key unwrapping, decryption and the index itself are
+# frozen here so later changes to utils.encryption can't alter what this
+# migration computes.
+
+import base64
+import hashlib
+import hmac
+import logging
+import re
+import zlib
+
+import utils.fields
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.db import migrations, models
+
+try:
+    import zstandard
+except ImportError:  # optional; only values sealed with FLAG_ZSTD need it
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ENVELOPE_MAGIC = b"\xa7\xe5"
+# Format version -> header size: magic, version, key version, and from v2 a flags byte
+HEADER_SIZES = {1: 4, 2: 5}
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+def _master_fernet():
+    # Every configured master key can unwrap, so this still runs after a master key rotation
+    keys = getattr(settings, "MASTER_KEYS", None) or [settings.MASTER_KEY]
+    return MultiFernet([Fernet(key.encode()) for key in keys])
+
+
+def _decrypt(aead, value):
+    # Plaintext of a binary v1 or v2 envelope, or None when it can't be read
+    value = bytes(value) if value else b""
+    if not value.startswith(ENVELOPE_MAGIC) or len(value) < 3 or value[2] not in HEADER_SIZES:
+        return None
+    size = HEADER_SIZES[value[2]]
+    header, body = value[:size], value[size:]
+    flags = header[4] if size > 4 else 0
+    nonce, tag, ciphertext = body[:NONCE_SIZE], body[NONCE_SIZE:NONCE_SIZE + TAG_SIZE], body[NONCE_SIZE + TAG_SIZE:]
+    try:
+        data = aead.decrypt(nonce, ciphertext + tag, header)
+        # Decompress only after the tag has been verified
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(data)
+        elif flags & FLAG_ZSTD:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return data.decode("utf-8")
+    except Exception:
+        return None
+
+
+def _blind_index(key, field, value):
+    if not value:
+        return None
+    normalized = re.sub(r"[\s-]", "", value).lower()
+    return hmac.new(key, f"{field}:{normalized}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def populate_blind_indexes(apps, schema_editor):
+    # Index existing rows; a duplicate Aadhar keeps only its first row indexed
+    Patient = apps.get_model("patients", "Patient")
+    fernet = _master_fernet()
+    secret = getattr(settings, "BLIND_INDEX_KEY", None) or settings.MASTER_KEY
+    index_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"blind-index").derive(secret.encode())
+    seen_aadhar = set()
+    duplicates = []
+    for patient in Patient.objects.select_related("user").order_by("id").iterator(chunk_size=500):
+        if patient.user is None or not patient.user.user_key:
+            continue
+        aead = AESGCM(base64.b64decode(fernet.decrypt(patient.user.user_key.encode())))
+        patient.contact_number_index = _blind_index(index_key, "contact_number", _decrypt(aead, patient.contact_number))
+        aadhar_index = _blind_index(index_key, "aadhar_number", _decrypt(aead, patient.aadhar_number))
+        if aadhar_index in seen_aadhar:
+            duplicates.append(patient.pk)
+            aadhar_index = None
+        elif aadhar_index:
+            seen_aadhar.add(aadhar_index)
+        patient.aadhar_number_index = aadhar_index
+        patient.save(update_fields=["contact_number_index", "aadhar_number_index"])
+    if duplicates:
+        logger.warning("Duplicate Aadhar numbers left unindexed on patients %s",
+                       ", ".join(map(str, duplicates)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0011_convert_ciphertext_to_binary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='aadhar_number_index',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='contact_number_index',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='aadhar_number',
+            field=utils.fields.EncryptedBinaryField(),
+        ),
+        migrations.RunPython(populate_blind_indexes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,130 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:34
+# Creates SearchToken and builds the keyword index for existing
+# MedicalHistory rows (doctors.0012 reuses index_model for its models). Key
+# unwrapping, decryption, tokenizing and the token HMAC are frozen here so
+# later changes to utils.encryption can't alter what this migration writes.
+
+import base64
+import hashlib
+import hmac
+import re
+import zlib
+
+import django.db.models.deletion
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.db import migrations, models
+
+try:
+    import zstandard
+except ImportError:  # optional; only values sealed with FLAG_ZSTD need it
+    zstandard = None
+
+BATCH_SIZE = 500
+ENVELOPE_MAGIC = b"\xa7\xe5"
+# Format version -> header size: magic, version, key version, and from v2 a flags byte
+HEADER_SIZES = {1: 4, 2: 5}
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+NONCE_SIZE = 12
+TAG_SIZE = 16
+KEYWORD_PATTERN = re.compile(r"[0-9a-z]+")
+MIN_KEYWORD_LENGTH = 2
+
+
+def _master_fernet():
+    # Every configured master key can unwrap, so this still runs after a master key rotation
+    keys = getattr(settings, "MASTER_KEYS", None) or [settings.MASTER_KEY]
+    return MultiFernet([Fernet(key.encode()) for key in keys])
+
+
+def _decrypt(aead, value):
+    # Plaintext of a binary v1 or v2 envelope, or None when it can't be read
+    value = bytes(value) if value else b""
+    if not value.startswith(ENVELOPE_MAGIC) or len(value) < 3 or value[2] not in HEADER_SIZES:
+        return None
+    size = HEADER_SIZES[value[2]]
+    header, body = value[:size], value[size:]
+    flags = header[4] if size > 4 else 0
+    nonce, tag, ciphertext = body[:NONCE_SIZE], body[NONCE_SIZE:NONCE_SIZE + TAG_SIZE], body[NONCE_SIZE + TAG_SIZE:]
+    try:
+        data = aead.decrypt(nonce, ciphertext + tag, header)
+        # Decompress only after the tag has been verified
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(data)
+        elif flags & FLAG_ZSTD:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return data.decode("utf-8")
+    except Exception:
+        return None
+
+
+def _tokens(user_key, text):
+    # Keyed HMAC of every whole word, under a key derived from the owner's AES key
+    words = {word for word in KEYWORD_PATTERN.findall(text.lower()) if len(word) >= MIN_KEYWORD_LENGTH}
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"search-index").derive(user_key)
+    return {hmac.new(key, word.encode("utf-8"), hashlib.sha256).hexdigest() for word in words}
+
+
+def index_model(apps, model, fields, owner_path):
+    # Build keyword tokens for existing rows of `model`
+    if not model.objects.exists():
+        return
+    ContentType = apps.get_model("contenttypes", "ContentType")
+    SearchToken = apps.get_model("patients", "SearchToken")
+    content_type, _ = ContentType.objects.get_or_create(app_label=model._meta.app_label,
+                                                        model=model._meta.model_name)
+    fernet = _master_fernet()
+    keys = {}
+    pending = []
+    for obj in model.objects.select_related(owner_path.replace(".", "__")).iterator(chunk_size=BATCH_SIZE):
+        owner = obj
+        for attr in owner_path.split("."):
+            owner = getattr(owner, attr, None)
+        if owner is None or not owner.user_key:
+            continue
+        if owner.pk not in keys:
+            key = base64.b64decode(fernet.decrypt(owner.user_key.encode()))
+            keys[owner.pk] = (key, AESGCM(key))
+        key, aead = keys[owner.pk]
+        text = " ".join(value for value in (_decrypt(aead, getattr(obj, f)) for f in fields) if value)
+        pending += [SearchToken(user_id=owner.pk, content_type=content_type, object_id=obj.pk, token=token)
+                    for token in _tokens(key, text)]
+        if len(pending) >= BATCH_SIZE:
+            SearchToken.objects.bulk_create(pending)
+            pending = []
+    SearchToken.objects.bulk_create(pending)
+
+
+def forwards(apps, schema_editor):
+    index_model(apps, apps.get_model("patients", "MedicalHistory"),
+                ["description", "diagnosis_code", "notes"], "patient.user")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('patients', '0012_patient_blind_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('token', models.CharField(max_length=64)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['content_type', 'token'], name='patients_se_content_6fb974_idx'), models.Index(fields=['content_type', 'object_id'], name='patients_se_content_4e6325_idx')],
+            },
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
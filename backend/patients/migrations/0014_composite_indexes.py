@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0013_search_tokens'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='medicalhistory',
+            index=models.Index(fields=['patient', 'event_date'], name='patients_me_patient_96a229_idx'),
+        ),
+    ]
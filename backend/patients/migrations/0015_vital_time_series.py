@@ -0,0 +1,62 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:05
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0014_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VitalRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('height_cm_count', models.PositiveIntegerField(default=0)),
+                ('height_cm_sum', models.FloatField(default=0)),
+                ('height_cm_min', models.FloatField(blank=True, null=True)),
+                ('height_cm_max', models.FloatField(blank=True, null=True)),
+                ('weight_kg_count', models.PositiveIntegerField(default=0)),
+                ('weight_kg_sum', models.FloatField(default=0)),
+                ('weight_kg_min', models.FloatField(blank=True, null=True)),
+                ('weight_kg_max', models.FloatField(blank=True, null=True)),
+                ('blood_pressure_count', models.PositiveIntegerField(default=0)),
+                ('blood_pressure_sum', models.FloatField(default=0)),
+                ('blood_pressure_min', models.FloatField(blank=True, null=True)),
+                ('blood_pressure_max', models.FloatField(blank=True, null=True)),
+                ('heart_rate_bpm_count', models.PositiveIntegerField(default=0)),
+                ('heart_rate_bpm_sum', models.FloatField(default=0)),
+                ('heart_rate_bpm_min', models.FloatField(blank=True, null=True)),
+                ('heart_rate_bpm_max', models.FloatField(blank=True, null=True)),
+                ('temperature_celsius_count', models.PositiveIntegerField(default=0)),
+                ('temperature_celsius_sum', models.FloatField(default=0)),
+                ('temperature_celsius_min', models.FloatField(blank=True, null=True)),
+                ('temperature_celsius_max', models.FloatField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='vital',
+            name='recorded_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='vital',
+            index=models.Index(fields=['patient', 'recorded_at'], name='patients_vi_patient_542ac9_idx'),
+        ),
+        migrations.AddField(
+            model_name='vitalrollup',
+            name='patient',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vital_rollups', to='patients.patient'),
+        ),
+        migrations.AddConstraint(
+            model_name='vitalrollup',
+            constraint=models.UniqueConstraint(fields=('patient', 'period', 'start'), name='unique_vital_rollup_bucket'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0015_vital_time_series'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VitalArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateTimeField()),
+                ('first_recorded_at', models.DateTimeField()),
+                ('last_recorded_at', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vital_archives', to='patients.patient')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('patient', 'month'), name='unique_vital_archive_month')],
+            },
+        ),
+    ]
@@ -1,66 +1,44 @@
 from django.db import models
 from django.conf import settings
-from utils.encryption import AESCipher, is_base64
-import base64
-
-class Patient(models.Model):
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from utils.encryption import blind_index
+from utils.fields import EncryptedBinaryField
+from utils.models import EncryptedModelMixin, EncryptedQuerySet
+
+class Patient(EncryptedModelMixin, models.Model):
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     date_of_birth = models.DateField()
     GENDER_CHOICES = [("male","Male"), ("female","Female"), ("Other","Other")]
     gender = models.CharField(max_length=20, choices=GENDER_CHOICES)
-    contact_number = models.CharField(max_length=512, null=True, blank=True)  # store encrypted text
+    contact_number = EncryptedBinaryField(null=True, blank=True)  # store encrypted bytes
     address = models.TextField(null=True, blank=True)
-    aadhar_number = models.CharField(max_length=512, unique=True)  # store encrypted text
+    aadhar_number = EncryptedBinaryField()  # store encrypted bytes
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
                                 related_name="patient_profile", null=True, blank=True)
+    # HMAC blind indexes of the plaintext for equality search and uniqueness
+    contact_number_index = models.CharField(max_length=64, null=True, blank=True, db_index=True, editable=False)
+    aadhar_number_index = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False)
+
+    objects = EncryptedQuerySet.as_manager()
 
-    def _get_user_key_bytes(self) -> bytes:
-        """
-        Return bytes key for AES. Ensure your `get_user_key()` returns appropriate bytes.
-        If it returns hex or str, adapt accordingly.
-        """
-        # Example: assume user.get_user_key() returns a bytes object of correct length.
-        if self.user and hasattr(self.user, "get_user_key"):
-            return self.user.get_user_key()
-        return None
+    ENCRYPTED_FIELDS = ['contact_number', 'aadhar_number']
+    KEY_OWNER = 'user'
+    BLIND_INDEX_FIELDS = {'contact_number': 'contact_number_index', 'aadhar_number': 'aadhar_number_index'}
 
     def save(self, *args, **kwargs):
-        key = self._get_user_key_bytes()
-        # If we have a key and contact_number is plain (not base64-like), encrypt it.
-        # We try to avoid double-encrypting by detecting base64-looking strings:
-        if key:
-            cipher = AESCipher(key)
-            # encrypt contact_number if it's not already an encrypted blob (heuristic)
-            if self.contact_number:
-                try:
-                    # If it decodes as base64 and has expected structure, assume encrypted -> skip
-                    base64.b64decode(self.contact_number)
-                    # We won't attempt decrypt here; assume it's already encrypted.
-                    # If you want stricter checks, try decrypting here and on failure re-encrypt.
-                except Exception:
-                    # not base64 -> encrypt
-                    self.contact_number = cipher.encrypt(self.contact_number)
-            if self.aadhar_number:
-                try:
-                    base64.b64decode(self.aadhar_number)
-                except Exception:
-                    self.aadhar_number = cipher.encrypt(self.aadhar_number)
-        # else: no user key available; you may choose to deny save or store plaintext (not recommended)
+        # Refresh blind indexes when plaintext was assigned. Values loaded from the database are bytes
+        # (envelopes, or plaintext of a patient without a key) and keep the index they have.
+        for field, index_field in self.BLIND_INDEX_FIELDS.items():
+            val = getattr(self, field, None)
+            if not val:
+                setattr(self, index_field, None)
+            elif isinstance(val, str):
+                setattr(self, index_field, blind_index(field, val))
         super().save(*args, **kwargs)
 
-    # decrypted properties (never modify DB)
-    def _decrypt_field(self, encrypted_value):
-        key = self._get_user_key_bytes()
-        if not encrypted_value or not key:
-            return None
-        cipher = AESCipher(key)
-        try:
-            return cipher.decrypt(encrypted_value)
-        except Exception:
-            # MAC check failed or corrupted value
-            return "[Decryption Error]"
-
     @property
     def contact_number_decrypted(self):
         return self._decrypt_field(self.contact_number)
@@ -73,67 +51,135 @@ class Patient(models.Model):
         return f"{self.first_name} {self.last_name}"
 
 
+class SearchToken(models.Model):
+    """
+    Keyed keyword index over encrypted free text (see utils.encryption.search_tokens).
+    One row per distinct word per record; rows go away with their record
+    through the owning model's GenericRelation.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="search_tokens")
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveBigIntegerField()
+    record = GenericForeignKey("content_type", "object_id")
+    token = models.CharField(max_length=64)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["content_type", "token"]),
+            models.Index(fields=["content_type", "object_id"]),
+        ]
+
+    def __str__(self):
+        return f"Search token for {self.content_type} {self.object_id}"
+
+
 class Vital(models.Model):
+    """
+    One reading in a patient's vitals time series; any metric may be absent.
+    Every insert is folded into the hourly and daily VitalRollup rows.
+    """
+    METRICS = ["height_cm", "weight_kg", "blood_pressure", "heart_rate_bpm", "temperature_celsius"]
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="vitals")
-    recorded_at = models.DateTimeField(auto_now_add=True)
+    recorded_at = models.DateTimeField(default=timezone.now)
     height_cm = models.FloatField(null=True, blank=True)
     weight_kg = models.FloatField(null=True, blank=True)
     blood_pressure = models.IntegerField(null=True, blank=True)
     heart_rate_bpm = models.IntegerField(null=True, blank=True)
     temperature_celsius = models.FloatField(null=True, blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["patient", "recorded_at"])]
+
     def __str__(self):
         return f"Vitals for {self.patient}"
 
 
-class MedicalHistory(models.Model):
+class VitalRollup(models.Model):
+    """
+    Per-metric count/sum/min/max of a patient's readings over one hour or
+    day bucket starting at `start`, kept current by patients/rollups.py so
+    long-range charts read one row per bucket instead of every reading.
+    """
+    PERIOD_CHOICES = [("hour", "Hour"), ("day", "Day")]
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="vital_rollups")
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+    height_cm_count = models.PositiveIntegerField(default=0)
+    height_cm_sum = models.FloatField(default=0)
+    height_cm_min = models.FloatField(null=True, blank=True)
+    height_cm_max = models.FloatField(null=True, blank=True)
+    weight_kg_count = models.PositiveIntegerField(default=0)
+    weight_kg_sum = models.FloatField(default=0)
+    weight_kg_min = models.FloatField(null=True, blank=True)
+    weight_kg_max = models.FloatField(null=True, blank=True)
+    blood_pressure_count = models.PositiveIntegerField(default=0)
+    blood_pressure_sum = models.FloatField(default=0)
+    blood_pressure_min = models.FloatField(null=True, blank=True)
+    blood_pressure_max = models.FloatField(null=True, blank=True)
+    heart_rate_bpm_count = models.PositiveIntegerField(default=0)
+    heart_rate_bpm_sum = models.FloatField(default=0)
+    heart_rate_bpm_min = models.FloatField(null=True, blank=True)
+    heart_rate_bpm_max = models.FloatField(null=True, blank=True)
+    temperature_celsius_count = models.PositiveIntegerField(default=0)
+    temperature_celsius_sum = models.FloatField(default=0)
+    temperature_celsius_min = models.FloatField(null=True, blank=True)
+    temperature_celsius_max = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["patient", "period", "start"], name="unique_vital_rollup_bucket")]
+
+    def __str__(self):
+        return f"{self.period} vitals of {self.patient_id} from {self.start}"
+
+
+class VitalArchive(models.Model):
+    """
+    Cold tier: one patient's readings of one calendar month, packed into
+    compressed columns by patients/archive.py once they fall outside
+    VITALS_RETENTION_DAYS. The raw Vital rows are deleted at that point.
+    """
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="vital_archives")
+    month = models.DateTimeField()
+    first_recorded_at = models.DateTimeField()
+    last_recorded_at = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["patient", "month"], name="unique_vital_archive_month")]
+
+    def __str__(self):
+        return f"{self.count} archived vitals of {self.patient_id} from {self.month:%Y-%m}"
+
+
+class MedicalHistory(EncryptedModelMixin, models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="medical_histories")
     TYPE_OF_CHOICES = [("disease","Disease"), ("surgery","Surgery"), ("allergy","Allergy"), ("Other","Other")]
-    type_of = models.CharField(max_length=256, choices=TYPE_OF_CHOICES)
-    description = models.TextField()
-    diagnosis_code = models.CharField(max_length=256, null=True, blank=True)
+    type_of = EncryptedBinaryField()
+    description = EncryptedBinaryField()
+    diagnosis_code = EncryptedBinaryField(null=True, blank=True)
     event_date = models.DateField()
     STATUS_CHOICES = [("active","Active"), ("resolved","Resolved"), ("chronic","Chronic")]
-    status = models.CharField(max_length=256, choices=STATUS_CHOICES)
-    notes = models.TextField(null=True, blank=True)
+    status = EncryptedBinaryField()
+    notes = EncryptedBinaryField(null=True, blank=True)
+
+    search_tokens = GenericRelation("patients.SearchToken")
+
+    objects = EncryptedQuerySet.as_manager()
+
+    ENCRYPTED_FIELDS = ['type_of', 'description', 'diagnosis_code', 'status', 'notes']
+    KEY_OWNER = 'patient__user'
+    SEARCH_FIELDS = ['description', 'diagnosis_code', 'notes']
+
+    class Meta:
+        indexes = [models.Index(fields=["patient", "event_date"])]
 
     @property
     def user(self):
         # Shortcut to access user from patient
         return getattr(self.patient, "user", None)
 
-    def _get_user_key_bytes(self) -> bytes:
-        """
-        Return bytes key for AES. Ensure your `get_user_key()` returns appropriate bytes.
-        If it returns hex or str, adapt accordingly.
-        """
-        # Example: assume user.get_user_key() returns a bytes object of correct length.
-        if self.user and hasattr(self.user, "get_user_key"):
-            return self.user.get_user_key()
-        return None
-    
-    def save(self, *args, **kwargs):
-        key = self._get_user_key_bytes()
-        if key:
-            cipher = AESCipher(key)
-            for field in ['type_of', 'description', 'diagnosis_code', 'status', 'notes']:
-                val = getattr(self, field, None)
-                if val and not is_base64(val):
-                    setattr(self, field, cipher.encrypt(val))
-        super().save(*args, **kwargs)
-
-    # decrypted properties (never modify DB)
-    def _decrypt_field(self, encrypted_value):
-        key = self._get_user_key_bytes()
-        if not encrypted_value or not key:
-            return None
-        cipher = AESCipher(key)
-        try:
-            return cipher.decrypt(encrypted_value)
-        except Exception:
-            # MAC check failed or corrupted value
-            return "[Decryption Error]"
-
     @property
     def type_of_decrypted(self):
         return self._decrypt_field(self.type_of)
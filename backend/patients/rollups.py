@@ -0,0 +1,138 @@
+# patients/rollups.py
+"""
+Maintenance of the hourly and daily VitalRollup buckets.
+
+add_readings() creates any missing bucket empty and then folds new
+readings in with one UPDATE of F() expressions per bucket, so concurrent
+inserts never lose counts. An edited reading can't be subtracted from a
+min/max, so rebuild() recomputes its buckets from the raw rows. There is no
+API to delete readings; after deleting some by hand run
+`manage.py rebuild_vital_rollups`. Readings moved to the archive
+(patients/archive.py) stay counted, and both rebuilds read them back.
+"""
+from datetime import timedelta
+from itertools import islice
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Max, Min, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+from .archive import archived_columns, to_micros, to_vitals, unpack
+from .models import Vital, VitalArchive, VitalRollup
+
+PERIODS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+
+def bucket_start(period, when, tz=None):
+    # Buckets follow the wall clock of the current time zone
+    start = timezone.localtime(when, tz).replace(minute=0, second=0, microsecond=0)
+    return start.replace(hour=0) if period == "day" else start
+
+
+def _summarise(vitals):
+    # {(patient_id, period, start): {"count": n, metric: [count, sum, min, max]}}
+    buckets = {}
+    tz = timezone.get_current_timezone()
+    for vital in vitals:
+        hour = bucket_start("hour", vital.recorded_at, tz)
+        values = [(metric, float(value)) for metric in Vital.METRICS
+                  if (value := getattr(vital, metric)) is not None]
+        for key in ((vital.patient_id, "hour", hour), (vital.patient_id, "day", hour.replace(hour=0))):
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = {"count": 0}
+            bucket["count"] += 1
+            for metric, value in values:
+                stats = bucket.get(metric)
+                if stats is None:
+                    bucket[metric] = [1, value, value, value]
+                else:
+                    stats[0] += 1
+                    stats[1] += value
+                    if value < stats[2]:
+                        stats[2] = value
+                    if value > stats[3]:
+                        stats[3] = value
+    return buckets
+
+
+def add_readings(vitals):
+    """Fold newly inserted readings into their buckets: one INSERT, then one UPDATE per bucket."""
+    buckets = _summarise(vitals)
+    # Missing buckets are created empty first, so every reading is a plain increment
+    VitalRollup.objects.bulk_create([VitalRollup(patient_id=patient_id, period=period, start=start)
+                                     for patient_id, period, start in buckets], ignore_conflicts=True)
+    for (patient_id, period, start), bucket in buckets.items():
+        increments = {"count": F("count") + bucket["count"]}
+        for metric in Vital.METRICS:
+            if metric not in bucket:
+                continue
+            count, total, low, high = bucket[metric]
+            increments.update({
+                f"{metric}_count": F(f"{metric}_count") + count,
+                f"{metric}_sum": F(f"{metric}_sum") + total,
+                f"{metric}_min": Least(Coalesce(f"{metric}_min", Value(low)), Value(low)),
+                f"{metric}_max": Greatest(Coalesce(f"{metric}_max", Value(high)), Value(high)),
+            })
+        VitalRollup.objects.filter(patient_id=patient_id, period=period, start=start).update(**increments)
+
+
+def rebuild(patient_id, times):
+    """Recompute the hourly and daily buckets holding `times` from the raw readings."""
+    aggregates = {"count": Count("id")}
+    for metric in Vital.METRICS:
+        aggregates.update({
+            f"{metric}_count": Count(metric),
+            f"{metric}_sum": Coalesce(Sum(metric, output_field=FloatField()), Value(0.0)),
+            f"{metric}_min": Min(metric),
+            f"{metric}_max": Max(metric),
+        })
+    buckets = [(period, start, start + length) for period, length in PERIODS.items()
+               for start in {bucket_start(period, when) for when in times}]
+    if not buckets:
+        return
+    # Any bucket may hold archived readings (archive_vitals --days can archive recent ones), so
+    # the archive is always read: one query for the span of every bucket, then sliced per bucket
+    archived = archived_columns([patient_id], min(start for _, start, _ in buckets),
+                                max(end for _, _, end in buckets))
+    for period, start, end in buckets:
+        values = Vital.objects.filter(patient_id=patient_id, recorded_at__gte=start,
+                                      recorded_at__lt=end).aggregate(**aggregates)
+        in_bucket = (archived["recorded_at"] >= to_micros(start)) & (archived["recorded_at"] < to_micros(end))
+        _fold_archived(values, {name: column[in_bucket] for name, column in archived.items()})
+        rollups = VitalRollup.objects.filter(patient_id=patient_id, period=period, start=start)
+        if not values["count"]:
+            rollups.delete()
+        elif not rollups.update(**values):
+            VitalRollup.objects.create(patient_id=patient_id, period=period, start=start, **values)
+
+
+def _fold_archived(values, columns):
+    # Add archived readings to rebuild()'s aggregate of the raw ones
+    values["count"] += len(columns["id"])
+    for metric in Vital.METRICS:
+        column = columns[metric][~np.isnan(columns[metric])]
+        if not len(column):
+            continue
+        low, high = float(column.min()), float(column.max())
+        values[f"{metric}_count"] += len(column)
+        values[f"{metric}_sum"] += float(column.sum())
+        values[f"{metric}_min"] = low if values[f"{metric}_min"] is None else min(values[f"{metric}_min"], low)
+        values[f"{metric}_max"] = high if values[f"{metric}_max"] is None else max(values[f"{metric}_max"], high)
+
+
+def rebuild_all(batch_size=5000):
+    # Recreate every bucket from scratch, streaming the readings in batches
+    with transaction.atomic():
+        VitalRollup.objects.all().delete()
+        readings = Vital.objects.order_by("patient_id", "recorded_at").iterator(chunk_size=batch_size)
+        total = 0
+        while batch := list(islice(readings, batch_size)):
+            add_readings(batch)
+            total += len(batch)
+        for archive in VitalArchive.objects.order_by("pk").iterator(chunk_size=10):
+            archived = to_vitals(archive.patient_id, unpack(archive.data))
+            add_readings(archived)
+            total += len(archived)
+    return total
@@ -1,6 +1,9 @@
 from rest_framework import serializers
+from django.db import IntegrityError
 from datetime import date
-from .models import Patient, Vital, MedicalHistory
+from .models import Patient, Vital, VitalRollup, MedicalHistory
+from utils.serializers import BatchDecryptListSerializer, SparseFieldsMixin
+from utils.encryption import blind_index
 import re
 
 class PatientSerializer(serializers.ModelSerializer):
@@ -9,7 +12,8 @@ class PatientSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Patient
-        fields = '__all__'
+        exclude = ['contact_number_index', 'aadhar_number_index']
+        list_serializer_class = BatchDecryptListSerializer
         read_only_fields = ["user"]
 
     # Field-level validations
@@ -62,6 +66,24 @@ class PatientSerializer(serializers.ModelSerializer):
     def get_aadhar_number(self, obj):
         return obj.aadhar_number_decrypted
 
+    def _save_unique(self, patient):
+        # Aadhar uniqueness is enforced on its blind index, not the ciphertext
+        duplicate_error = serializers.ValidationError({
+            "aadhar_number": "A patient with this Aadhar number is already registered."
+        })
+        aadhar = self.initial_data.get("aadhar_number")
+        if aadhar:
+            duplicates = Patient.objects.filter(aadhar_number_index=blind_index("aadhar_number", aadhar))
+            if patient.pk:
+                duplicates = duplicates.exclude(pk=patient.pk)
+            if duplicates.exists():
+                raise duplicate_error
+        try:
+            patient.save()
+        except IntegrityError:
+            # This covers the rare race condition where two registrations happen concurrently
+            raise duplicate_error
+
     def create(self, validated_data):
         # validated_data won't include contact_number/aadhar_number here because we replaced them with method fields.
         # If you want to accept plaintext on create, read from self.initial_data:
@@ -76,7 +98,7 @@ class PatientSerializer(serializers.ModelSerializer):
         for field in ("first_name","last_name","date_of_birth","gender","address"):
             if field in validated_data:
                 setattr(p, field, validated_data[field])
-        p.save()
+        self._save_unique(p)
         return p
 
     def update(self, instance, validated_data):
@@ -91,50 +113,56 @@ class PatientSerializer(serializers.ModelSerializer):
             instance.contact_number = self.initial_data["contact_number"]
         if "aadhar_number" in self.initial_data:
             instance.aadhar_number = self.initial_data["aadhar_number"]
-        instance.save()
+        self._save_unique(instance)
         return instance
 
 
+# Accepted range per metric: (lower bound, upper bound, lower bound itself allowed, message)
+VITAL_LIMITS = {
+    "height_cm": (0, 300, False, "Height must be between 1 cm and 300 cm."),
+    "weight_kg": (0, 500, False, "Weight must be between 1 kg and 500 kg."),
+    "blood_pressure": (40, 300, True, "Blood pressure must be between 40 and 300 mmHg."),
+    "heart_rate_bpm": (30, 250, True, "Heart rate must be between 30 and 250 bpm."),
+    "temperature_celsius": (25, 45, True, "Temperature must be between 25°C and 45°C."),
+}
+HEIGHT_WEIGHT_PAIRED = "Both height and weight should be provided together."
+
+
+def vital_in_range(metric, value):
+    low, high, low_allowed, _ = VITAL_LIMITS[metric]
+    return (value >= low if low_allowed else value > low) and value <= high
+
+
 class VitalsSerializer(serializers.ModelSerializer):
     class Meta:
         model = Vital
         fields = '__all__'
         read_only_fields = ['recorded_at']
 
+    def _check_limits(self, metric, value):
+        if value is not None and not vital_in_range(metric, value):
+            raise serializers.ValidationError(VITAL_LIMITS[metric][3])
+        return value
+
     def validate_height_cm(self, value):
         # Validate height in centimeters
-        if value is not None:
-            if value <= 0 or value > 300:
-                raise serializers.ValidationError("Height must be between 1 cm and 300 cm.")
-        return value
+        return self._check_limits("height_cm", value)
 
     def validate_weight_kg(self, value):
         # Validate weight in kilograms
-        if value is not None:
-            if value <= 0 or value > 500:
-                raise serializers.ValidationError("Weight must be between 1 kg and 500 kg.")
-        return value
+        return self._check_limits("weight_kg", value)
 
     def validate_blood_pressure(self, value):
         # Validate systolic blood pressure
-        if value is not None:
-            if value < 40 or value > 300:
-                raise serializers.ValidationError("Blood pressure must be between 40 and 300 mmHg.")
-        return value
+        return self._check_limits("blood_pressure", value)
 
     def validate_heart_rate_bpm(self, value):
         # Validate heart rate
-        if value is not None:
-            if value < 30 or value > 250:
-                raise serializers.ValidationError("Heart rate must be between 30 and 250 bpm.")
-        return value
+        return self._check_limits("heart_rate_bpm", value)
 
     def validate_temperature_celsius(self, value):
         # Validate body temperature
-        if value is not None:
-            if value < 25 or value > 45:
-                raise serializers.ValidationError("Temperature must be between 25°C and 45°C.")
-        return value
+        return self._check_limits("temperature_celsius", value)
 
     def validate(self, attrs):
         # Cross-field validation (optional)
@@ -143,12 +171,31 @@ class VitalsSerializer(serializers.ModelSerializer):
 
         # Example: ensure both height and weight are given if one is provided
         if (height and not weight) or (weight and not height):
-            raise serializers.ValidationError("Both height and weight should be provided together.")
+            raise serializers.ValidationError(HEIGHT_WEIGHT_PAIRED)
 
         return attrs
 
 
-class MedicalHistorySerializer(serializers.ModelSerializer):
+class VitalRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = VitalRollup
+        fields = ['period', 'start', 'count']
+
+    def to_representation(self, instance):
+        # Each metric as {count, avg, min, max}, or None when the bucket has no readings of it
+        data = super().to_representation(instance)
+        for metric in Vital.METRICS:
+            count = getattr(instance, f"{metric}_count")
+            data[metric] = {
+                "count": count,
+                "avg": getattr(instance, f"{metric}_sum") / count,
+                "min": getattr(instance, f"{metric}_min"),
+                "max": getattr(instance, f"{metric}_max"),
+            } if count else None
+        return data
+
+
+class MedicalHistorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     type_of = serializers.SerializerMethodField()
     description = serializers.SerializerMethodField()
     diagnosis_code = serializers.SerializerMethodField()
@@ -158,6 +205,7 @@ class MedicalHistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = MedicalHistory
         fields = '__all__'
+        list_serializer_class = BatchDecryptListSerializer
 
     # --- Field-level validation ---
     def validate_type_of(self, value):
@@ -1,6 +1,8 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from .models import Patient
+from utils.access import invalidate
+from .models import Patient, Vital
+from .rollups import add_readings, rebuild
 
 @receiver(post_save, sender=Patient)
 def update_linked_patient(sender, instance, created, **kwargs):
@@ -9,3 +11,21 @@ def update_linked_patient(sender, instance, created, **kwargs):
         if user.role == "patient" and not user.linked_patient:
             user.linked_patient = instance
             user.save(update_fields=["linked_patient"])
+
+
+@receiver([post_save, post_delete], sender=Patient)
+def drop_patient_grants(sender, instance, created=False, **kwargs):
+    # A new profile can reuse a deleted one's id (e.g. SQLite), so start it clean too
+    if created or kwargs["signal"] is post_delete:
+        invalidate("patient", instance.pk)
+
+
+@receiver(post_save, sender=Vital)
+def roll_up_vital(sender, instance, created, raw=False, **kwargs):
+    # Readings saved one at a time; bulk inserts call add_readings() themselves
+    if raw:
+        return
+    if created:
+        add_readings([instance])
+    else:
+        rebuild(instance.patient_id, [instance.recorded_at])
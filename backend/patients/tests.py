@@ -1,3 +1,816 @@
-from django.test import TestCase
+import base64
+import json
+import os
+from importlib import import_module
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+import numpy as np
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from jobs.models import Job
+from jobs.worker import run_job
+from patients import archive, ingest, rollups
+from patients.models import MedicalHistory, Patient, SearchToken, Vital, VitalArchive, VitalRollup
+from patients.serializers import VitalsSerializer
+from utils import index_advisor, testing
+from utils.encryption import FLAG_ZLIB, blind_index
+from utils.keyring import user_keyring
 
-# Create your tests here.
+
+class PatientQueryBudgetTests(testing.QueryBudgetTestCase):
+    urlconf = "patients.urls"
+
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.user = self.patient.user
+        self.doctor = testing.make_doctor()
+        testing.grant_access(self.doctor, self.patient)
+        self.login(self.user)
+
+    def grow_patients(self, n):
+        for _ in range(n):
+            testing.make_patient()
+
+    def grow_vitals(self, n):
+        for _ in range(n):
+            testing.make_vital(self.patient)
+
+    def grow_rollups(self, n):
+        # One reading in each of n earlier hours
+        now = timezone.now()
+        for hours in range(1, n + 1):
+            testing.make_vital(self.patient, recorded_at=now - timedelta(hours=hours + self.patient.vitals.count()))
+
+    def grow_histories(self, n):
+        for _ in range(n):
+            testing.make_history(self.patient)
+
+    def grow_chart(self, n):
+        for _ in range(n):
+            testing.make_vital(self.patient)
+            testing.make_history(self.patient)
+            testing.make_note(testing.make_encounter(self.patient, self.doctor))
+
+    def new_patient_user(self):
+        user = testing.make_user("patient")
+        self.login(user)
+        return (user,)
+
+    def new_patient(self):
+        patient = testing.make_patient()
+        self.login(patient.user)
+        return (patient,)
+
+    def budget_cases(self):
+        base = f"/v1/patients/{self.patient.pk}"
+        vital = testing.make_vital(self.patient)
+        history = testing.make_history(self.patient)
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+        return {
+            ("", "get"): {"request": lambda: self.client.get("/v1/patients/"), "grow": self.grow_patients},
+            ("", "post"): {
+                "setup": self.new_patient_user,
+                "request": lambda user: self.client.post("/v1/patients/", {
+                    "first_name": "Meera", "last_name": "Shah", "date_of_birth": "1985-05-05", "gender": "female",
+                    "contact_number": "9123456780", "aadhar_number": "5%011d" % user.pk}, format="json"),
+                "grow": self.grow_patients,
+            },
+            ("<int:pk>/", "get"): {"request": lambda: self.client.get(f"{base}/"), "grow": self.grow_patients},
+            ("<int:pk>/", "patch"): {
+                "request": lambda: self.client.patch(f"{base}/", {"first_name": "Meera", "address": "12 Park Street"}, format="json"),
+                "grow": self.grow_patients,
+            },
+            ("<int:pk>/export/", "get"): {
+                "request": lambda: self.client.get(f"{base}/export/"), "grow": self.grow_chart,
+            },
+            ("<int:pk>/vitals/", "get"): {"request": lambda: self.client.get(f"{base}/vitals/"), "grow": self.grow_vitals},
+            ("<int:pk>/vitals/", "post"): {
+                "setup": self.new_patient,
+                "request": lambda patient: self.client.post(f"/v1/patients/{patient.pk}/vitals/", {
+                    "patient": patient.pk, "height_cm": 165, "weight_kg": 60, "heart_rate_bpm": 70}, format="json"),
+                "grow": self.grow_vitals,
+            },
+            ("<int:pk>/vitals/bulk/", "post"): {
+                "request": lambda: self.client.post(f"{base}/vitals/bulk/", [
+                    {"heart_rate_bpm": 70 + i, "recorded_at": (hour + timedelta(minutes=i)).isoformat()}
+                    for i in range(20)], format="json"),
+                "grow": self.grow_vitals,
+            },
+            ("<int:pk>/vitals/analytics/", "get"): {
+                "setup": self.cold_cache,
+                "request": lambda: self.client.get(f"{base}/vitals/analytics/"), "grow": self.grow_vitals,
+            },
+            ("<int:pk>/vitals/latest/", "get"): {
+                "request": lambda: self.client.get(f"{base}/vitals/latest/"), "grow": self.grow_vitals,
+            },
+            ("<int:pk>/vitals/rollups/", "get"): {
+                "request": lambda: self.client.get(f"{base}/vitals/rollups/?period=hour"), "grow": self.grow_rollups,
+            },
+            ("<int:patient_id>/vitals/<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"{base}/vitals/{vital.pk}/"), "grow": self.grow_vitals,
+            },
+            ("<int:patient_id>/vitals/<int:pk>/", "patch"): {
+                "request": lambda: self.client.patch(f"{base}/vitals/{vital.pk}/", {
+                    "height_cm": 171, "weight_kg": 71}, format="json"),
+                "grow": self.grow_vitals,
+            },
+            ("<int:pk>/medical-histories/", "get"): {
+                "request": lambda: self.client.get(f"{base}/medical-histories/"), "grow": self.grow_histories,
+            },
+            ("<int:pk>/medical-histories/", "post"): {
+                "request": lambda: self.client.post(f"{base}/medical-histories/", {
+                    "patient": self.patient.pk, "type_of": "surgery", "description": "Appendectomy",
+                    "status": "resolved", "event_date": "2015-03-01"}, format="json"),
+                "grow": self.grow_histories,
+            },
+            ("<int:patient_id>/medical-histories/<int:pk>/", "get"): {
+                "request": lambda: self.client.get(f"{base}/medical-histories/{history.pk}/"),
+                "grow": self.grow_histories,
+            },
+            ("<int:patient_id>/medical-histories/<int:pk>/", "patch"): {
+                "request": lambda: self.client.patch(f"{base}/medical-histories/{history.pk}/", {
+                    "notes": "Updated notes"}, format="json"),
+                "grow": self.grow_histories,
+            },
+            ("<int:patient_id>/medical-histories/<int:pk>/", "delete"): {
+                "setup": lambda: (testing.make_history(self.patient),),
+                "request": lambda history: self.client.delete(f"{base}/medical-histories/{history.pk}/"),
+                "grow": self.grow_histories,
+            },
+        }
+
+
+class InstrumentationTests(APITestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        testing.make_history(self.patient)
+        token = RefreshToken.for_user(self.patient.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_server_timing_header(self):
+        with self.settings(SERVER_TIMING_HEADERS=True):
+            response = self.client.get(f"/v1/patients/{self.patient.pk}/medical-histories/")
+        timing = response["Server-Timing"]
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn("aes;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+    def test_slow_request_logged_with_explain(self):
+        with self.settings(SLOW_REQUEST_MS=0), self.assertLogs("utils.instrumentation", "WARNING") as logs:
+            self.client.get(f"/v1/patients/{self.patient.pk}/vitals/")
+        self.assertIn("Slow request GET", logs.output[0])
+        self.assertIn('FROM "patients_vital"', logs.output[0])
+        self.assertRegex(logs.output[0], r"\n {6}\S")  # EXPLAIN rows
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class IndexAdvisorTests(TestCase):
+    def test_typical_requests_use_indexes(self):
+        index_advisor.seed(rows=20)
+        results = index_advisor.advise(*index_advisor.sample())
+        self.assertEqual(len(results), len(index_advisor.TYPICAL_REQUESTS))
+        for result in results:
+            self.assertEqual(result["status"], 200, result["path"])
+            self.assertEqual(result["scans"], [], result["path"])
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"], EXPORT_CHUNK_SIZE=2)
+class ChartExportTests(APITestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.doctor = testing.make_doctor()
+        for _ in range(3):
+            testing.make_history(self.patient)
+            testing.make_note(testing.make_encounter(self.patient, self.doctor))
+        testing.make_vital(self.patient)
+
+    def export(self, user):
+        self.client.force_authenticate(user)
+        return self.client.get(f"/v1/patients/{self.patient.pk}/export/")
+
+    def test_streams_decrypted_chart(self):
+        response = self.export(self.patient.user)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        kinds = [record["type"] for record in records]
+        self.assertEqual(kinds, ["patient"] + ["vital"] + ["medical_history"] * 3 + ["encounter"] * 3
+                         + ["clinical_note"] * 3)
+        self.assertEqual(records[2]["data"]["description"], "Peanut allergy")
+        self.assertEqual(records[-1]["data"]["subjective"], "Wheezing at night")
+
+    def test_requires_access(self):
+        self.assertEqual(self.export(self.doctor.user).status_code, 403)
+        testing.grant_access(self.doctor, self.patient)
+        self.assertEqual(self.export(self.doctor.user).status_code, 200)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class DecryptionKeyTests(TestCase):
+    def setUp(self):
+        user_keyring.clear()
+        self.addCleanup(user_keyring.clear)
+        self.patients = [testing.make_patient() for _ in range(2)]
+        for patient in self.patients:
+            testing.make_history(patient)
+            testing.make_history(patient)
+
+    def test_keys_resolved_once_per_owner(self):
+        with self.assertNumQueries(2):  # the rows, then their owners
+            histories = list(MedicalHistory.objects.with_decryption_keys().order_by("id"))
+            self.assertEqual({history.description_decrypted for history in histories}, {"Peanut allergy"})
+        self.assertEqual([history.key_owner_id for history in histories],
+                         [patient.user_id for patient in self.patients for _ in range(2)])
+        self.assertEqual(user_keyring.stats()["misses"], 2)
+
+    def test_reassigned_owner_gets_its_own_key(self):
+        history = MedicalHistory.objects.with_decryption_keys().filter(patient=self.patients[0]).first()
+        history.patient = self.patients[1]
+        history.description = "Moved to the right chart"
+        history.save()
+        self.assertEqual(history.key_owner_id, self.patients[1].user_id)
+        history = MedicalHistory.objects.get(pk=history.pk)
+        self.assertEqual(history.description_decrypted, "Moved to the right chart")
+
+
+class SparseFieldsetTests(APITestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        testing.make_history(self.patient)
+        self.url = f"/v1/patients/{self.patient.pk}/medical-histories/"
+        self.client.force_authenticate(self.patient.user)
+
+    def get(self, **params):
+        with CaptureQueriesContext(connection) as ctx, \
+                patch("utils.encryption.AESCipher.decrypt_many", autospec=True,
+                      side_effect=lambda cipher, values, errors="strict": ["x"] * len(values)) as decrypt:
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        [select] = [query["sql"] for query in ctx.captured_queries if 'FROM "patients_medicalhistory"' in query["sql"]
+                    and "COUNT" not in query["sql"]]
+        decrypted = sum(len(call.args[1]) for call in decrypt.call_args_list)
+        return response.data["results"][0], select, decrypted
+
+    def test_fields(self):
+        row, select, decrypted = self.get(fields="id,type_of")
+        self.assertEqual(set(row), {"id", "type_of"})
+        self.assertIn('"type_of"', select)
+        self.assertNotIn('"notes"', select)
+        self.assertEqual(decrypted, 1)
+
+    def test_omit(self):
+        row, select, decrypted = self.get(omit="notes,description")
+        self.assertNotIn("notes", row)
+        self.assertNotIn("description", row)
+        self.assertIn("event_date", row)
+        self.assertNotIn('"notes"', select)
+        self.assertEqual(decrypted, 3)  # type_of, diagnosis_code, status
+
+    def test_writes_return_every_field(self):
+        response = self.client.post(f"{self.url}?fields=id", {
+            "patient": self.patient.pk, "type_of": "surgery", "description": "Appendectomy",
+            "status": "resolved", "event_date": "2015-03-01"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["description"], "Appendectomy")
+
+
+class EnvelopeMigrationTests(TestCase):
+    def test_rewrites_bare_ciphertext_into_envelopes(self):
+        migration = import_module("patients.migrations.0009_rewrite_ciphertext_envelope")
+        patient = testing.make_patient()
+        history = testing.make_history(patient)
+        aead = AESGCM(bytes(patient.user.get_user_key()))
+        # The models as 0009 saw them, with text columns holding base64(nonce + tag + ciphertext)
+        old_apps = MigrationExecutor(connection).loader.project_state(
+            ("patients", "0008_alter_medicalhistory_diagnosis_code_and_more")).apps
+        OldHistory = old_apps.get_model("patients", "MedicalHistory")
+        nonce = os.urandom(12)
+        sealed = aead.encrypt(nonce, b"Asthma", None)
+        bare = base64.b64encode(nonce + sealed[-16:] + sealed[:-16]).decode()
+        # A value the old heuristics left in plaintext gets sealed too
+        OldHistory.objects.filter(pk=history.pk).update(description=bare, notes="Uses an inhaler")
+
+        migration.rewrite_model(OldHistory, ["description", "notes"], "patient.user")
+        row = OldHistory.objects.get(pk=history.pk)
+        self.assertTrue(row.description.startswith(migration.ENVELOPE_PREFIX))
+        history = MedicalHistory.objects.get(pk=history.pk)
+        self.assertEqual((history.description_decrypted, history.notes_decrypted), ("Asthma", "Uses an inhaler"))
+        # Envelopes are left alone on a rerun
+        migration.rewrite_model(OldHistory, ["description", "notes"], "patient.user")
+        self.assertEqual(OldHistory.objects.get(pk=history.pk).description, row.description)
+
+
+class BinaryColumnMigrationTests(TestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.histories = [testing.make_history(self.patient) for _ in range(3)]
+        self.aead = AESGCM(bytes(self.patient.user.get_user_key()))
+
+    def test_converts_base64_text_in_batches(self):
+        migration = import_module("patients.migrations.0011_convert_ciphertext_to_binary")
+        # Rows as 0010 left them: v1 envelopes as base64 text, some columns empty
+        for history in self.histories:
+            MedicalHistory.objects.filter(pk=history.pk).update(**{
+                field: base64.b64encode(BlindIndexTests.seal_v1(self.aead, field)).decode()
+                for field in ("type_of", "description", "status")}, notes=None)
+        fields = ["type_of", "description", "diagnosis_code", "status", "notes"]
+        with CaptureQueriesContext(connection) as ctx, patch.object(migration, "BATCH_SIZE", 2):
+            migration.convert_table(MedicalHistory, fields)
+        updates = [query for query in ctx.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)  # one bulk_update per batch of two rows
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT type_of, notes FROM patients_medicalhistory")
+            self.assertTrue(all(bytes(type_of).startswith(b"\xa7\xe5\x01") and notes is None
+                                for type_of, notes in cursor.fetchall()))
+        for history in MedicalHistory.objects.all():
+            self.assertEqual((history.type_of_decrypted, history.status_decrypted), ("type_of", "status"))
+
+        with CaptureQueriesContext(connection) as ctx:
+            migration.convert_table(MedicalHistory, fields)
+        self.assertFalse([query for query in ctx.captured_queries if query["sql"].startswith("UPDATE")])
+
+
+class BinaryColumnCopyMigrationTests(TransactionTestCase):
+    BEFORE = [("patients", "0009_rewrite_ciphertext_envelope"), ("doctors", "0009_rewrite_ciphertext_envelope")]
+    AFTER = [("patients", "0010_encrypted_binary_columns"), ("doctors", "0010_encrypted_binary_columns")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_plaintext_with_backslashes_survives(self):
+        # 0009 left keyless owners' values as plaintext; PostgreSQL's implicit ::bytea cast reads \ as an escape
+        old_apps = self.migrate(self.BEFORE)
+        contact, notes, reason = r"98\x41", "C:\\scans\\new", "\\\\ back\\slash"
+        patient = old_apps.get_model("patients", "Patient").objects.create(
+            first_name="Asha", last_name="Rao", date_of_birth="1990-01-01", gender="female",
+            contact_number=contact, aadhar_number="123412341234")
+        old_apps.get_model("patients", "MedicalHistory").objects.create(
+            patient_id=patient.pk, type_of="allergy", description="Dust", status="active", notes=notes,
+            event_date="2020-01-01")
+        doctor = old_apps.get_model("doctors", "Doctor").objects.create(
+            name="Dr Old", specialty="General", contact_number="9876500000", hospital="City Hospital")
+        old_apps.get_model("doctors", "Encounter").objects.create(patient_id=patient.pk, doctor_id=doctor.pk, reason=reason)
+
+        self.migrate(self.AFTER)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT contact_number, aadhar_number FROM patients_patient")
+            self.assertEqual([bytes(value) for value in cursor.fetchone()], [contact.encode(), b"123412341234"])
+            cursor.execute("SELECT notes FROM patients_medicalhistory")
+            self.assertEqual(bytes(cursor.fetchone()[0]), notes.encode())
+            cursor.execute("SELECT reason, summary FROM doctors_encounter")
+            self.assertEqual(tuple(cursor.fetchone()), (reason.encode(), None))
+
+        old_apps = self.migrate(self.BEFORE)
+        self.assertEqual(old_apps.get_model("patients", "Patient").objects.get().contact_number, contact)
+        self.assertEqual(old_apps.get_model("doctors", "Encounter").objects.get().reason, reason)
+
+
+class BlindIndexTests(APITestCase):
+    def setUp(self):
+        self.patients = [testing.make_patient() for _ in range(2)]
+        self.aadhar = Patient.objects.get(pk=self.patients[0].pk).aadhar_number_decrypted
+
+    def test_duplicate_aadhar_rejected(self):
+        user = testing.make_user("patient")
+        self.client.force_authenticate(user)
+        spaced = " ".join([self.aadhar[:4], self.aadhar[4:8], self.aadhar[8:]])
+        response = self.client.post("/v1/patients/", {
+            "first_name": "Meera", "last_name": "Shah", "date_of_birth": "1985-05-05", "gender": "female",
+            "contact_number": "9123456780", "aadhar_number": spaced}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("already registered", str(response.data["aadhar_number"]))
+        self.assertEqual(Patient.objects.count(), 2)
+
+    def test_index_stable_for_a_patient_without_a_key(self):
+        patient = Patient(first_name="Ravi", last_name="Keyless", date_of_birth="1980-01-01", gender="male",
+                          contact_number="9811111111", aadhar_number="555566667777")
+        patient.save()
+        indexes = (patient.contact_number_index, patient.aadhar_number_index)
+        self.assertEqual(indexes[1], blind_index("aadhar_number", "555566667777"))
+        patient.refresh_from_db()
+        patient.first_name = "Ravi K"
+        patient.save()
+        patient.refresh_from_db()
+        self.assertEqual((patient.contact_number_index, patient.aadhar_number_index), indexes)
+
+    def test_filters_on_encrypted_columns(self):
+        self.client.force_authenticate(self.patients[0].user)
+        dashed = f"{self.aadhar[:4]}-{self.aadhar[4:8]}-{self.aadhar[8:]}"
+        response = self.client.get("/v1/patients/", {"aadhar_number": dashed})
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.patients[0].pk])
+        contact = Patient.objects.get(pk=self.patients[1].pk).contact_number_decrypted
+        response = self.client.get("/v1/patients/", {"contact_number": contact})
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.patients[1].pk])
+        self.assertEqual(self.client.get("/v1/patients/", {"aadhar_number": "000000000000"}).data["results"], [])
+
+    def test_admin_search(self):
+        self.client.force_login(testing.make_user("patient", is_staff=True, is_superuser=True))
+        response = self.client.get("/admin/patients/patient/", {"q": self.aadhar})
+        self.assertEqual([patient.pk for patient in response.context["cl"].result_list], [self.patients[0].pk])
+
+    def test_migration_indexes_existing_rows_and_skips_duplicates(self):
+        migration = import_module("patients.migrations.0012_patient_blind_indexes")
+        # Rows as they were before binary envelopes grew a flags byte
+        duplicate = testing.make_patient()
+        for patient in (*self.patients, duplicate):
+            aead = AESGCM(bytes(patient.user.get_user_key()))
+            values = {field: self.aadhar if patient is duplicate and field == "aadhar_number"
+                      else getattr(Patient.objects.get(pk=patient.pk), f"{field}_decrypted")
+                      for field in Patient.ENCRYPTED_FIELDS}
+            Patient.objects.filter(pk=patient.pk).update(contact_number_index=None, aadhar_number_index=None, **{
+                field: self.seal_v1(aead, value) for field, value in values.items()})
+        with self.assertLogs(migration.logger, "WARNING") as logs:
+            migration.populate_blind_indexes(apps, None)
+        self.assertIn(str(duplicate.pk), logs.output[0])
+        indexes = dict(Patient.objects.values_list("pk", "aadhar_number_index"))
+        self.assertEqual(indexes, {self.patients[0].pk: blind_index("aadhar_number", self.aadhar),
+                                   self.patients[1].pk: self.patients[1].aadhar_number_index, duplicate.pk: None})
+        self.assertEqual(Patient.objects.get(pk=duplicate.pk).contact_number_index,
+                         duplicate.contact_number_index)
+
+    def test_migration_reads_rows_written_by_the_live_code(self):
+        migration = import_module("patients.migrations.0012_patient_blind_indexes")
+        expected = dict(Patient.objects.values_list("pk", "contact_number_index"))
+        Patient.objects.update(contact_number_index=None, aadhar_number_index=None)
+        migration.populate_blind_indexes(apps, None)
+        self.assertEqual(dict(Patient.objects.values_list("pk", "contact_number_index")), expected)
+        self.assertNotIn(None, expected.values())
+
+    @staticmethod
+    def seal_v1(aead, plaintext):
+        header, nonce = b"\xa7\xe5\x01\x01", os.urandom(12)
+        sealed = aead.encrypt(nonce, plaintext.encode(), header)
+        return header + nonce + sealed[-16:] + sealed[:-16]
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class KeywordSearchTests(APITestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.history = testing.make_history(self.patient)
+        self.url = f"/v1/patients/{self.patient.pk}/medical-histories/"
+        self.client.force_authenticate(self.patient.user)
+
+    def search(self, text, url=None):
+        return [row["id"] for row in self.client.get(url or self.url, {"search": text}).data["results"]]
+
+    def test_whole_words_all_required(self):
+        other = testing.make_history(self.patient)
+        other.notes = "Epinephrine pen expired"
+        other.save()
+        self.assertEqual(sorted(self.search("EPINEPHRINE")), [self.history.pk, other.pk])
+        self.assertEqual(self.search("carries epinephrine"), [self.history.pk])
+        self.assertEqual(self.search("epine"), [])
+        self.assertEqual(len(self.search("")), 2)
+
+    def test_tokens_are_keyed_per_owner(self):
+        stranger = testing.make_history(testing.make_patient())
+        mine = set(SearchToken.objects.filter(object_id=self.history.pk).values_list("token", flat=True))
+        theirs = set(SearchToken.objects.filter(object_id=stranger.pk).values_list("token", flat=True))
+        self.assertTrue(mine)
+        self.assertFalse(mine & theirs)
+
+    def test_edits_reindex(self):
+        response = self.client.patch(f"{self.url}{self.history.pk}/", {"notes": "Uses an inhaler"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.search("epinephrine"), [])
+        self.assertEqual(self.search("inhaler"), [self.history.pk])
+        history = MedicalHistory.objects.get(pk=self.history.pk)
+        history.notes = None
+        history.save()
+        self.assertEqual(self.search("inhaler"), [])
+        self.assertEqual(self.search("peanut"), [self.history.pk])
+
+    def test_unchanged_empty_fields_do_not_reindex(self):
+        history = MedicalHistory.objects.get(pk=self.history.pk)
+        history.notes = None
+        history.save()
+        history = MedicalHistory.objects.get(pk=self.history.pk)
+        self.assertIsNone(history.notes)
+        with CaptureQueriesContext(connection) as ctx:
+            history.save()
+        self.assertFalse([query for query in ctx.captured_queries if "patients_searchtoken" in query["sql"]])
+
+    @override_settings(ENCRYPTION_COMPRESSION="zlib")
+    def test_migration_builds_the_same_tokens(self):
+        migration = import_module("patients.migrations.0013_search_tokens")
+        # Rows as the live code writes them, one long enough to be compressed
+        long = testing.make_history(self.patient)
+        long.notes = "Seasonal asthma, worse with pollen. " * 20
+        long.save()
+        self.assertEqual(MedicalHistory.objects.get(pk=long.pk).notes[4], FLAG_ZLIB)
+        live = set(SearchToken.objects.values_list("token", flat=True))
+        SearchToken.objects.all().delete()
+        migration.index_model(apps, MedicalHistory, MedicalHistory.SEARCH_FIELDS, "patient.user")
+        self.assertEqual(set(SearchToken.objects.values_list("token", flat=True)), live)
+
+    def test_migration_reads_v1_envelopes(self):
+        migration = import_module("patients.migrations.0013_search_tokens")
+        live = set(SearchToken.objects.values_list("token", flat=True))
+        history = MedicalHistory.objects.get(pk=self.history.pk)
+        aead = AESGCM(bytes(self.patient.user.get_user_key()))
+        MedicalHistory.objects.filter(pk=history.pk).update(**{
+            field: BlindIndexTests.seal_v1(aead, getattr(history, f"{field}_decrypted"))
+            for field in MedicalHistory.SEARCH_FIELDS if getattr(history, field)})
+        SearchToken.objects.all().delete()
+        migration.index_model(apps, MedicalHistory, MedicalHistory.SEARCH_FIELDS, "patient.user")
+        self.assertEqual(set(SearchToken.objects.values_list("token", flat=True)), live)
+
+    def test_clinical_notes(self):
+        doctor = testing.make_doctor()
+        testing.grant_access(doctor, self.patient)
+        note = testing.make_note(testing.make_encounter(self.patient, doctor))
+        self.client.force_authenticate(doctor.user)
+        url = "/v1/doctors/encounters/clinical-notes/"
+        self.assertEqual(self.search("salbutamol inhaler", url), [note.pk])
+        self.assertEqual(self.search("peanut", url), [])
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class VitalsTimeSeriesTests(APITestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.base = f"/v1/patients/{self.patient.pk}/vitals"
+        self.hour = (timezone.now() - timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+        self.readings = [
+            testing.make_vital(self.patient, recorded_at=self.hour + timedelta(minutes=10), heart_rate_bpm=60),
+            testing.make_vital(self.patient, recorded_at=self.hour + timedelta(minutes=40), heart_rate_bpm=80),
+            testing.make_vital(self.patient, recorded_at=self.hour + timedelta(hours=1, minutes=5), heart_rate_bpm=90,
+                               height_cm=None, weight_kg=None),
+        ]
+        self.client.force_authenticate(self.patient.user)
+
+    def rollups(self, period):
+        return self.client.get(f"{self.base}/rollups/?period={period}").data["results"]
+
+    def test_readings_accumulate_and_filter_by_range(self):
+        response = self.client.post(f"{self.base}/", {"patient": self.patient.pk, "heart_rate_bpm": 75}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.client.get(f"{self.base}/").data["results"]), 4)
+        since = (self.hour + timedelta(minutes=30)).isoformat()
+        until = (self.hour + timedelta(hours=2)).isoformat()
+        response = self.client.get(f"{self.base}/", {"from": since, "to": until})
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.readings[2].pk, self.readings[1].pk])
+        self.assertEqual(self.client.get(f"{self.base}/?from=yesterday").status_code, 400)
+
+    def test_latest(self):
+        self.assertEqual(self.client.get(f"{self.base}/latest/").data["id"], self.readings[2].pk)
+        self.client.force_authenticate(testing.make_doctor().user)
+        self.assertEqual(self.client.get(f"{self.base}/latest/").status_code, 404)
+
+    def test_rollups_follow_inserts_and_edits(self):
+        first, second = self.rollups("hour")
+        self.assertEqual(first["start"], self.hour.isoformat().replace("+00:00", "Z"))
+        self.assertEqual(first["count"], 2)
+        self.assertEqual(first["heart_rate_bpm"], {"count": 2, "avg": 70.0, "min": 60.0, "max": 80.0})
+        self.assertIsNone(second["height_cm"])
+        [day] = self.rollups("day")
+        self.assertEqual((day["count"], day["heart_rate_bpm"]["max"]), (3, 90.0))
+
+        response = self.client.patch(f"{self.base}/{self.readings[0].pk}/", {"heart_rate_bpm": 100}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.rollups("hour")[0]["heart_rate_bpm"], {"count": 2, "avg": 90.0, "min": 80.0, "max": 100.0})
+
+        before = list(VitalRollup.objects.order_by("period", "start").values())
+        rollups.rebuild_all()
+        after = list(VitalRollup.objects.order_by("period", "start").values())
+        self.assertEqual([{**row, "id": None} for row in after], [{**row, "id": None} for row in before])
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class VitalsIngestTests(APITestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.url = f"/v1/patients/{self.patient.pk}/vitals/bulk/"
+        self.hour = (timezone.now() - timedelta(days=1)).replace(hour=8, minute=0, second=0, microsecond=0)
+        self.client.force_authenticate(self.patient.user)
+
+    def at(self, minutes):
+        return (self.hour + timedelta(minutes=minutes)).isoformat()
+
+    def test_json_array_reports_bad_rows_and_keeps_good_ones(self):
+        response = self.client.post(self.url, [
+            {"heart_rate_bpm": 72, "recorded_at": self.at(1)},
+            {"heart_rate_bpm": 20, "temperature_celsius": 37.2, "recorded_at": self.at(2)},
+            {"height_cm": 170, "recorded_at": self.at(3)},
+            {"blood_pressure": "high"},
+            {"temperature_celsius": 36.6, "recorded_at": "soon"},
+            {"height_cm": 170, "weight_kg": 65, "recorded_at": self.at(4)},
+        ], format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(response.data["errors"], [
+            {"row": 1, "errors": {"heart_rate_bpm": ["Heart rate must be between 30 and 250 bpm."]}},
+            {"row": 2, "errors": {"non_field_errors": ["Both height and weight should be provided together."]}},
+            {"row": 3, "errors": {"blood_pressure": ["A valid integer is required."]}},
+            {"row": 4, "errors": {"recorded_at": ["Use an ISO 8601 datetime."]}},
+        ])
+        self.assertEqual(VitalRollup.objects.get(patient=self.patient, period="hour").count, 2)
+
+    def test_ndjson_stream(self):
+        lines = [json.dumps({"heart_rate_bpm": 60 + i, "recorded_at": self.at(i)}) for i in range(30)]
+        body = "\n".join(lines[:10] + ["{not json", ""] + lines[10:]) + "\n"
+        with patch("patients.ingest.INGEST_BATCH_SIZE", 7):
+            response = self.client.generic("POST", self.url, body, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["created"], 30)
+        self.assertEqual(response.data["errors"], [{"row": 10, "errors": {"non_field_errors": ["Invalid JSON."]}}])
+        rollup = VitalRollup.objects.get(patient=self.patient, period="hour")
+        self.assertEqual((rollup.heart_rate_bpm_count, rollup.heart_rate_bpm_min, rollup.heart_rate_bpm_max),
+                         (30, 60, 89))
+
+    def test_agrees_with_the_vitals_serializer(self):
+        rows = [{"heart_rate_bpm": "72"}, {"heart_rate_bpm": 72.0}, {"heart_rate_bpm": " 72.00 "},
+                {"heart_rate_bpm": 72.5}, {"heart_rate_bpm": True}, {"heart_rate_bpm": 10 ** 30},
+                {"temperature_celsius": "36.6"}, {"temperature_celsius": "nan"}, {"temperature_celsius": "1e400"},
+                {"height_cm": "170", "weight_kg": "70.5"}, {"height_cm": 170, "weight_kg": 0},
+                {"height_cm": 170, "weight_kg": None}, {"blood_pressure": "high", "height_cm": 170}]
+        readings, errors = ingest.validate_batch(rows)
+        accepted = iter(readings)
+        for index, row in enumerate(rows):
+            serializer = VitalsSerializer(data={**row, "patient": self.patient.pk})
+            with self.subTest(row=row):
+                if serializer.is_valid():
+                    self.assertNotIn(index, errors)
+                    reading = next(accepted)
+                    serializer.validated_data.pop("patient")
+                    self.assertEqual({metric: reading[metric] for metric in row}, dict(serializer.validated_data))
+                else:
+                    self.assertEqual(errors[index], {field: [str(message) for message in messages]
+                                                     for field, messages in serializer.errors.items()})
+
+    def test_rejects_all_invalid_and_foreign_patients(self):
+        response = self.client.post(self.url, [{"weight_kg": 0, "height_cm": 170}], format="json")
+        self.assertEqual((response.status_code, response.data["created"]), (400, 0))
+        self.assertEqual(self.client.post(self.url, {"heart_rate_bpm": 70}, format="json").status_code, 400)
+        other = testing.make_patient()
+        response = self.client.post(f"/v1/patients/{other.pk}/vitals/bulk/", [{"heart_rate_bpm": 70}], format="json")
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Vital.objects.exists())
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"], ACCESS_GRANT_CACHE_TTL=300)
+class VitalsAnalyticsTests(APITestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.url = f"/v1/patients/{self.patient.pk}/vitals/analytics/"
+        self.start = timezone.now().replace(microsecond=0) - timedelta(days=20)
+        # Weight climbs 0.5 kg a day; the last heart rate is far off the patient's normal
+        for day in range(12):
+            testing.make_vital(self.patient, recorded_at=self.start + timedelta(days=day), weight_kg=70 + day / 2,
+                               heart_rate_bpm=180 if day == 11 else 70, blood_pressure=120 + day)
+        self.client.force_authenticate(self.patient.user)
+
+    def test_bmi_trends_rolling_and_anomalies(self):
+        data = self.client.get(self.url, {"window": 3}).data
+        self.assertEqual(data["readings"], 12)
+        self.assertEqual(data["bmi"], round(75.5 / 1.7 ** 2, 2))
+        weight = data["metrics"]["weight_kg"]
+        self.assertEqual((weight["min"], weight["max"], weight["slope_per_day"]), (70.0, 75.5, 0.5))
+        self.assertEqual(data["metrics"]["heart_rate_bpm"]["anomalies"], 1)
+        [anomaly] = data["recent_anomalies"]
+        self.assertEqual((anomaly["metric"], anomaly["value"]), ("heart_rate_bpm", 180.0))
+        self.assertEqual(anomaly["recorded_at"], self.start + timedelta(days=11))
+        rolling = data["rolling"]["blood_pressure"]
+        self.assertEqual(len(rolling), 10)
+        self.assertEqual(rolling[-1], {"recorded_at": self.start + timedelta(days=11), "mean": 130.0})
+
+    def test_trend_window(self):
+        # Only the last two readings fall in a one-day window
+        data = self.client.get(self.url, {"trend_days": 1}).data
+        self.assertEqual(data["metrics"]["blood_pressure"]["slope_per_day"], 1.0)
+        self.assertEqual(self.client.get(self.url, {"trend_days": 0}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {"window": "wide"}).status_code, 400)
+
+    def test_cached_until_a_new_reading(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(2):  # the table's and the archive's stamps
+            self.assertEqual(self.client.get(self.url).data["readings"], 12)
+        testing.make_vital(self.patient, recorded_at=self.start - timedelta(days=1))
+        self.assertEqual(self.client.get(self.url).data["readings"], 13)
+
+    def test_requires_access(self):
+        self.client.force_authenticate(testing.make_doctor().user)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"], VITALS_RETENTION_DAYS=365)
+class VitalsArchiveTests(APITestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.base = f"/v1/patients/{self.patient.pk}/vitals"
+        # On the hour, so a reading a few minutes after old[0] shares its hourly bucket
+        now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.old = [now - timedelta(days=500), now - timedelta(days=500, hours=-1), now - timedelta(days=460)]
+        for when, rate in zip(self.old, (61, 62, 63)):
+            testing.make_vital(self.patient, recorded_at=when, heart_rate_bpm=rate)
+        testing.make_vital(self.patient, recorded_at=self.old[2], heart_rate_bpm=64, height_cm=None, weight_kg=None)
+        for hours in (2, 1):
+            testing.make_vital(self.patient, recorded_at=now - timedelta(hours=hours), heart_rate_bpm=70 + hours)
+        self.ids = list(Vital.objects.order_by("-recorded_at", "-id").values_list("id", flat=True))
+        self.client.force_authenticate(self.patient.user)
+
+    def archive(self):
+        call_command("archive_vitals", stdout=StringIO())
+
+    def test_pack_round_trip(self):
+        columns = archive.archived_columns([self.patient.pk])
+        self.assertEqual(len(columns["id"]), 0)
+        self.archive()
+        columns = archive.archived_columns([self.patient.pk])
+        self.assertEqual(list(columns["heart_rate_bpm"]), [61, 62, 63, 64])
+        self.assertTrue(np.isnan(columns["height_cm"][-1]))
+        self.assertEqual(archive.from_micros(columns["recorded_at"][0]), self.old[0])
+
+    def test_moves_old_readings_and_keeps_rollups(self):
+        rollups_before = list(VitalRollup.objects.order_by("period", "start").values())
+        self.archive()
+        self.assertEqual(Vital.objects.count(), 2)
+        self.assertEqual(sorted(VitalArchive.objects.values_list("count", flat=True)), [2, 2])
+        self.assertEqual(list(VitalRollup.objects.order_by("period", "start").values()), rollups_before)
+        rollups.rebuild_all()
+        rebuilt = list(VitalRollup.objects.order_by("period", "start").values())
+        self.assertEqual([{**row, "id": None} for row in rebuilt], [{**row, "id": None} for row in rollups_before])
+
+        # A late reading for an archived month is merged into its blob on the next run
+        late = testing.make_vital(self.patient, recorded_at=self.old[0] + timedelta(minutes=5), heart_rate_bpm=65)
+        late.heart_rate_bpm = 90
+        late.save()  # rebuilds a bucket that is partly archived
+        bucket = VitalRollup.objects.get(patient=self.patient, period="hour",
+                                         start=rollups.bucket_start("hour", self.old[0]))
+        self.assertEqual((bucket.count, bucket.heart_rate_bpm_min, bucket.heart_rate_bpm_max), (2, 61, 90))
+        self.archive()
+        self.assertEqual(sorted(VitalArchive.objects.values_list("count", flat=True)), [2, 3])
+        self.assertEqual(Vital.objects.count(), 2)
+
+    def test_analytics_cache_follows_the_archive(self):
+        url = f"{self.base}/analytics/"
+        self.archive()
+        self.assertEqual(self.client.get(url).data["readings"], 6)
+        # Only the cold tier changes, so the table's stamp alone would serve the cached result
+        VitalArchive.objects.filter(patient=self.patient).order_by("month").first().delete()
+        self.assertEqual(self.client.get(url).data["readings"], 4)
+
+    def test_rebuild_keeps_readings_archived_with_a_shorter_window(self):
+        hour = (timezone.now() - timedelta(days=40)).replace(minute=0, second=0, microsecond=0)
+        for minutes in (5, 10, 15):
+            testing.make_vital(self.patient, recorded_at=hour + timedelta(minutes=minutes), heart_rate_bpm=60 + minutes)
+        call_command("archive_vitals", "--days", "30", stdout=StringIO())
+        self.assertFalse(Vital.objects.filter(recorded_at__lt=hour + timedelta(hours=1)).exists())
+
+        late = testing.make_vital(self.patient, recorded_at=hour + timedelta(minutes=20), heart_rate_bpm=80)
+        late.heart_rate_bpm = 90
+        late.save()
+        bucket = VitalRollup.objects.get(patient=self.patient, period="hour", start=hour)
+        self.assertEqual((bucket.count, bucket.heart_rate_bpm_min, bucket.heart_rate_bpm_max), (4, 65, 90))
+        day = VitalRollup.objects.get(patient=self.patient, period="day", start=rollups.bucket_start("day", hour))
+        self.assertEqual(day.count, 4)
+
+    def test_list_pages_through_both_tiers(self):
+        self.archive()
+        # Pages of 3 split the two archived readings that share a recorded_at
+        for size in (2, 3):
+            seen, url = [], f"{self.base}/?page_size={size}"
+            while url:
+                page = self.client.get(url).data
+                seen += [row["id"] for row in page["results"]]
+                url = page["next"]
+            self.assertEqual(seen, self.ids)
+        since, until = (self.old[0] - timedelta(days=1)).isoformat(), (self.old[2] - timedelta(days=1)).isoformat()
+        response = self.client.get(f"{self.base}/", {"from": since, "to": until})
+        self.assertEqual([row["heart_rate_bpm"] for row in response.data["results"]], [62, 61])
+        response = self.client.get(f"{self.base}/", {"ordering": "recorded_at", "page_size": 3})
+        self.assertEqual([row["id"] for row in response.data["results"]], self.ids[::-1][:3])
+
+    def test_latest_analytics_and_export_read_the_archive(self):
+        Vital.objects.filter(recorded_at__gt=self.old[2]).delete()
+        self.archive()
+        self.assertFalse(Vital.objects.exists())
+        self.assertEqual(self.client.get(f"{self.base}/latest/").data["heart_rate_bpm"], 64)
+        self.assertEqual(self.client.get(f"{self.base}/analytics/").data["metrics"]["heart_rate_bpm"]["count"], 4)
+        response = self.client.get(f"/v1/patients/{self.patient.pk}/export/")
+        records = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(sorted(record["data"]["id"] for record in records if record["type"] == "vital"),
+                         sorted(self.ids[2:]))
+
+    def test_background_job(self):
+        call_command("archive_vitals", "--queue", stdout=StringIO())
+        job = Job.objects.get(kind="archive_vitals")
+        self.assertTrue(run_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress, job.checkpoint["last_patient"]), ("done", 4, self.patient.pk))
+        self.assertEqual(Vital.objects.count(), 2)
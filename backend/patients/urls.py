@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import PatientViewSet, VitalsViewSet, MedicalHistoryViewSet
+from .views import PatientViewSet, VitalsViewSet, VitalRollupViewSet, MedicalHistoryViewSet
 
 # Map HTTP verbs to viewset actions
 patient_list = PatientViewSet.as_view({
@@ -12,6 +12,10 @@ patient_detail = PatientViewSet.as_view({
     'patch': 'partial_update',  # use partial_update, not update
 })
 
+patient_export = PatientViewSet.as_view({
+    'get': 'export',
+})
+
 # Map HTTP verbs to viewset actions
 vital_list = VitalsViewSet.as_view({
     'get': 'list',
@@ -23,6 +27,23 @@ vital_detail = VitalsViewSet.as_view({
     'patch': 'partial_update',  # use partial_update, not update
 })
 
+# Hand-mapped actions don't pick up @action kwargs (the NDJSON parser) on their own
+vital_bulk = VitalsViewSet.as_view({
+    'post': 'bulk',
+}, **VitalsViewSet.bulk.kwargs)
+
+vital_latest = VitalsViewSet.as_view({
+    'get': 'latest',
+})
+
+vital_analytics = VitalsViewSet.as_view({
+    'get': 'analytics',
+})
+
+vital_rollups = VitalRollupViewSet.as_view({
+    'get': 'list',
+})
+
 # Map HTTP verbs to viewset actions
 medical_history_list = MedicalHistoryViewSet.as_view({
     'get': 'list',
@@ -38,8 +59,13 @@ medical_history_detail = MedicalHistoryViewSet.as_view({
 urlpatterns = [
     path('', patient_list, name='patient-list'),
     path('<int:pk>/', patient_detail, name='patient-detail'),
+    path('<int:pk>/export/', patient_export, name='patient-export'),
 
     path('<int:pk>/vitals/', vital_list, name='vital-list'),
+    path('<int:pk>/vitals/bulk/', vital_bulk, name='vital-bulk'),
+    path('<int:pk>/vitals/latest/', vital_latest, name='vital-latest'),
+    path('<int:pk>/vitals/analytics/', vital_analytics, name='vital-analytics'),
+    path('<int:pk>/vitals/rollups/', vital_rollups, name='vital-rollups'),
     path('<int:patient_id>/vitals/<int:pk>/', vital_detail, name='vital-detail'),
 
     path('<int:pk>/medical-histories/', medical_history_list, name='medical-history-list'),
@@ -1,59 +1,146 @@
+from django.http import StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
+from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 from rest_framework.filters import SearchFilter, OrderingFilter
 from .serializers import PatientSerializer, Patient, VitalsSerializer, Vital, MedicalHistorySerializer, MedicalHistory
+from .serializers import VitalRollupSerializer, VitalRollup
+from . import analytics
+from .archive import TieredVitals, latest_archived
+from .ingest import ingest
 from utils.permissions import IsOwnerOrReadOnly
-from doctors.models import AccessRequest
-from families.models import FamilyMember
+from utils.access import accessible_patient_ids, can_access
+from utils.export import export_chunks, ndjson
+from utils.filters import BlindIndexFilter, KeywordSearchFilter, TimeRangeFilter
+from utils.parsers import NDJSONParser
+from utils.views import DecryptionKeysMixin, SparseFieldsetMixin
 
 # Create your views here.
-class PatientViewSet(viewsets.ModelViewSet):
+class PatientViewSet(DecryptionKeysMixin, viewsets.ModelViewSet):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, BlindIndexFilter, SearchFilter, OrderingFilter]
     filterset_fields = ['gender']
     ordering_fields = ['id', 'first_name', 'last_name']
-    search_fields = ['id', 'first_name', 'last_name', 'contact_number', 'aadhar_number']
+    ordering = ['-id']
+    search_fields = ['id', 'first_name', 'last_name']
+    # Encrypted columns: exact match via ?contact_number= / ?aadhar_number=
+    blind_index_fields = Patient.BLIND_INDEX_FIELDS
     permission_classes = [IsAuthenticated, IsOwnerOrReadOnly]
+    query_budget = {
+        'list': 3,
+        'create': 4,
+        'retrieve': 3,
+        'partial_update': 4,
+        'export': 11,
+    }
+
+    @action(detail=True, methods=["get"])
+    def export(self, request, pk=None):
+        """
+        Stream the patient's whole chart as NDJSON (see utils.export), for
+        referrals and data-portability requests. Same access rules as the
+        record viewsets: the patient, their family head or an approved doctor.
+        """
+        if not can_access(request.user, [pk]):
+            raise PermissionDenied("You do not have access to this patient's records.")
+        response = StreamingHttpResponse(ndjson(export_chunks([int(pk)])), content_type="application/x-ndjson")
+        response["Content-Disposition"] = f'attachment; filename="patient-{pk}.ndjson"'
+        return response
 
 
 class VitalsViewSet(viewsets.ModelViewSet):
+    """
+    A patient's vitals time series. ?from=&to= select a range of
+    recorded_at; /latest/ is the newest reading and /analytics/ the derived
+    figures (patients.analytics).
+    """
     serializer_class = VitalsSerializer
     queryset = Vital.objects.all()
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, TimeRangeFilter, SearchFilter, OrderingFilter]
     filterset_fields = ['patient']
-    ordering_fields = ['id', 'patient__first_name', 'patient__last_name']
+    time_range_field = 'recorded_at'
+    ordering_fields = ['id', 'recorded_at', 'patient__first_name', 'patient__last_name']
+    ordering = ['-recorded_at', '-id']
     search_fields = ['id']
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 3,
+        'latest': 2,
+        'analytics': 6,
+        'create': 7,
+        'bulk': 7,
+        'retrieve': 2,
+        'partial_update': 8,
+    }
     
     def get_queryset(self):
         """
-        Normal users see only their own record.
-        Doctors can see access request approved patient's vitals.
-        Family Heads can see their family members' vitals.
+        Readings of the patient in the URL, for the patient themselves, their
+        family head or a doctor with an approved access request.
         """
-        user = self.request.user
-        if user.role == 'patient':
-            # Family head can see vitals for patients they have approved access to
-            approved_patient_ids = FamilyMember.objects.filter(
-                family__head_of_family=user.linked_patient, is_verified=True
-            ).values_list('patient_id', flat=True)
+        patient_id = self.kwargs.get("pk")
+        if not can_access(self.request.user, [patient_id]):
+            return Vital.objects.none()
+        return Vital.objects.filter(patient_id=patient_id)
 
-            patient_id = user.linked_patient.id
-            approved_patient_ids = list(approved_patient_ids) + [patient_id]
+    def filter_queryset(self, queryset):
+        """
+        Listings continue into the archive: after the filterset, the rows are
+        wrapped in TieredVitals so the time range, ordering and cursor apply
+        to both tiers. ?search=, ?patient= and ordering by the patient's name
+        cover the table only.
+        """
+        params = self.request.query_params
+        tiered = self.action == "list" and "search" not in params and "patient" not in params \
+            and "patient__" not in params.get("ordering", "") \
+            and can_access(self.request.user, [self.kwargs.get("pk")])
+        for backend in self.filter_backends:
+            if tiered and backend is TimeRangeFilter:
+                queryset = TieredVitals(queryset, int(self.kwargs["pk"]))
+            queryset = backend().filter_queryset(self.request, queryset, self)
+        return queryset
 
-            return self.queryset.filter(patient_id__in=approved_patient_ids)
-        elif user.role == 'doctor':
-            patient_id = self.kwargs.get("pk")
-            access_requests = AccessRequest.objects.filter(doctor__user=user, patient__id=patient_id,
-                                                            is_approved=True)
-            if not access_requests.exists():
-                return Vital.objects.none()
-            return Vital.objects.filter(patient__id=patient_id)
-        else:
-            return Vital.objects.none()
+    @action(detail=False, methods=["post"], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request, pk=None):
+        """
+        Device uploads: a JSON array or an NDJSON stream of readings, each
+        optionally with its own recorded_at. Valid rows are stored and
+        invalid ones are listed in "errors" by their position in the upload.
+        """
+        if not can_access(request.user, [pk]):
+            raise PermissionDenied("You do not have access to this patient's vitals.")
+        if isinstance(request.data, dict):
+            raise ValidationError({"detail": "Expected a list of readings."})
+        created, errors = ingest(int(pk), request.data)
+        code = status.HTTP_400_BAD_REQUEST if errors and not created else status.HTTP_201_CREATED
+        return Response({"created": created, "errors": errors}, status=code)
+
+    @action(detail=False, methods=["get"])
+    def analytics(self, request, pk=None):
+        """
+        Latest BMI, per-metric statistics, trend slopes over the last
+        ?trend_days= days, ?window=-reading rolling means of heart rate and
+        blood pressure, and the most recent anomalous readings.
+        """
+        if not can_access(request.user, [pk]):
+            raise PermissionDenied("You do not have access to this patient's vitals.")
+        window, trend_days = analytics.parse_params(request.query_params)
+        return Response(analytics.cached("patient", [int(pk)], (window, trend_days),
+                                         lambda: analytics.patient_analytics(int(pk), window, trend_days)))
+
+    @action(detail=False, methods=["get"])
+    def latest(self, request, pk=None):
+        vital = self.get_queryset().order_by("-recorded_at", "-id").first()
+        if vital is None and can_access(request.user, [pk]):
+            vital = latest_archived(int(pk))
+        if vital is None:
+            raise NotFound("No vitals recorded for this patient.")
+        return Response(self.get_serializer(vital).data)
         
     def get_object(self):
         """
@@ -62,6 +149,8 @@ class VitalsViewSet(viewsets.ModelViewSet):
         """
         patient_id = self.kwargs.get("patient_id")
         vital_id = self.kwargs.get("pk")
+        if not can_access(self.request.user, [patient_id]):
+            raise PermissionDenied("Vital records not found.")
         try:
             return Vital.objects.get(pk=vital_id, patient_id=patient_id)
         except Vital.DoesNotExist:
@@ -73,11 +162,6 @@ class VitalsViewSet(viewsets.ModelViewSet):
         if user.role != 'patient':
             raise PermissionDenied("Only patients are allowed to create vital records.")
 
-        # Check if vital record already exists for this patient
-        patient_id = self.kwargs.get("pk")
-        if Vital.objects.filter(patient_id=patient_id).exists():
-            raise ValidationError({"detail": "Vital records already exists for this patient."})
-            
         serializer.save(patient=user.linked_patient)
 
     def perform_update(self, serializer):
@@ -87,15 +171,11 @@ class VitalsViewSet(viewsets.ModelViewSet):
         - doctor to update access request approved patient's vitals
         """
         user = self.request.user
-        vital = self.get_object()  # current vital being updated
+        vital = serializer.instance  # current vital being updated
 
         # Doctor can update access request approved patient's vitals
         if user.role == "doctor":
-            patient_id = self.kwargs.get("patient_id")
-            print(patient_id)
-            access_requests = AccessRequest.objects.filter(doctor__user=user, patient__id=patient_id,
-                                                            is_approved=True)
-            if access_requests.exists():
+            if can_access(user, [vital.patient_id]):
                 serializer.save()
                 return
             else:
@@ -103,7 +183,7 @@ class VitalsViewSet(viewsets.ModelViewSet):
 
         # Patient can only update their own vitals
         if user.role == "patient":
-            if vital.patient == user.linked_patient:
+            if vital.patient_id == user.linked_patient_id:
                 serializer.save()
                 return
             else:
@@ -113,14 +193,45 @@ class VitalsViewSet(viewsets.ModelViewSet):
         raise PermissionDenied("You are not allowed to update vitals.")
 
 
-class MedicalHistoryViewSet(viewsets.ModelViewSet):
+class VitalRollupViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Hourly or daily vitals summaries (?period=hour|day, default day) for
+    charts over long ranges; ?from=&to= select bucket starts.
+    """
+    serializer_class = VitalRollupSerializer
+    filter_backends = [TimeRangeFilter]
+    time_range_field = 'start'
+    ordering = ['start']
+    permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 2,
+    }
+
+    def get_queryset(self):
+        patient_id = self.kwargs.get("pk")
+        period = self.request.query_params.get("period", "day")
+        if period not in dict(VitalRollup.PERIOD_CHOICES):
+            raise ValidationError({"period": "Use 'hour' or 'day'."})
+        if not can_access(self.request.user, [patient_id]):
+            return VitalRollup.objects.none()
+        return VitalRollup.objects.filter(patient_id=patient_id, period=period)
+
+
+class MedicalHistoryViewSet(SparseFieldsetMixin, DecryptionKeysMixin, viewsets.ModelViewSet):
     serializer_class = MedicalHistorySerializer
     queryset = MedicalHistory.objects.all()
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, KeywordSearchFilter, OrderingFilter]
     filterset_fields = ['patient']
-    ordering_fields = ['id', 'patient__first_name', 'patient__last_name']
-    search_fields = ['id']
+    ordering_fields = ['id', 'event_date', 'patient__first_name', 'patient__last_name']
+    ordering = ['-event_date', '-id']
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 3,
+        'create': 8,
+        'retrieve': 2,
+        'partial_update': 7,
+        'destroy': 5,
+    }
 
     def get_queryset(self):
         """
@@ -130,20 +241,11 @@ class MedicalHistoryViewSet(viewsets.ModelViewSet):
         """
         user = self.request.user
         if user.role == 'patient':
-            # Family head can see vitals for patients they have approved access to
-            approved_patient_ids = FamilyMember.objects.filter(
-                family__head_of_family=user.linked_patient, is_verified=True
-            ).values_list('patient_id', flat=True)
-
-            patient_id = user.linked_patient.id
-            approved_patient_ids = list(approved_patient_ids) + [patient_id]
-
-            return self.queryset.filter(patient_id__in=approved_patient_ids)
+            # Own records plus verified family members' when the user heads a family
+            return self.queryset.filter(patient_id__in=accessible_patient_ids(user))
         elif user.role == 'doctor':
             patient_id = self.kwargs.get("pk")
-            access_requests = AccessRequest.objects.filter(doctor__user=user, patient__id=patient_id,
-                                                            is_approved=True)
-            if not access_requests.exists():
+            if not can_access(user, [patient_id]):
                 return MedicalHistory.objects.none()
             return MedicalHistory.objects.filter(patient__id=patient_id)
         else:
@@ -156,8 +258,10 @@ class MedicalHistoryViewSet(viewsets.ModelViewSet):
         """
         patient_id = self.kwargs.get("patient_id")
         history_id = self.kwargs.get("pk")
+        if not can_access(self.request.user, [patient_id]):
+            raise PermissionDenied("Medical History records not found.")
         try:
-            return MedicalHistory.objects.get(pk=history_id, patient_id=patient_id)
+            return MedicalHistory.objects.select_related("patient__user").get(pk=history_id, patient_id=patient_id)
         except MedicalHistory.DoesNotExist:
             raise PermissionDenied("Medical History records not found.")
 
@@ -175,11 +279,11 @@ class MedicalHistoryViewSet(viewsets.ModelViewSet):
         - patient to update their own medical histories
         """
         user = self.request.user
-        vital = self.get_object()  # current vital being updated
+        vital = serializer.instance  # current vital being updated
 
         # Patient can only update their own vitals
         if user.role == "patient":
-            if vital.patient == user.linked_patient:
+            if vital.patient_id == user.linked_patient_id:
                 serializer.save()
                 return
             else:
@@ -198,7 +302,7 @@ class MedicalHistoryViewSet(viewsets.ModelViewSet):
         patient = user.patient_profile
 
         # Only the patient who created the medical history can delete it
-        if instance.patient != patient:
+        if instance.patient_id != patient.pk:
             raise PermissionDenied("You can only delete medical history you have created.")
 
         # If all checks pass, delete
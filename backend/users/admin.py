@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group
 from .models import CustomUser
@@ -10,6 +10,7 @@ class CustomUserAdmin(UserAdmin):
     list_filter = ("role", "is_active", "is_staff")
     ordering = ("email",)
     search_fields = ("email",)
+    actions = ["rotate_data_key"]
 
     fieldsets = (
         ('Login Credentials', {'fields': ('email', 'password')}),
@@ -20,6 +21,14 @@ class CustomUserAdmin(UserAdmin):
         ('Other Details', {'fields': ('date_joined', 'role', 'is_active', 'is_staff')})
     )
 
+    @admin.action(description="Rotate data key and re-encrypt records")
+    def rotate_data_key(self, request, queryset):
+        for user in queryset:
+            try:
+                user.rotate_user_key(requested_by=request.user)
+            except ValueError as e:
+                self.message_user(request, f"{user.email}: {e}", messages.WARNING)
+
 # Unregister the Group model from the admin site
 admin.site.unregister(Group)
 
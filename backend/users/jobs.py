@@ -0,0 +1,153 @@
+# users/jobs.py
+import logging
+from itertools import islice
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from jobs.registry import register
+from utils.encryption import DECRYPTION_ERROR, AESCipher, key_version_of, search_tokens
+from utils.keyring import user_keyring
+from .models import CustomUser
+
+logger = logging.getLogger(__name__)
+
+REENCRYPT_BATCH_SIZE = 200
+# Every model whose ENCRYPTED_FIELDS are sealed with a user's key
+REENCRYPTED_MODELS = ["patients.Patient", "patients.MedicalHistory", "doctors.Encounter", "doctors.ClinicalNote"]
+
+PURGE_BATCH_SIZE = 500
+# Rows belonging to other users' charts that point at the user: kept, with the reference cleared
+PURGE_DETACH_PLAN = [
+    ("doctors.Encounter", "doctor__user", "doctor"),
+]
+# Bulky rows under a user, leaves first; deleting the user cascades to the rest
+PURGE_PLAN = [
+    ("doctors.ClinicalNote", "encounter__patient__user"),
+    ("doctors.Encounter", "patient__user"),
+    ("patients.MedicalHistory", "patient__user"),
+    ("patients.Vital", "patient__user"),
+    ("patients.VitalArchive", "patient__user"),
+    ("patients.SearchToken", "user"),
+]
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+@register("reencrypt_user_data")
+def reencrypt_user_data(job):
+    """
+    Re-encrypt everything a user owns under their current key after
+    rotate_user_key(), then forget the retired key. Rows are streamed by
+    primary key; the checkpoint records the model index and last pk done.
+    A final sweep catches values written under the retired key meanwhile.
+    """
+    user = CustomUser.objects.get(pk=job.params["user_id"])
+    if not user.previous_user_key:
+        return
+    key = user.get_user_key()
+    cipher = AESCipher(key)
+    start = job.checkpoint.get("model", 0)
+    for index, label in enumerate(REENCRYPTED_MODELS[start:], start):
+        model = apps.get_model(label)
+        last_pk = job.checkpoint.get("last_pk", 0) if index == start else 0
+        pks = (model.objects.filter(**{model.KEY_OWNER: user}, pk__gt=last_pk)
+               .order_by("pk").values_list("pk", flat=True).iterator(chunk_size=REENCRYPT_BATCH_SIZE))
+        for batch in _batched(pks, REENCRYPT_BATCH_SIZE):
+            rewritten = _reencrypt_batch(model, batch, cipher, key, user.pk)
+            job.save_checkpoint(progress=job.progress + rewritten, model=index, last_pk=batch[-1])
+        job.save_checkpoint(model=index + 1, last_pk=0)
+
+    # A save holding a pre-rotation user instance can seal values under the
+    # retired version after their batch was passed; rewrite those until a
+    # sweep finds none, so dropping the old key can't strand them
+    while swept := _sweep_stale(user, cipher, key):
+        job.save_checkpoint(progress=job.progress + swept)
+
+    # A newer rotation started meanwhile keeps its own previous key
+    CustomUser.objects.filter(pk=user.pk, user_key_version=key.version).update(previous_user_key=None)
+    user_keyring.invalidate(user.pk)
+
+
+def _sweep_stale(user, cipher, key):
+    # Re-encrypt only the rows holding a value not sealed under the current version; returns rows rewritten
+    rewritten = 0
+    for label in REENCRYPTED_MODELS:
+        model = apps.get_model(label)
+        rows = (model.objects.filter(**{model.KEY_OWNER: user}).order_by("pk")
+                .values_list("pk", *model.ENCRYPTED_FIELDS).iterator(chunk_size=REENCRYPT_BATCH_SIZE))
+        stale = (row[0] for row in rows if any(value and key_version_of(value) != key.version for value in row[1:]))
+        for batch in _batched(stale, REENCRYPT_BATCH_SIZE):
+            rewritten += _reencrypt_batch(model, batch, cipher, key, user.pk)
+    return rewritten
+
+
+def _reencrypt_batch(model, pks, cipher, key, owner_id):
+    # Lock the rows so a concurrent save can't be overwritten with older plaintext
+    fields = model.ENCRYPTED_FIELDS
+    with transaction.atomic():
+        rows = list(model.objects.select_for_update().filter(pk__in=pks))
+        stale = [(obj, field) for obj in rows for field in fields
+                 if getattr(obj, field) and key_version_of(getattr(obj, field)) != key.version]
+        plaintexts = cipher.decrypt_many([getattr(obj, field) for obj, field in stale], errors="replace")
+        readable = [(obj, field, text) for (obj, field), text in zip(stale, plaintexts) if text != DECRYPTION_ERROR]
+        if len(readable) < len(stale):
+            logger.warning("%s: %d value(s) could not be decrypted and were left as they are",
+                           model.__name__, len(stale) - len(readable))
+        ciphertexts = cipher.encrypt_many([text for _, _, text in readable])
+        for (obj, field, _), ciphertext in zip(readable, ciphertexts):
+            setattr(obj, field, ciphertext)
+        changed = list({obj.pk: obj for obj, _, _ in readable}.values())
+        if changed:
+            model.objects.bulk_update(changed, fields)
+        if model.SEARCH_FIELDS:
+            _reindex(model, rows, key, owner_id)
+    return len(changed)
+
+
+def _reindex(model, rows, key, owner_id):
+    # Search tokens are derived from the user key, so they are rebuilt too
+    SearchToken = model.search_tokens.field.related_model
+    content_type = ContentType.objects.get_for_model(model)
+    SearchToken.objects.filter(content_type=content_type, object_id__in=[obj.pk for obj in rows]).delete()
+    tokens = []
+    for obj in rows:
+        obj.attach_user_key(key)
+        tokens += [SearchToken(user_id=owner_id, content_type=content_type, object_id=obj.pk, token=token)
+                   for token in search_tokens(key, obj.search_keywords()).values()]
+    SearchToken.objects.bulk_create(tokens)
+
+
+@register("purge_user")
+def purge_user(job):
+    """
+    Delete a shredded user's rows in small batches so no single transaction
+    holds locks for long, then the user itself. A doctor's encounters stay
+    in their patients' charts with the doctor cleared. Processed rows never
+    match again, so a rerun simply continues; the checkpoint counts rows per
+    model.
+    """
+    user_id = job.params["user_id"]
+    detached = job.checkpoint.get("detached", {})
+    for label, lookup, field in PURGE_DETACH_PLAN:
+        model = apps.get_model(label)
+        queryset = model.objects.filter(**{f"{lookup}_id": user_id})
+        while pks := list(queryset.values_list("pk", flat=True)[:PURGE_BATCH_SIZE]):
+            model.objects.filter(pk__in=pks).update(**{field: None})
+            detached[label] = detached.get(label, 0) + len(pks)
+            job.save_checkpoint(progress=job.progress + len(pks), detached=detached)
+
+    deleted = job.checkpoint.get("deleted", {})
+    for label, lookup in PURGE_PLAN:
+        model = apps.get_model(label)
+        queryset = model.objects.filter(**{f"{lookup}_id": user_id})
+        while pks := list(queryset.values_list("pk", flat=True)[:PURGE_BATCH_SIZE]):
+            model.objects.filter(pk__in=pks).delete()
+            deleted[label] = deleted.get(label, 0) + len(pks)
+            job.save_checkpoint(progress=job.progress + len(pks), deleted=deleted)
+    _, counts = CustomUser.objects.filter(pk=user_id).delete()
+    job.save_checkpoint(progress=job.progress + sum(counts.values()), deleted={**deleted, "cascade": counts})
@@ -0,0 +1,57 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from users.models import CustomUser
+from utils.keyring import current_master_key_id, master_fernet
+
+
+class Command(BaseCommand):
+    help = ("Re-wrap every user key with the newest MASTER_KEYS entry. Safe to run while "
+            "serving traffic and to interrupt: rows already on the newest key are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--sleep", type=float, default=0.5,
+                            help="Seconds to pause between batches (default 0.5)")
+        parser.add_argument("--limit", type=int, help="Stop after re-wrapping this many keys")
+        parser.add_argument("--dry-run", action="store_true", help="Only report how many keys need re-wrapping")
+
+    def handle(self, *args, **options):
+        current = current_master_key_id()
+        fernet = master_fernet()
+        pending = CustomUser.objects.filter(user_key__isnull=False).exclude(master_key_id=current)
+        total = pending.count()
+        self.stdout.write(f"{total} user key(s) to re-wrap with master key {current}")
+        if options["dry_run"] or not total:
+            return
+
+        done = skipped = 0
+        last_id = 0
+        while options["limit"] is None or done < options["limit"]:
+            size = options["batch_size"]
+            if options["limit"] is not None:
+                size = min(size, options["limit"] - done)
+            # Keyset pagination on id keeps every batch an index range scan
+            batch = list(pending.filter(id__gt=last_id).order_by("id")
+                         .values_list("id", "user_key", "previous_user_key")[:size])
+            if not batch:
+                break
+            with transaction.atomic():
+                for user_id, wrapped, previous in batch:
+                    rewrapped = fernet.rotate(wrapped.encode()).decode()
+                    # A retired data key still being re-encrypted away is re-wrapped too
+                    previous_rewrapped = fernet.rotate(previous.encode()).decode() if previous else None
+                    # Only replace the values we read, so a key regenerated meanwhile is kept
+                    updated = CustomUser.objects.filter(id=user_id, user_key=wrapped, previous_user_key=previous).update(
+                        user_key=rewrapped, previous_user_key=previous_rewrapped, master_key_id=current)
+                    done += updated
+                    skipped += 1 - updated
+            last_id = batch[-1][0]
+            self.stdout.write(f"Re-wrapped {done}/{total} (checkpoint: id {last_id})")
+            if len(batch) < size:
+                break
+            time.sleep(options["sleep"])
+
+        remaining = pending.count()
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {done} re-wrapped, {skipped} changed concurrently, {remaining} still on an older key"))
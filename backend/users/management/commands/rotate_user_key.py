@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = ("Give users a fresh data key and queue re-encryption of their records "
+            "(processed by `manage.py run_jobs`)")
+
+    def add_arguments(self, parser):
+        parser.add_argument("users", nargs="+", help="User ids or emails")
+
+    def handle(self, *args, **options):
+        ids = [value for value in options["users"] if value.isdigit()]
+        emails = [value for value in options["users"] if not value.isdigit()]
+        users = list(CustomUser.objects.filter(Q(pk__in=ids) | Q(email__in=emails)))
+        if len(users) != len(options["users"]):
+            found = {str(user.pk) for user in users} | {user.email for user in users}
+            raise CommandError(f"Unknown users: {', '.join(set(options['users']) - found)}")
+        for user in users:
+            try:
+                job = user.rotate_user_key()
+            except ValueError as e:
+                self.stderr.write(f"{user.email}: {e}")
+                continue
+            self.stdout.write(f"{user.email}: now on key version {user.user_key_version}, queued job {job.pk}")
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:35
+
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def record_master_key_id(apps, schema_editor):
+    # Every existing user key was wrapped with the single MASTER_KEY
+    CustomUser = apps.get_model("users", "CustomUser")
+    key_id = hashlib.sha256(settings.MASTER_KEY.encode()).hexdigest()[:16]
+    CustomUser.objects.filter(user_key__isnull=False).update(master_key_id=key_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_rename_expires_at_customuser_otp_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='master_key_id',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=16, null=True),
+        ),
+        migrations.RunPython(record_master_key_id, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_customuser_master_key_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='previous_user_key',
+            field=models.CharField(blank=True, editable=False, max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='user_key_version',
+            field=models.PositiveSmallIntegerField(default=1, editable=False),
+        ),
+    ]
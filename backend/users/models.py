@@ -1,12 +1,16 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import RegexValidator
 from django.contrib.auth.base_user import BaseUserManager
-from cryptography.fernet import Fernet
-from django.conf import settings
 from patients.models import Patient
-from doctors.models import Doctor
+from utils.encryption import MAX_KEY_VERSION, DataKey
+from utils.instrumentation import timed
+from utils.keyring import current_master_key_id, master_fernet, user_keyring
+from jobs.models import Job
+from doctors.models import AccessRequest, Doctor
+from families.models import FamilyMember
+from utils import access
 import base64
 import os
 import random
@@ -56,6 +60,11 @@ class CustomUser(AbstractUser):
     ]
     role = models.CharField(max_length=20, choices=ROLE_CHOICES, null=True, blank=True)
     user_key = models.CharField(max_length=256, editable=False, unique=True, blank=True, null=True)
+    # Fingerprint of the master key that wrapped user_key (see rotate_master_key)
+    master_key_id = models.CharField(max_length=16, editable=False, blank=True, null=True, db_index=True)
+    # Bumped by rotate_user_key(); the old key is kept until every row is re-encrypted
+    user_key_version = models.PositiveSmallIntegerField(default=1, editable=False)
+    previous_user_key = models.CharField(max_length=256, editable=False, blank=True, null=True)
     linked_patient = models.ForeignKey(Patient, on_delete=models.SET_NULL, null=True, blank=True)
     linked_doctor = models.ForeignKey(Doctor, on_delete=models.SET_NULL, null=True, blank=True)
     otp = models.CharField(max_length=6, blank=True, null=True)
@@ -65,17 +74,80 @@ class CustomUser(AbstractUser):
     def generate_user_key(self):
         # Generate a 32-byte AES key and store it encrypted
         user_key = os.urandom(32)
-        f = Fernet(settings.MASTER_KEY.encode())
-        encrypted = f.encrypt(base64.b64encode(user_key))
+        with timed("fernet"):
+            encrypted = master_fernet().encrypt(base64.b64encode(user_key))
         self.user_key = encrypted.decode()
+        self.master_key_id = current_master_key_id()
+        if self.pk:
+            user_keyring.invalidate(self.pk)
         return user_key
 
+    def rotate_user_key(self, requested_by=None):
+        """
+        Switch the user to a fresh AES key and queue the job that re-encrypts
+        their records. Until it finishes, values under the old key still decrypt.
+        """
+        if self.previous_user_key:
+            raise ValueError("A key rotation is already in progress for this user.")
+        # Re-wrap under the current master key so rotate_master_key can skip this row
+        self.previous_user_key = master_fernet().rotate(self.user_key.encode()).decode()
+        self.generate_user_key()
+        self.user_key_version = self.user_key_version % MAX_KEY_VERSION + 1
+        self.save(update_fields=["user_key", "master_key_id", "user_key_version", "previous_user_key"])
+        return Job.enqueue("reencrypt_user_data", created_by=requested_by, user_id=self.pk)
+
+    def shred(self):
+        """
+        Crypto-shred the account: drop the wrapped keys so everything sealed
+        with them is unreadable at once, revoke every grant on the user's
+        patient records, deactivate the user and queue the batched purge of
+        their rows.
+        """
+        patient_ids = list(Patient.objects.filter(user=self).values_list("pk", flat=True))
+        with transaction.atomic():
+            CustomUser.objects.filter(pk=self.pk).update(
+                user_key=None, previous_user_key=None, master_key_id=None, is_active=False)
+            # Blind indexes are keyed globally, so they would still link the record to an Aadhar number
+            Patient.objects.filter(pk__in=patient_ids).update(contact_number_index=None, aadhar_number_index=None)
+            # Nobody may keep writing to the chart once there is no key left to seal it with
+            grants = AccessRequest.objects.filter(patient_id__in=patient_ids)
+            doctor_ids = set(grants.values_list("doctor_id", flat=True))
+            grants.delete()
+            memberships = FamilyMember.objects.filter(patient_id__in=patient_ids, is_verified=True)
+            head_ids = set(memberships.values_list("family__head_of_family_id", flat=True))
+            memberships.update(is_verified=False)
+            job = Job.enqueue("purge_user", user_id=self.pk)
+        user_keyring.invalidate(self.pk)
+        # After commit too, so a request racing the transaction can't have re-cached the old grants
+        access.invalidate("doctor", *doctor_ids)
+        access.invalidate("patient", *head_ids, *patient_ids)
+        self.user_key = self.previous_user_key = self.master_key_id = None
+        self.is_active = False
+        return job
+
+    @property
+    def previous_key_version(self):
+        return (self.user_key_version - 2) % MAX_KEY_VERSION + 1
+
     def get_user_key(self):
-        # Decrypt and return the user's AES key
+        # Return the user's AES key as a DataKey, unwrapping it at most once per worker
         if not self.user_key:
             return None
-        f = Fernet(settings.MASTER_KEY.encode())
-        decrypted = f.decrypt(self.user_key.encode())
+        wrapped = (self.user_key, self.user_key_version, self.previous_user_key)
+        if not self.pk:
+            return self._unwrap_data_key(wrapped)
+        return user_keyring.get(self.pk, wrapped, self._unwrap_data_key)
+
+    def _unwrap_data_key(self, wrapped):
+        user_key, version, previous = wrapped
+        retired = {self.previous_key_version: self._unwrap_user_key(previous)} if previous else {}
+        return DataKey(self._unwrap_user_key(user_key), version, retired)
+
+    @staticmethod
+    def _unwrap_user_key(wrapped):
+        # Decrypt the Fernet-wrapped user key with any configured master key
+        with timed("fernet"):
+            decrypted = master_fernet().decrypt(wrapped.encode())
         return base64.b64decode(decrypted)
     
     def generate_otp(self):
@@ -97,6 +169,8 @@ class CustomUser(AbstractUser):
     # Auth setup
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = []
+    # Columns get_user_key() reads; use with .only() when loading key owners in bulk
+    KEY_FIELDS = ["id", "user_key", "user_key_version", "previous_user_key"]
 
     objects = CustomUserManager()
 
@@ -0,0 +1,9 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from utils.keyring import user_keyring
+from .models import CustomUser
+
+@receiver(post_delete, sender=CustomUser)
+def drop_cached_user_key(sender, instance, **kwargs):
+    # Never keep key material around for a deleted user
+    user_keyring.invalidate(instance.pk)
@@ -1,3 +1,328 @@
-from django.test import TestCase
+from io import StringIO
+from unittest.mock import patch
 
-# Create your tests here.
+from cryptography.fernet import Fernet, InvalidToken
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from doctors.models import ClinicalNote, Doctor, Encounter
+from jobs.models import Job
+from jobs.worker import run_job
+from patients.models import MedicalHistory, Patient, SearchToken, Vital
+from users import jobs
+from users.models import CustomUser
+from utils import testing
+from utils.access import can_access
+from utils.encryption import key_version_of
+from utils.keyring import master_key_id, user_keyring
+
+
+class UserQueryBudgetTests(testing.QueryBudgetTestCase):
+    urlconf = "users.urls"
+
+    def setUp(self):
+        self.user = testing.make_user("patient")
+        self.login(self.user)
+
+    def grow_users(self, n):
+        for _ in range(n):
+            testing.make_user("patient")
+
+    def anonymous(self):
+        self.login(None)
+        return ()
+
+    def new_unverified_user(self):
+        self.login(None)
+        user = testing.make_user("patient", is_active=False, is_verified=False)
+        user.generate_otp()
+        return (user,)
+
+    def new_user(self):
+        user = testing.make_user("patient")
+        self.login(user)
+        return ()
+
+    def budget_cases(self):
+        refresh_token = str(RefreshToken.for_user(self.user))
+        return {
+            ("login/", "post"): {
+                "setup": self.anonymous,
+                "request": lambda: self.client.post("/v1/users/login/", {
+                    "email": self.user.email, "password": testing.PASSWORD}, format="json"),
+                "grow": self.grow_users,
+            },
+            ("token/refresh/", "post"): {
+                "setup": self.anonymous,
+                "request": lambda: self.client.post("/v1/users/token/refresh/", {
+                    "refresh_token": refresh_token}, format="json"),
+                "grow": self.grow_users,
+            },
+            ("", "get"): {"request": lambda: self.client.get("/v1/users/"), "grow": self.grow_users},
+            ("", "post"): {
+                "setup": self.anonymous,
+                "request": lambda: self.client.post("/v1/users/", {
+                    "email": testing.unique_email(),
+                    "password": testing.PASSWORD, "role": "patient"}, format="json"),
+                "grow": self.grow_users,
+            },
+            ("<int:pk>/verify-otp/", "post"): {
+                "setup": self.new_unverified_user,
+                "request": lambda user: self.client.post(f"/v1/users/{user.pk}/verify-otp/", {
+                    "otp": user.otp}, format="json"),
+                "grow": self.grow_users,
+            },
+            ("<int:pk>/resend-otp/", "post"): {
+                "setup": lambda: (testing.make_user("patient", is_active=False, is_verified=False),),
+                "request": lambda user: self.client.post(f"/v1/users/{user.pk}/resend-otp/"),
+                "grow": self.grow_users,
+            },
+            ("my-account/", "get"): {"request": lambda: self.client.get("/v1/users/my-account/"), "grow": self.grow_users},
+            ("my-account/", "patch"): {
+                "request": lambda: self.client.patch("/v1/users/my-account/", {
+                    "password": testing.PASSWORD}, format="json"),
+                "grow": self.grow_users,
+            },
+            ("my-account/", "delete"): {
+                "setup": self.new_user,
+                "request": lambda: self.client.delete("/v1/users/my-account/"),
+                "grow": self.grow_users,
+            },
+        }
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class UserKeyCacheTests(TestCase):
+    def setUp(self):
+        user_keyring.clear()
+        self.addCleanup(user_keyring.clear)
+        self.user = testing.make_patient().user
+
+    def test_cached_per_worker(self):
+        key = self.user.get_user_key()
+        with patch.object(CustomUser, "_unwrap_user_key") as unwrap:
+            self.assertEqual(CustomUser.objects.get(pk=self.user.pk).get_user_key(), key)
+        unwrap.assert_not_called()
+
+    def test_regenerated_key_is_not_served_stale(self):
+        old = self.user.get_user_key()
+        self.assertNotEqual(self.user.generate_user_key(), old)
+        self.assertNotIn(self.user.pk, user_keyring._entries)
+        self.user.save()
+        self.assertNotEqual(CustomUser.objects.get(pk=self.user.pk).get_user_key(), old)
+
+    def test_deleted_user_is_dropped(self):
+        self.user.get_user_key()
+        self.assertIn(self.user.pk, user_keyring._entries)
+        pk = self.user.pk
+        self.user.delete()
+        self.assertNotIn(pk, user_keyring._entries)
+
+
+class MasterKeyRotationTests(TestCase):
+    def setUp(self):
+        self.old, self.new = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+        user_keyring.clear()
+        self.addCleanup(user_keyring.clear)
+        with self.settings(MASTER_KEYS=[self.old]):
+            self.patients = [testing.make_patient() for _ in range(3)]
+            # Mid user-key rotation: its retired key is wrapped under the old master key too
+            self.patients[0].user.rotate_user_key()
+            self.contacts = [patient.contact_number_decrypted for patient in self.patients]
+
+    def contacts_now(self):
+        user_keyring.clear()
+        return [Patient.objects.get(pk=patient.pk).contact_number_decrypted for patient in self.patients]
+
+    def rotate(self, *args):
+        out = StringIO()
+        call_command("rotate_master_key", "--sleep", "0", *args, stdout=out)
+        return out.getvalue()
+
+    def test_reads_keys_wrapped_under_an_older_master_key(self):
+        with self.settings(MASTER_KEYS=[self.new, self.old]):
+            self.assertEqual(self.contacts_now(), self.contacts)
+        # Dropping the old master key before rotate_master_key has run loses the user keys
+        with self.settings(MASTER_KEYS=[self.new]), self.assertRaises(InvalidToken):
+            self.contacts_now()
+
+    def test_rewraps_user_keys(self):
+        wrapped = dict(CustomUser.objects.values_list("pk", "user_key"))
+        with self.settings(MASTER_KEYS=[self.new, self.old]):
+            self.assertIn("3 user key(s) to re-wrap", self.rotate("--dry-run"))
+            self.assertEqual(dict(CustomUser.objects.values_list("pk", "user_key")), wrapped)
+            output = self.rotate("--batch-size", "2")
+            self.assertIn("Done: 3 re-wrapped, 0 changed concurrently, 0 still on an older key", output)
+            self.assertIn("0 user key(s) to re-wrap", self.rotate())
+        users = CustomUser.objects.filter(pk__in=wrapped)
+        self.assertEqual(set(users.values_list("master_key_id", flat=True)), {master_key_id(self.new)})
+        self.assertFalse(set(users.values_list("user_key", flat=True)) & set(wrapped.values()))
+        # The old master key can go; the retired user key still opens values sealed under it
+        with self.settings(MASTER_KEYS=[self.new]):
+            self.assertEqual(self.contacts_now(), self.contacts)
+            self.assertEqual(CustomUser.objects.get(pk=self.patients[0].user.pk).get_user_key().retired.keys(), {1})
+
+
+class UserKeyRotationTests(APITestCase):
+    def setUp(self):
+        user_keyring.clear()
+        self.patient = testing.make_patient()
+        self.user = self.patient.user
+        self.histories = [testing.make_history(self.patient) for _ in range(3)]
+        self.note = testing.make_note(testing.make_encounter(self.patient, testing.make_doctor()))
+
+    def sealed_versions(self):
+        values = [self.patient_row().aadhar_number]
+        values += [history.notes for history in MedicalHistory.objects.all()]
+        values += [note.plan for note in ClinicalNote.objects.all()]
+        return {key_version_of(value) for value in values}
+
+    def patient_row(self):
+        return Patient.objects.get(pk=self.patient.pk)
+
+    def rotate(self):
+        user = CustomUser.objects.get(pk=self.user.pk)
+        return user, user.rotate_user_key()
+
+    def test_rotation_reencrypts_everything_and_drops_the_old_key(self):
+        aadhar = self.patient_row().aadhar_number_decrypted
+        user, job = self.rotate()
+        self.assertEqual((job.kind, job.params), ("reencrypt_user_data", {"user_id": user.pk}))
+        self.assertEqual(self.sealed_versions(), {1})
+        # Until the job is done, values under the old key still decrypt through the retired key
+        key = CustomUser.objects.get(pk=user.pk).get_user_key()
+        self.assertEqual((key.version, list(key.retired)), (2, [1]))
+        self.assertEqual(self.patient_row().aadhar_number_decrypted, aadhar)
+        with self.assertRaises(ValueError):
+            user.rotate_user_key()
+
+        self.assertTrue(run_job(job))
+        job.refresh_from_db()
+        self.assertEqual(job.progress, 1 + 3 + 1 + 1)
+        self.assertEqual(self.sealed_versions(), {2})
+        user.refresh_from_db()
+        self.assertIsNone(user.previous_user_key)
+        self.assertEqual(user.get_user_key().retired, {})
+        self.assertEqual(self.patient_row().aadhar_number_decrypted, aadhar)
+        self.assertEqual(MedicalHistory.objects.first().notes_decrypted, "Carries epinephrine")
+        # Search tokens follow the new key
+        self.client.force_authenticate(user)
+        response = self.client.get(f"/v1/patients/{self.patient.pk}/medical-histories/", {"search": "epinephrine"})
+        self.assertEqual(len(response.data["results"]), 3)
+
+    def test_resumes_from_checkpoint(self):
+        user, job = self.rotate()
+        calls = []
+
+        def fail_on_histories(model, pks, *args):
+            if model is MedicalHistory and len(calls) == 2:
+                raise RuntimeError("worker lost")
+            calls.append(list(pks))
+            return reencrypt(model, pks, *args)
+
+        reencrypt = jobs._reencrypt_batch
+        with patch("users.jobs.REENCRYPT_BATCH_SIZE", 1), patch("users.jobs._reencrypt_batch", fail_on_histories), \
+                self.assertLogs("jobs.worker", "ERROR"):
+            self.assertFalse(run_job(job))
+        job.refresh_from_db()
+        self.assertEqual(job.checkpoint, {"model": 1, "last_pk": self.histories[0].pk})
+        first = MedicalHistory.objects.get(pk=self.histories[0].pk).notes
+        self.assertEqual(key_version_of(first), 2)
+
+        with patch("users.jobs.REENCRYPT_BATCH_SIZE", 1):
+            self.assertTrue(run_job(job))
+        # The history done before the failure was not rewritten again
+        self.assertEqual(MedicalHistory.objects.get(pk=self.histories[0].pk).notes, first)
+        self.assertEqual(self.sealed_versions(), {2})
+        self.assertIsNone(CustomUser.objects.get(pk=user.pk).previous_user_key)
+
+    def test_save_with_a_stale_user_during_the_job(self):
+        stale_user = CustomUser.objects.get(pk=self.user.pk)
+        user, job = self.rotate()
+        saves = []
+
+        def save_behind_the_job(model, pks, *args):
+            rewritten = reencrypt(model, pks, *args)
+            if model is Patient and not saves:
+                # A request that loaded the user before the rotation saves after the patient batch passed
+                patient = Patient.objects.get(pk=self.patient.pk)
+                patient.user = stale_user
+                patient.aadhar_number = "999988887777"
+                patient.save()
+                saves.append(patient)
+                self.assertEqual(key_version_of(self.patient_row().aadhar_number), 1)
+            return rewritten
+
+        reencrypt = jobs._reencrypt_batch
+        with patch("users.jobs._reencrypt_batch", save_behind_the_job):
+            self.assertTrue(run_job(job))
+        self.assertEqual(self.sealed_versions(), {2})
+        user_keyring.clear()
+        self.assertEqual(self.patient_row().aadhar_number_decrypted, "999988887777")
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class AccountShredTests(APITestCase):
+    def setUp(self):
+        user_keyring.clear()
+        self.doctor = testing.make_doctor()
+        self.patient = testing.make_patient()
+        testing.make_history(self.patient)
+        testing.make_vital(self.patient)
+        self.encounter = testing.make_encounter(self.patient, self.doctor)
+        self.note = testing.make_note(self.encounter)
+
+    def delete_account(self, user):
+        self.client.force_authenticate(user)
+        self.assertEqual(self.client.delete("/v1/users/my-account/").status_code, 204)
+        self.client.force_authenticate(None)
+        return Job.objects.get(kind="purge_user", params={"user_id": user.pk})
+
+    def test_patient_records_are_unreadable_at_once_then_purged(self):
+        user = self.patient.user
+        job = self.delete_account(user)
+        shredded = CustomUser.objects.get(pk=user.pk)
+        self.assertEqual((shredded.user_key, shredded.is_active), (None, False))
+        patient = Patient.objects.get(pk=self.patient.pk)
+        self.assertEqual((patient.aadhar_number_index, patient.contact_number_index), (None, None))
+        self.assertIsNone(patient.aadhar_number_decrypted)
+        self.assertIsNone(MedicalHistory.objects.get().notes_decrypted)
+
+        self.assertTrue(run_job(job))
+        self.assertFalse(CustomUser.objects.filter(pk=user.pk).exists())
+        for model in (Patient, MedicalHistory, Vital, Encounter, ClinicalNote, SearchToken):
+            self.assertFalse(model.objects.exists(), model.__name__)
+        self.assertTrue(Doctor.objects.filter(pk=self.doctor.pk).exists())
+
+    @override_settings(ACCESS_GRANT_CACHE_TTL=300)
+    def test_no_writes_after_the_shred(self):
+        testing.grant_access(self.doctor, self.patient)
+        self.assertTrue(can_access(self.doctor.user, [self.patient.pk]))  # grants now cached
+        self.patient.user.shred()
+        self.assertFalse(can_access(self.doctor.user, [self.patient.pk]))
+
+        self.client.force_authenticate(self.doctor.user)
+        response = self.client.post("/v1/doctors/encounters/", {
+            "patient": self.patient.pk, "doctor": self.doctor.pk, "reason": "Follow-up"}, format="json")
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post("/v1/doctors/encounters/clinical-notes/", {
+            "encounter": self.encounter.pk, "plan": "Continue inhaler"}, format="json")
+        self.assertEqual(response.status_code, 403)
+        # Nor below the API: without the owner's key the row would be stored in the clear
+        with self.assertRaises(ValueError):
+            testing.make_encounter(Patient.objects.get(pk=self.patient.pk), self.doctor)
+        self.assertEqual((Encounter.objects.count(), ClinicalNote.objects.count()), (1, 1))
+
+    def test_doctor_purge_keeps_their_patients_charts(self):
+        user = self.doctor.user
+        self.assertTrue(run_job(self.delete_account(user)))
+        self.assertFalse(CustomUser.objects.filter(pk=user.pk).exists())
+        self.assertFalse(Doctor.objects.exists())
+        encounter = Encounter.objects.get(pk=self.encounter.pk)
+        self.assertIsNone(encounter.doctor_id)
+        self.assertEqual(encounter.reason_decrypted, "Persistent cough")
+        self.assertEqual(ClinicalNote.objects.get(pk=self.note.pk).plan_decrypted, "Salbutamol inhaler")
+        self.client.force_authenticate(self.patient.user)
+        response = self.client.get("/v1/doctors/encounters/")
+        self.assertEqual([(row["id"], row["doctor"]) for row in response.data["results"]], [(encounter.pk, None)])
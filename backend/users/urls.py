@@ -3,7 +3,8 @@ from .views import LoginViewSet, UserViewSet, MyAccountViewSet
 
 myaccount = MyAccountViewSet.as_view({
     'get': 'list',
-    'patch': 'update'
+    'patch': 'update',
+    'delete': 'destroy'
 })
 
 users = UserViewSet.as_view({
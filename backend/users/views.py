@@ -14,6 +14,11 @@ from datetime import timedelta
 User = get_user_model()
 
 class LoginViewSet(viewsets.ViewSet):
+    query_budget = {
+        'login': 1,
+        'refresh': 0,
+    }
+
     @action(detail=False, methods=['post'])
     def login(self, request):
         serializer = LoginSerializer(data=request.data)
@@ -72,8 +77,15 @@ class UserViewSet(viewsets.ModelViewSet):
     serializer_class = UserSerializer
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     filterset_fields = ['email', 'role']
-    ordering_fields = ['id', 'name']
+    ordering_fields = ['id']
+    ordering = ['-id']
     search_fields = ['id']
+    query_budget = {
+        'list': 2,
+        'create': 3,
+        'verify_otp': 2,
+        'resend_otp': 3,
+    }
 
     def get_queryset(self):
         return User.objects.filter(is_superuser=False, is_staff=False)
@@ -144,8 +156,14 @@ class MyAccountViewSet(viewsets.ModelViewSet):
     serializer_class = UserSerializer
     filter_backends = [SearchFilter, OrderingFilter]
     ordering_fields = ['id']
+    ordering = ['-id']
     search_fields = ['id']
     permission_classes = [IsAuthenticated]
+    query_budget = {
+        'list': 2,
+        'update': 2,
+        'destroy': 6,
+    }
 
     def get_queryset(self):
         return User.objects.filter(id=self.request.user.id)
@@ -167,8 +185,9 @@ class MyAccountViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=["delete"])
     def destroy(self, request, *args, **kwargs):
+        # Shredding the key is immediate; the rows are purged by a background job
         user = self.get_object()
-        user.delete()
+        user.shred()
         return Response(
             {"type": "success", "detail": "Your account has been deleted."},
             status=status.HTTP_204_NO_CONTENT
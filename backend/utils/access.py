@@ -0,0 +1,70 @@
+# utils/access.py
+"""
+Access policy for patient records. A doctor may see patients whose access
+request they had approved; a patient sees themselves plus the verified
+members of the family they head. The grant set is cached per doctor or
+patient profile (ACCESS_GRANT_CACHE_TTL) and dropped by the signals in
+doctors/signals.py and families/signals.py whenever an AccessRequest or
+FamilyMember changes. A TTL of 0, the default without a shared cache,
+reads the grants on every call.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+CACHE_PREFIX = "access-grants"
+
+
+def _cache_key(kind, profile_id):
+    return f"{CACHE_PREFIX}:{kind}:{profile_id}"
+
+
+def _principal(user):
+    # (kind, profile id) whose grants apply to this user, or None
+    if user is None or not user.is_authenticated:
+        return None
+    if user.role == "doctor" and user.linked_doctor_id:
+        return "doctor", user.linked_doctor_id
+    if user.role == "patient" and user.linked_patient_id:
+        return "patient", user.linked_patient_id
+    return None
+
+
+def _load_grants(kind, profile_id):
+    from doctors.models import AccessRequest
+    from families.models import FamilyMember
+
+    if kind == "doctor":
+        return frozenset(AccessRequest.objects.filter(doctor_id=profile_id, is_approved=True)
+                         .values_list("patient_id", flat=True))
+    members = FamilyMember.objects.filter(family__head_of_family_id=profile_id, is_verified=True)
+    return frozenset(members.values_list("patient_id", flat=True)) | {profile_id}
+
+
+def accessible_patient_ids(user) -> frozenset:
+    """Ids of every patient whose records `user` may see."""
+    principal = _principal(user)
+    if principal is None:
+        return frozenset()
+    ttl = getattr(settings, "ACCESS_GRANT_CACHE_TTL", 0)
+    if ttl <= 0:
+        return _load_grants(*principal)
+    key = _cache_key(*principal)
+    grants = cache.get(key)
+    if grants is None:
+        grants = _load_grants(*principal)
+        cache.set(key, grants, ttl)
+    return grants
+
+
+def can_access(user, patient_ids) -> bool:
+    """True when `user` may see every one of `patient_ids`."""
+    try:
+        wanted = {int(patient_id) for patient_id in patient_ids}
+    except (TypeError, ValueError):
+        return False
+    return bool(wanted) and wanted <= accessible_patient_ids(user)
+
+
+def invalidate(kind, *profile_ids):
+    # kind is "doctor" or "patient" (a family head)
+    cache.delete_many([_cache_key(kind, profile_id) for profile_id in profile_ids if profile_id is not None])
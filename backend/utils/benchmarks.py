@@ -0,0 +1,330 @@
+# utils/benchmarks.py
+"""
+Micro-benchmarks for the encrypted hot paths, run with
+`python manage.py benchmark`. Every case returns a dict of metrics;
+`us_per_op` (lower is better) is what regression checks compare.
+Cases that write rows run inside a transaction that is rolled back.
+"""
+import base64
+import os
+import platform
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import django
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from utils.encryption import AESCipher, decrypt_many_by_key, get_engine, is_encrypted, zstandard
+from utils.keyring import user_keyring
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _sample_text(size):
+    words = ("patient", "reports", "mild", "fever", "cough", "since", "three", "days", "no", "allergy")
+    text = " ".join(words[i % len(words)] for i in range(size // 5 + 1))
+    return text[:size]
+
+
+_NOTE_SENTENCES = (
+    "Patient is a {age} year old {sex} presenting with {complaint} for the past {days} days.",
+    "Reports {complaint} that is worse at night and partially relieved by rest.",
+    "Denies chest pain, shortness of breath, nausea or vomiting.",
+    "Known case of {condition}, on {drug} {dose} mg {freq} with fair compliance.",
+    "BP {sys}/{dia} mmHg, HR {hr} bpm, temperature {temp} C, SpO2 {spo2}% on room air.",
+    "On examination the patient is conscious, oriented and afebrile.",
+    "Chest is clear bilaterally, no added sounds. Abdomen soft and non-tender.",
+    "Assessment: {condition}, {status}. Rule out {differential}.",
+    "Plan: continue {drug} {dose} mg {freq}, start {drug2} {dose2} mg for {days} days.",
+    "Advised CBC, HbA1c and lipid profile. Review after {days} days with reports.",
+    "Counselled on diet, hydration and medication adherence; patient verbalised understanding.",
+)
+_NOTE_VALUES = {
+    "sex": ("male", "female"),
+    "complaint": ("dry cough", "intermittent fever", "lower back pain", "headache", "burning micturition",
+                  "joint pain", "fatigue", "epigastric discomfort"),
+    "condition": ("type 2 diabetes mellitus", "essential hypertension", "bronchial asthma", "hypothyroidism",
+                  "acute gastritis", "viral upper respiratory infection"),
+    "status": ("stable", "improving", "poorly controlled", "newly diagnosed"),
+    "differential": ("dengue", "typhoid", "urinary tract infection", "GERD", "pneumonia"),
+    "drug": ("metformin", "amlodipine", "levothyroxine", "salbutamol", "pantoprazole"),
+    "drug2": ("paracetamol", "azithromycin", "cetirizine", "ibuprofen"),
+    "freq": ("once daily", "twice daily", "at bedtime", "as needed"),
+}
+
+
+def _clinical_note(rng, size):
+    # Free text shaped like real SOAP notes: repetitive vocabulary, varying numbers
+    def fill(sentence):
+        values = {name: rng.choice(choices) for name, choices in _NOTE_VALUES.items()}
+        values.update(age=rng.randint(18, 90), days=rng.randint(2, 14), dose=rng.choice((5, 10, 25, 50, 500)),
+                      dose2=rng.choice((250, 500, 650)), sys=rng.randint(100, 170), dia=rng.randint(60, 100),
+                      hr=rng.randint(55, 110), temp=round(rng.uniform(36.1, 39.2), 1), spo2=rng.randint(92, 100))
+        return sentence.format(**values)
+
+    parts = []
+    while sum(len(p) + 1 for p in parts) < size:
+        parts.append(fill(rng.choice(_NOTE_SENTENCES)))
+    return " ".join(parts)[:size]
+
+
+def _best_of(run, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _timing(seconds, ops, **extra):
+    return {"ops": ops, "us_per_op": round(seconds / ops * 1e6, 3), "ops_per_sec": round(ops / seconds), **extra}
+
+
+@transaction.atomic
+def _with_rollback(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        transaction.set_rollback(True)
+
+
+def _create_patient(index):
+    from django.contrib.auth import get_user_model
+    from patients.models import Patient
+
+    user = get_user_model().objects.create(email=f"bench{index}@example.com", role="patient")
+    patient = Patient(user=user, first_name="Bench", last_name="Patient", date_of_birth=date(1990, 1, 1),
+                      gender="female", contact_number="98765%05d" % index, aadhar_number="1234%08d" % index)
+    patient.save()
+    return patient
+
+
+@benchmark("aes_encrypt")
+def aes_encrypt_benchmark(n=2000, payload_size=200, rounds=3, **options):
+    cipher = AESCipher(os.urandom(32))
+    text = _sample_text(payload_size)
+    seconds = _best_of(lambda: [cipher.encrypt(text) for _ in range(n)], rounds)
+    return _timing(seconds, n, engine=get_engine().name, payload_size=payload_size)
+
+
+@benchmark("aes_decrypt")
+def aes_decrypt_benchmark(n=2000, payload_size=200, rounds=3, **options):
+    cipher = AESCipher(os.urandom(32))
+    token = cipher.encrypt(_sample_text(payload_size))
+    seconds = _best_of(lambda: [cipher.decrypt(token) for _ in range(n)], rounds)
+    return _timing(seconds, n, engine=get_engine().name, payload_size=payload_size)
+
+
+@benchmark("aes_decrypt_many")
+def aes_decrypt_many_benchmark(n=2000, payload_size=200, rounds=3, **options):
+    cipher = AESCipher(os.urandom(32))
+    tokens = cipher.encrypt_many([_sample_text(payload_size)] * n)
+    seconds = _best_of(lambda: cipher.decrypt_many(tokens), rounds)
+    return _timing(seconds, n, engine=get_engine().name, payload_size=payload_size)
+
+
+@benchmark("is_encrypted")
+def is_encrypted_benchmark(n=2000, rounds=3, **options):
+    values = [AESCipher(os.urandom(32)).encrypt("x"), "plain text value"] * (n // 2)
+    seconds = _best_of(lambda: [is_encrypted(v) for v in values], rounds)
+    return _timing(seconds, len(values))
+
+
+@benchmark("get_user_key")
+def get_user_key_benchmark(n=2000, rounds=3, **options):
+    def run():
+        user = _create_patient(0).user
+        user_keyring.invalidate(user.pk)
+        cold = _best_of(lambda: user._unwrap_user_key(user.user_key), rounds)
+        cached = _best_of(lambda: [user.get_user_key() for _ in range(n)], rounds)
+        return {
+            "unwrap": _timing(cold, 1),
+            "cached": _timing(cached, n),
+        }
+    return _with_rollback(run)
+
+
+@benchmark("patient_save")
+def patient_save_benchmark(n=200, **options):
+    def run():
+        start = time.perf_counter()
+        for i in range(n):
+            _create_patient(i)
+        return _timing(time.perf_counter() - start, n)
+    return _with_rollback(run)
+
+
+def _render_benchmark(n, rounds, make_rows, serializer_class, queryset):
+    def run():
+        make_rows()
+        def render():
+            return serializer_class(queryset().with_decryption_keys(), many=True).data
+        with CaptureQueriesContext(connection) as ctx:
+            render()
+        seconds = _best_of(render, rounds)
+        return _timing(seconds, n, queries=len(ctx.captured_queries))
+    return _with_rollback(run)
+
+
+@benchmark("render_medical_history")
+def render_medical_history_benchmark(n=200, payload_size=200, rounds=3, **options):
+    from patients.models import MedicalHistory
+    from patients.serializers import MedicalHistorySerializer
+
+    def make_rows():
+        patient = _create_patient(0)
+        for _ in range(n):
+            MedicalHistory(patient=patient, type_of="disease", description=_sample_text(payload_size),
+                           diagnosis_code="J45", event_date=date(2020, 1, 1), status="active",
+                           notes=_sample_text(payload_size)).save()
+
+    return _render_benchmark(n, rounds, make_rows, MedicalHistorySerializer, MedicalHistory.objects.all)
+
+
+@benchmark("render_clinical_note")
+def render_clinical_note_benchmark(n=200, payload_size=200, rounds=3, **options):
+    from doctors.models import ClinicalNote, Doctor, Encounter
+    from doctors.serializers import ClinicalNoteSerializer
+
+    def make_rows():
+        patient = _create_patient(0)
+        doctor = Doctor.objects.create(name="Bench", specialty="General", contact_number="9876500000",
+                                       hospital="Bench Hospital")
+        encounter = Encounter(patient=patient, doctor=doctor, reason="checkup")
+        encounter.save()
+        text = _sample_text(payload_size)
+        for _ in range(n):
+            ClinicalNote(encounter=encounter, subjective=text, objective=text, assessment=text,
+                         plan=text, note=text).save()
+
+    return _render_benchmark(n, rounds, make_rows, ClinicalNoteSerializer, ClinicalNote.objects.all)
+
+
+@benchmark("storage")
+def storage_benchmark(n=2000, payload_size=200, rounds=3, **options):
+    """
+    Compare base64-text vs raw-binary ciphertext storage in throwaway tables:
+    stored bytes and read+decrypt throughput.
+    """
+    cipher = AESCipher(os.urandom(32))
+    envelopes = cipher.encrypt_many([_sample_text(payload_size)] * n)
+    layouts = {
+        "base64_text": ("text", [base64.b64encode(e).decode() for e in envelopes]),
+        "binary": ("bytea" if connection.vendor == "postgresql" else "blob", envelopes),
+    }
+
+    def run():
+        results = {}
+        with connection.cursor() as cursor:
+            for name, (column_type, values) in layouts.items():
+                table = f"bench_storage_{name}"
+                cursor.execute(f"CREATE TEMPORARY TABLE {table} (id integer PRIMARY KEY, val {column_type})")
+                cursor.executemany(f"INSERT INTO {table} (id, val) VALUES (%s, %s)", list(enumerate(values)))
+                cursor.execute(f"SELECT SUM(LENGTH(val)) FROM {table}")
+                stored_bytes = cursor.fetchone()[0]
+
+                def read():
+                    cursor.execute(f"SELECT val FROM {table}")
+                    cipher.decrypt_many([row[0] for row in cursor.fetchall()])
+
+                results[name] = _timing(_best_of(read, rounds), n, stored_bytes=stored_bytes)
+        return results
+    return _with_rollback(run)
+
+
+@benchmark("compression")
+def compression_benchmark(n=500, sizes=(256, 1024, 4096, 16384), rounds=3, **options):
+    """
+    Stored size and encrypt/decrypt cost of clinical-note-like text for each
+    compression codec, per plaintext size.
+    """
+    rng = random.Random(0)
+    key = os.urandom(32)
+    codecs = ["none", "zlib"] + (["zstd"] if zstandard is not None else [])
+    results = {}
+    for size in sizes:
+        notes = [_clinical_note(rng, size) for _ in range(n)]
+        plain_bytes = sum(len(note.encode()) for note in notes)
+        by_codec = {}
+        for codec in codecs:
+            cipher = AESCipher(key, compression=(codec, 0))
+            tokens = cipher.encrypt_many(notes)
+            stored = sum(len(token) for token in tokens)
+            encrypt = _best_of(lambda: cipher.encrypt_many(notes), rounds)
+            decrypt = _best_of(lambda: cipher.decrypt_many(tokens), rounds)
+            by_codec[codec] = {
+                "stored_bytes": stored,
+                "ratio": round(stored / plain_bytes, 3),
+                "encrypt": _timing(encrypt, n),
+                "decrypt": _timing(decrypt, n),
+            }
+        results[str(size)] = by_codec
+    return results
+
+
+@benchmark("parallel_decryption")
+def parallel_decryption_benchmark(n=20000, payload_size=200, users=50, pool_sizes=(2, 4, 8), rounds=3, **options):
+    """
+    Time decrypt_many_by_key serially and on thread pools of several sizes
+    for `n` ciphertexts spread over `users` keys.
+    """
+    per_user = max(1, n // users)
+    jobs = []
+    for _ in range(users):
+        key = os.urandom(32)
+        jobs.append((key, AESCipher(key).encrypt_many([_sample_text(payload_size)] * per_user)))
+    total = per_user * users
+
+    serial = _best_of(lambda: decrypt_many_by_key(jobs, executor=None, threshold=total + 1), rounds)
+    results = {"serial": _timing(serial, total)}
+    for size in pool_sizes:
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            elapsed = _best_of(lambda: decrypt_many_by_key(jobs, executor=executor, workers=size, threshold=0), rounds)
+        results[f"pool_{size}"] = _timing(elapsed, total, speedup=round(serial / elapsed, 2))
+    return results
+
+
+def run_benchmarks(names=None, **options):
+    results = {}
+    for name in names or BENCHMARKS:
+        results[name] = BENCHMARKS[name](**options)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "aes_engine": get_engine().name,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+
+
+def find_regressions(baseline, current, tolerance=0.2, path=""):
+    """
+    Compare two run_benchmarks() result trees and list every `us_per_op`
+    that got slower by more than `tolerance` (0.2 = 20%).
+    """
+    regressions = []
+    for key, value in current.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if old is None:
+            continue
+        where = f"{path}.{key}" if path else key
+        if isinstance(value, dict):
+            regressions += find_regressions(old, value, tolerance, where)
+        elif key == "us_per_op" and old and value > old * (1 + tolerance):
+            regressions.append({"benchmark": path, "before": old, "after": value,
+                                "change": f"+{(value / old - 1) * 100:.0f}%"})
+    return regressions
@@ -1,43 +1,382 @@
 # utils/encryption.py
 import base64
+import functools
+import hashlib
+import hmac
+import os
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from utils.instrumentation import timed
+
+try:
+    import zstandard
+except ImportError:  # optional; zlib is always available
+    zstandard = None
 
 BLOCK_SIZE = 16
 NONCE_SIZE = 12   # recommended for GCM
+TAG_SIZE = 16
+
+# Envelope: magic (2) + format version (1) + key version (1) + flags (1)
+# + nonce + tag + ciphertext. Stored as raw bytes
+# (utils.fields.EncryptedBinaryField); the header is authenticated as AAD.
+# Format v1 has no flags byte and is still read. Rows written before binary
+# storage hold a v1 envelope base64-encoded, which always starts with
+# ENVELOPE_PREFIX.
+ENVELOPE_MAGIC = b"\xa7\xe5"
+ENVELOPE_VERSION = 2
+ENVELOPE_V1 = 1
+ENVELOPE_PREFIX = base64.b64encode(ENVELOPE_MAGIC + bytes([ENVELOPE_V1])).decode()
+ENVELOPE_HEADERS = (ENVELOPE_MAGIC + bytes([ENVELOPE_VERSION]), ENVELOPE_MAGIC + bytes([ENVELOPE_V1]))
+HEADER_SIZE = len(ENVELOPE_MAGIC) + 3
+HEADER_SIZE_V1 = len(ENVELOPE_MAGIC) + 2
+DEFAULT_KEY_VERSION = 1
+MAX_KEY_VERSION = 255  # one header byte; versions wrap around to 1
+
+# Header flags: how the plaintext was compressed before sealing
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+COMPRESSION_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+
+DECRYPTION_ERROR = "[Decryption Error]"
+
+
+class PyCryptodomeEngine:
+    # pycryptodome needs a fresh cipher object per nonce
+    name = "pycryptodome"
 
-class AESCipher:
     def __init__(self, key: bytes):
+        self.key = bytes(key)
+
+    def seal(self, nonce: bytes, data: bytes, aad: bytes = b""):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(aad)
+        return cipher.encrypt_and_digest(data)
+
+    def open(self, nonce: bytes, ciphertext: bytes, tag: bytes, aad: bytes = b"") -> bytes:
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(aad)
+        return cipher.decrypt_and_verify(ciphertext, tag)
+
+
+class CryptographyEngine:
+    # cryptography's AESGCM expands the key schedule once and reuses it for every call
+    name = "cryptography"
+
+    def __init__(self, key: bytes):
+        self._aead = AESGCM(bytes(key))
+
+    def seal(self, nonce: bytes, data: bytes, aad: bytes = b""):
+        out = self._aead.encrypt(nonce, data, aad or None)
+        return out[:-TAG_SIZE], out[-TAG_SIZE:]
+
+    def open(self, nonce: bytes, ciphertext: bytes, tag: bytes, aad: bytes = b"") -> bytes:
+        return self._aead.decrypt(nonce, ciphertext + tag, aad or None)
+
+
+ENGINES = {engine.name: engine for engine in (PyCryptodomeEngine, CryptographyEngine)}
+
+_selected_engine = None
+_engine_lock = threading.Lock()
+
+
+def benchmark_engines(rounds=200, payload_size=256):
+    """
+    Time an encrypt/decrypt round trip for every engine.
+    Returns {engine_name: seconds}.
+    """
+    key = get_random_bytes(32)
+    payload = get_random_bytes(payload_size)
+    nonce = get_random_bytes(NONCE_SIZE)
+    timings = {}
+    for name, engine_cls in ENGINES.items():
+        engine = engine_cls(key)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            ciphertext, tag = engine.seal(nonce, payload)
+            engine.open(nonce, ciphertext, tag)
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+def get_engine():
+    """
+    Return the AES-GCM engine class to use.
+    `settings.AES_ENGINE` can pin one; "auto" benchmarks them once per process.
+    """
+    global _selected_engine
+    if _selected_engine is None:
+        with _engine_lock:
+            if _selected_engine is None:
+                choice = getattr(settings, "AES_ENGINE", "auto")
+                if choice == "auto":
+                    timings = benchmark_engines()
+                    choice = min(timings, key=timings.get)
+                if choice not in ENGINES:
+                    raise ValueError(f"Unknown AES engine: {choice}")
+                _selected_engine = ENGINES[choice]
+    return _selected_engine
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def _zstd_decompress(data):
+    if zstandard is None:
+        raise RuntimeError("zstandard is required to decrypt this value")
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+COMPRESSORS = {
+    "zlib": (FLAG_ZLIB, zlib.compress),
+    "zstd": (FLAG_ZSTD, _zstd_compress),
+}
+DECOMPRESSORS = {
+    FLAG_ZLIB: zlib.decompress,
+    FLAG_ZSTD: _zstd_decompress,
+}
+
+
+def get_compression():
+    """
+    Return the (codec, threshold) from settings. "auto" picks zstd when
+    installed, else zlib; "none" turns compression off for new writes.
+    """
+    codec = getattr(settings, "ENCRYPTION_COMPRESSION", "auto")
+    if codec == "auto":
+        codec = "zstd" if zstandard is not None else "zlib"
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("ENCRYPTION_COMPRESSION=zstd needs the zstandard package")
+    if codec != "none" and codec not in COMPRESSORS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    return codec, getattr(settings, "ENCRYPTION_COMPRESSION_THRESHOLD", 256)
+
+
+class DataKey(bytes):
+    """
+    A user's current AES key, tagged with its version. While the user's data
+    is being re-encrypted after a key rotation, `retired` maps older versions
+    to their keys so values sealed under them still decrypt.
+    """
+
+    def __new__(cls, key, version=DEFAULT_KEY_VERSION, retired=None):
+        obj = super().__new__(cls, key)
+        obj.version = version
+        obj.retired = dict(retired or {})
+        return obj
+
+
+class AESCipher:
+    def __init__(self, key: bytes, key_version: int = None, engine=None, compression=None):
         if not isinstance(key, (bytes, bytearray)):
             raise TypeError("Key must be bytes")
         # key must be 16/24/32 bytes for AES
         self.key = key
+        self.key_version = key_version or getattr(key, "version", DEFAULT_KEY_VERSION)
+        self._engine_class = engine or get_engine()
+        self._engine = self._engine_class(key)
+        self._retired = getattr(key, "retired", {})
+        self._retired_engines = {}
+        # (codec, threshold); plaintexts shorter than threshold bytes are not compressed
+        self.compression = compression or get_compression()
+
+    def encrypt(self, raw: str) -> bytes:
+        return self.encrypt_many([raw])[0]
+
+    def decrypt(self, enc: bytes) -> str:
+        # bubble up so caller can handle
+        return self.decrypt_many([enc])[0]
+
+    def encrypt_many(self, raws) -> list:
+        # Encrypt a batch with one key schedule; None stays None
+        results = []
+        with timed("aes"):
+            for raw in raws:
+                if raw is None:
+                    results.append(None)
+                    continue
+                nonce = get_random_bytes(NONCE_SIZE)
+                data = raw if isinstance(raw, bytes) else str(raw).encode("utf-8")
+                flags, data = self._compress(data)
+                header = ENVELOPE_MAGIC + bytes([ENVELOPE_VERSION, self.key_version, flags])
+                ciphertext, tag = self._engine.seal(nonce, data, header)
+                results.append(header + nonce + tag + ciphertext)
+        return results
+
+    def decrypt_many(self, encs, errors="strict") -> list:
+        """
+        Decrypt a batch with one key schedule; empty values come back as None.
+        errors="replace" returns DECRYPTION_ERROR for values that fail
+        instead of raising.
+        """
+        results = []
+        with timed("aes"):
+            for enc in encs:
+                if not enc:
+                    results.append(None)
+                    continue
+                try:
+                    if isinstance(enc, str):
+                        # Base64 text from before binary storage
+                        enc = base64.b64decode(enc)
+                    results.append(self._open(bytes(enc)).decode("utf-8"))
+                except Exception:
+                    if errors != "replace":
+                        raise
+                    # MAC check failed or corrupted value
+                    results.append(DECRYPTION_ERROR)
+        return results
+
+    def _compress(self, data: bytes):
+        # Returns (flags, data); kept uncompressed when it would not shrink
+        codec, threshold = self.compression
+        if codec == "none" or len(data) < threshold:
+            return 0, data
+        flag, compress = COMPRESSORS[codec]
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            return 0, data
+        return flag, compressed
+
+    def _engine_for(self, key_version):
+        if key_version == self.key_version:
+            return self._engine
+        if key_version not in self._retired_engines:
+            if key_version not in self._retired:
+                raise ValueError(f"No key available for key version {key_version}")
+            self._retired_engines[key_version] = self._engine_class(self._retired[key_version])
+        return self._retired_engines[key_version]
+
+    def _open(self, enc_bytes: bytes) -> bytes:
+        flags = 0
+        if enc_bytes.startswith(ENVELOPE_MAGIC + bytes([ENVELOPE_VERSION])):
+            header, body = enc_bytes[:HEADER_SIZE], enc_bytes[HEADER_SIZE:]
+            flags = header[-1]
+        elif enc_bytes.startswith(ENVELOPE_MAGIC + bytes([ENVELOPE_V1])):
+            header, body = enc_bytes[:HEADER_SIZE_V1], enc_bytes[HEADER_SIZE_V1:]
+        else:
+            # Pre-envelope rows: nonce + tag + ciphertext, no header
+            header, body = b"", enc_bytes
+        nonce = body[:NONCE_SIZE]
+        tag = body[NONCE_SIZE:NONCE_SIZE+TAG_SIZE]
+        ciphertext = body[NONCE_SIZE+TAG_SIZE:]
+        engine = self._engine_for(header[3] if header else DEFAULT_KEY_VERSION)
+        data = engine.open(nonce, ciphertext, tag, header)
+        # Decompress only after the tag has been verified
+        codec = flags & COMPRESSION_FLAGS
+        return DECOMPRESSORS[codec](data) if codec else data
+
+
+def is_encrypted(value) -> bool:
+    # O(1) check for a value produced by AESCipher.encrypt
+    return isinstance(value, bytes) and value[:3] in ENVELOPE_HEADERS
+
+
+def key_version_of(value) -> int:
+    # Version of the user key an envelope was sealed with
+    return value[3] if is_encrypted(value) else DEFAULT_KEY_VERSION
+
+
+_decryption_executor = None
+
+
+def _reset_after_fork():
+    # A forked child (e.g. a bulk export worker) inherits the pool object but
+    # not its threads, and possibly a lock held by one; start both afresh
+    global _decryption_executor, _engine_lock
+    _decryption_executor = None
+    _engine_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_decryption_executor():
+    # Shared thread pool for large decryptions; None unless DECRYPTION_POOL_SIZE > 0
+    global _decryption_executor
+    pool_size = getattr(settings, "DECRYPTION_POOL_SIZE", 0)
+    if pool_size <= 0:
+        return None
+    if _decryption_executor is None:
+        with _engine_lock:
+            if _decryption_executor is None:
+                _decryption_executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="decrypt")
+    return _decryption_executor
+
+
+def decrypt_many_by_key(jobs, errors="replace", executor=None, workers=None, threshold=None):
+    """
+    Decrypt several (key, values) batches, returning one plaintext list per job.
+    When the request holds at least DECRYPTION_PARALLEL_THRESHOLD values and
+    the decryption pool is enabled, the batches are split across its workers.
+    """
+    executor = executor or get_decryption_executor()
+    workers = workers or getattr(settings, "DECRYPTION_POOL_SIZE", 0)
+    if threshold is None:
+        threshold = getattr(settings, "DECRYPTION_PARALLEL_THRESHOLD", 500)
+    total = sum(len(values) for _, values in jobs)
+    if executor is None or total < threshold:
+        return [AESCipher(key).decrypt_many(values, errors=errors) for key, values in jobs]
+
+    chunk_size = max(1, -(-total // workers))
+    pending = []
+    # Pool threads don't see the request's metrics; time the wait here instead
+    with timed("aes"):
+        for key, values in jobs:
+            cipher = AESCipher(key)
+            pending.append([
+                executor.submit(cipher.decrypt_many, values[i:i + chunk_size], errors)
+                for i in range(0, len(values), chunk_size)
+            ])
+        return [[plaintext for future in futures for plaintext in future.result()] for futures in pending]
+
+
+@functools.lru_cache(maxsize=None)
+def _blind_index_key(secret: str) -> bytes:
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"blind-index")
+    return hkdf.derive(secret.encode("utf-8"))
+
+
+def blind_index(field: str, value) -> str:
+    """
+    Deterministic HMAC-SHA256 of a normalized plaintext, for exact-match
+    lookups and uniqueness on encrypted columns. The field name is mixed in
+    so equal values in different columns don't produce equal indexes.
+    """
+    if not value:
+        return None
+    secret = getattr(settings, "BLIND_INDEX_KEY", None) or settings.MASTER_KEY
+    normalized = re.sub(r"[\s-]", "", str(value)).lower()
+    message = f"{field}:{normalized}".encode("utf-8")
+    return hmac.new(_blind_index_key(secret), message, hashlib.sha256).hexdigest()
+
+
+KEYWORD_PATTERN = re.compile(r"[0-9a-z]+")
+MIN_KEYWORD_LENGTH = 2
+
+
+def keywords(text) -> set:
+    # Lowercased alphanumeric words; search matches whole words only
+    if not text:
+        return set()
+    return {word for word in KEYWORD_PATTERN.findall(str(text).lower()) if len(word) >= MIN_KEYWORD_LENGTH}
+
 
-    def encrypt(self, raw: str) -> str:
-        raw_bytes = str(raw).encode("utf-8")
-        cipher = AES.new(self.key, AES.MODE_GCM, nonce=get_random_bytes(NONCE_SIZE))
-        ciphertext, tag = cipher.encrypt_and_digest(raw_bytes)
-        # store as: nonce + tag + ciphertext
-        return base64.b64encode(cipher.nonce + tag + ciphertext).decode("utf-8")
-
-    def decrypt(self, enc: str) -> str:
-        try:
-            enc_bytes = base64.b64decode(enc)
-            nonce = enc_bytes[:NONCE_SIZE]
-            tag = enc_bytes[NONCE_SIZE:NONCE_SIZE+16]
-            ciphertext = enc_bytes[NONCE_SIZE+16:]
-            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
-            data = cipher.decrypt_and_verify(ciphertext, tag)
-            return data.decode("utf-8")
-        except Exception as e:
-            # bubble up so caller can handle
-            raise
-
-def is_base64(s: str) -> bool:
-    try:
-        # Must be a multiple of 4 in length and roundtrip successfully
-        if not isinstance(s, str) or len(s.strip()) == 0 or len(s) % 4 != 0:
-            return False
-        return base64.b64encode(base64.b64decode(s)).decode() == s
-    except Exception:
-        return False
\ No newline at end of file
+def search_tokens(user_key: bytes, words) -> dict:
+    """
+    Map each keyword to its HMAC-SHA256 under a key derived from the owner's
+    AES key, so equal words in different users' records don't share tokens.
+    """
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"search-index")
+    key = hkdf.derive(bytes(user_key))
+    return {word: hmac.new(key, word.encode("utf-8"), hashlib.sha256).hexdigest() for word in words}
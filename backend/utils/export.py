@@ -0,0 +1,59 @@
+# utils/export.py
+"""
+Chart export as NDJSON, one {"type": ..., "data": ...} object per line.
+Every table is read with a chunked .iterator() and each chunk is decrypted
+in one pass by the model's list serializer (BatchDecryptListSerializer), so
+memory stays bounded by EXPORT_CHUNK_SIZE rows whatever the chart size.
+Archived vitals come first, unpacked one monthly blob at a time.
+"""
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import QuerySet
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def chart_sections(patient_ids):
+    # (record type, queryset or iterable of instances, serializer class) for every table of the given charts
+    from doctors.models import ClinicalNote, Encounter
+    from doctors.serializers import ClinicalNoteSerializer, EncounterSerializer
+    from patients.archive import iter_archived_vitals
+    from patients.models import MedicalHistory, Patient, Vital
+    from patients.serializers import MedicalHistorySerializer, PatientSerializer, VitalsSerializer
+
+    return [
+        ("patient", Patient.objects.filter(pk__in=patient_ids).with_decryption_keys(), PatientSerializer),
+        ("vital", iter_archived_vitals(patient_ids), VitalsSerializer),
+        ("vital", Vital.objects.filter(patient_id__in=patient_ids), VitalsSerializer),
+        ("medical_history", MedicalHistory.objects.filter(patient_id__in=patient_ids).with_decryption_keys(),
+         MedicalHistorySerializer),
+        ("encounter", Encounter.objects.filter(patient_id__in=patient_ids).with_decryption_keys(), EncounterSerializer),
+        ("clinical_note", ClinicalNote.objects.filter(encounter__patient_id__in=patient_ids).with_decryption_keys(),
+         ClinicalNoteSerializer),
+    ]
+
+
+def export_chunks(patient_ids, chunk_size=None):
+    """Yield lists of export records, at most `chunk_size` rows each."""
+    chunk_size = chunk_size or getattr(settings, "EXPORT_CHUNK_SIZE", 500)
+    for kind, queryset, serializer_class in chart_sections(patient_ids):
+        rows = queryset.order_by("pk").iterator(chunk_size=chunk_size) if isinstance(queryset, QuerySet) else queryset
+        for chunk in _chunks(rows, chunk_size):
+            yield [{"type": kind, "data": data} for data in serializer_class(chunk, many=True).data]
+
+
+def to_ndjson(records):
+    return "".join(json.dumps(record, cls=DjangoJSONEncoder) + "\n" for record in records)
+
+
+def ndjson(chunks):
+    # One string per chunk, so a streaming response writes whole chunks
+    for records in chunks:
+        yield to_ndjson(records)
@@ -1,16 +1,53 @@
+import base64
 from django.db import models
-from utils.encryption import AESCipher
+from utils.encryption import ENVELOPE_PREFIX
 
-class EncryptedCharField(models.CharField):
-    # Encrypt data with the owning user's AES key
 
-    def get_prep_value(self, value):
-        # encryption happens before saving
-        if value is None or not hasattr(self, 'user_key'):
-            return value
-        return AESCipher(self.user_key).encrypt(value)
+class EncryptedBinaryField(models.BinaryField):
+    """
+    Stores AESCipher envelopes as raw bytes instead of base64 text.
+
+    Encryption stays in the owning model's save() (it needs the owner's key);
+    this field only moves ciphertext between Python and the database.
+    Values still stored as base64 text (before the binary conversion
+    migration has reached them) are decoded transparently on read.
+
+    Strings given to to_python() are plaintext, whatever they look like, so
+    input can't pass itself off as ciphertext. Fixtures (dumpdata/loaddata,
+    JSON or YAML) carry envelopes as {"envelope": "<base64>"} instead.
+    """
 
     def from_db_value(self, value, expression, connection):
-        if value is None or not hasattr(self, 'user_key'):
+        if value is None:
             return value
-        return AESCipher(self.user_key).decrypt(value)
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        value = bytes(value)
+        if value.startswith(ENVELOPE_PREFIX.encode()):
+            return base64.b64decode(value)
+        return value
+
+    def to_python(self, value):
+        if isinstance(value, memoryview):
+            return bytes(value)
+        if isinstance(value, dict) and "envelope" in value:
+            return base64.b64decode(value["envelope"])
+        return value
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        if isinstance(value, (bytes, memoryview)):
+            return {"envelope": base64.b64encode(value).decode("ascii")}
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        # Plaintext only reaches here when the owner has no key yet
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        return super().get_db_prep_value(value, connection, prepared)
+
+
+class EncryptedCharField(models.CharField):
+    # Superseded by EncryptedBinaryField; kept because early patients
+    # migrations reference it.
+    pass
@@ -0,0 +1,87 @@
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+from utils.encryption import blind_index, keywords, search_tokens
+
+
+class BlindIndexFilter(BaseFilterBackend):
+    """
+    Exact-match filtering on encrypted columns through their blind indexes,
+    e.g. ?aadhar_number=123412341234 becomes an indexed equality lookup.
+    Views declare `blind_index_fields = {field: index_field}`.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        for field, index_field in getattr(view, "blind_index_fields", {}).items():
+            value = request.query_params.get(field)
+            if value:
+                queryset = queryset.filter(**{index_field: blind_index(field, value)})
+        return queryset
+
+
+class KeywordSearchFilter(BaseFilterBackend):
+    """
+    Whole-word search over a model's encrypted SEARCH_FIELDS through its
+    keyed token index, e.g. ?search=asthma. Every word must match. Tokens
+    are computed once per key owner in the already-filtered queryset, so
+    only matching rows are fetched and decrypted.
+    """
+    search_param = "search"
+
+    def filter_queryset(self, request, queryset, view):
+        words = keywords(request.query_params.get(self.search_param, ""))
+        if not words:
+            return queryset
+        model = queryset.model
+        # A list rather than a subquery, so owners are fetched by primary key instead of a scan
+        owner_ids = set(queryset.order_by().values_list(f"{model.KEY_OWNER}_id", flat=True)) - {None}
+        User = get_user_model()
+        owner_keys = [owner.get_user_key() for owner in User.objects.filter(pk__in=owner_ids).only(*User.KEY_FIELDS)]
+        # Rows not yet re-encrypted after a key rotation are indexed under the retired key
+        tokens = [search_tokens(key, words) for owner_key in owner_keys if owner_key
+                  for key in (owner_key, *owner_key.retired.values())]
+        SearchToken = model.search_tokens.field.related_model
+        content_type = ContentType.objects.get_for_model(model)
+        for word in words:
+            matches = SearchToken.objects.filter(content_type=content_type,
+                                                 token__in=[owner_tokens[word] for owner_tokens in tokens])
+            queryset = queryset.filter(pk__in=matches.values("object_id"))
+        return queryset
+
+
+def parse_instant(value):
+    # ISO datetime or date (midnight); naive values are in the current time zone
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            parsed = day and timezone.datetime(day.year, day.month, day.day)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        return None
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+class TimeRangeFilter(BaseFilterBackend):
+    """
+    ?from=&to= on the view's `time_range_field`: from is inclusive, to is
+    exclusive, each an ISO datetime or date.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        field = getattr(view, "time_range_field", None)
+        if field is None:
+            return queryset
+        for param, lookup in (("from", "gte"), ("to", "lt")):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            instant = parse_instant(value)
+            if instant is None:
+                raise ValidationError({param: "Use an ISO 8601 date or datetime."})
+            queryset = queryset.filter(**{f"{field}__{lookup}": instant})
+        return queryset
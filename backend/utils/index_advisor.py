@@ -0,0 +1,155 @@
+# utils/index_advisor.py
+"""
+Index advisor: replays each PHI viewset's typical requests, EXPLAINs every
+SELECT they run and flags full table scans. Backs `manage.py index_advisor`,
+so a schema change can be checked against the hot paths on SQLite and
+PostgreSQL. On PostgreSQL sequential scans are disabled while explaining, so
+a "Seq Scan" that remains means no index can serve the predicate at all.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from utils.instrumentation import explain, fingerprint
+
+# (role, path); {placeholders} are filled from sample rows and requests
+# whose placeholders have no sample are skipped
+TYPICAL_REQUESTS = [
+    ("patient", "/v1/patients/{patient}/vitals/"),
+    ("patient", "/v1/patients/{patient}/vitals/latest/"),
+    ("patient", "/v1/patients/{patient}/vitals/analytics/"),
+    ("patient", "/v1/patients/{patient}/vitals/rollups/?period=day&from=2020-01-01"),
+    ("patient", "/v1/patients/{patient}/medical-histories/"),
+    ("patient", "/v1/patients/{patient}/medical-histories/{history}/"),
+    ("patient", "/v1/doctors/encounters/"),
+    ("patient", "/v1/doctors/encounters/clinical-notes/"),
+    ("patient", "/v1/doctors/access-requests/"),
+    ("patient", "/v1/families/"),
+    ("patient", "/v1/families/members/"),
+    ("doctor", "/v1/patients/?aadhar_number={aadhar}"),
+    ("doctor", "/v1/patients/{patient}/vitals/"),
+    ("doctor", "/v1/patients/{patient}/vitals/?from=2020-01-01"),
+    ("doctor", "/v1/patients/{patient}/medical-histories/"),
+    ("doctor", "/v1/patients/{patient}/medical-histories/?search=allergy"),
+    ("doctor", "/v1/doctors/encounters/"),
+    ("doctor", "/v1/doctors/encounters/?patient={patient}"),
+    ("doctor", "/v1/doctors/encounters/?search=asthma"),
+    ("doctor", "/v1/doctors/encounters/{encounter}/"),
+    ("doctor", "/v1/doctors/encounters/clinical-notes/"),
+    ("doctor", "/v1/doctors/encounters/clinical-notes/?encounter__patient={patient}"),
+    ("doctor", "/v1/doctors/access-requests/"),
+    ("doctor", "/v1/doctors/analytics/"),
+]
+
+# Plan lines that read a whole table
+FULL_SCANS = {
+    "sqlite": re.compile(r"\bSCAN (?!CONSTANT ROW)(\w+)(?!.*\bINDEX\b)"),
+    "postgresql": re.compile(r"\bSeq Scan on (\w+)"),
+}
+
+
+def seed(rows=200):
+    """
+    Sample data for a throwaway database: `rows` unrelated patients with
+    records, plus one doctor/patient pair with an approved grant and a family.
+    Tables are left un-ANALYZEd, so SQLite plans as if they were large and a
+    scan means no index fits, as with enable_seqscan = off on PostgreSQL.
+    """
+    from utils import testing
+
+    filler_doctor = testing.make_doctor()
+    filler_family = testing.make_family(testing.make_patient())
+    for _ in range(rows):
+        other = testing.make_patient()
+        testing.make_family(other)
+        testing.add_member(filler_family, other)
+        testing.grant_access(filler_doctor, other)
+        testing.make_note(testing.make_encounter(other, filler_doctor))
+        testing.make_history(other)
+        testing.make_vital(other)
+
+    doctor = testing.make_doctor()
+    patient = testing.make_patient()
+    testing.grant_access(doctor, patient)
+    family = testing.make_family(patient)
+    for _ in range(5):
+        testing.add_member(family)
+    for _ in range(5):
+        testing.make_note(testing.make_encounter(patient, doctor))
+        testing.make_history(patient)
+        testing.make_vital(patient)
+
+
+def sample():
+    # Users and placeholder values taken from the first approved grant, or None
+    from doctors.models import AccessRequest
+
+    grant = (AccessRequest.objects.filter(is_approved=True).select_related("doctor__user", "patient__user")
+             .order_by("-pk").first())
+    if grant is None:
+        return None
+    patient = grant.patient
+    encounter = patient.encounters.order_by("pk").first()
+    history = patient.medical_histories.order_by("pk").first()
+    users = {"doctor": grant.doctor.user, "patient": patient.user}
+    values = {
+        "patient": patient.pk,
+        "encounter": encounter.pk if encounter else None,
+        "history": history.pk if history else None,
+        "aadhar": patient.aadhar_number_decrypted,
+    }
+    return users, values
+
+
+def _plan(sql, params):
+    postgres = connection.vendor == "postgresql"
+    if postgres:
+        with connection.cursor() as cursor:
+            cursor.execute("SET enable_seqscan = off")
+    try:
+        return explain(connection.alias, sql, params)
+    finally:
+        if postgres:
+            with connection.cursor() as cursor:
+                cursor.execute("RESET enable_seqscan")
+
+
+def advise(users, values, requests=TYPICAL_REQUESTS):
+    """
+    Run each request and EXPLAIN its SELECTs. Returns one dict per request:
+    role, path, status, queries, plans [(sql, rows)], scans [(table, sql)].
+    """
+    pattern = FULL_SCANS.get(connection.vendor)
+    results = []
+    hosts = [*settings.ALLOWED_HOSTS, "testserver"]
+    with override_settings(ALLOWED_HOSTS=hosts, SLOW_REQUEST_MS=None):
+        for role, template in requests:
+            try:
+                path = template.format(**values)
+            except KeyError:
+                continue
+            if "None" in path:
+                continue
+            client = APIClient()
+            client.force_authenticate(users[role])
+            with CaptureQueriesContext(connection) as ctx:
+                response = client.get(path)
+
+            plans, scans, seen = [], [], set()
+            for query in ctx.captured_queries:
+                sql = query["sql"]
+                shape = fingerprint(sql)
+                if shape in seen or not sql.lstrip().upper().startswith("SELECT"):
+                    continue
+                seen.add(shape)
+                # captured_queries holds interpolated SQL, so there are no params left to bind
+                rows = _plan(sql.replace("%", "%%"), ())
+                plans.append((sql, rows))
+                if pattern:
+                    scans += [(match.group(1), sql) for row in rows for match in [pattern.search(row)] if match]
+            results.append({"role": role, "path": path, "status": response.status_code,
+                            "queries": len(ctx.captured_queries), "plans": plans, "scans": scans})
+    return results
@@ -0,0 +1,167 @@
+# utils/instrumentation.py
+"""
+Per-request performance metrics. QueryInstrumentationMiddleware records every
+SQL statement (via connection.execute_wrapper) and the time spent in AES and
+Fernet calls (via timed()), then
+  - adds a Server-Timing header when SERVER_TIMING_HEADERS is on, so the
+    breakdown shows up in browser devtools, and
+  - logs requests slower than SLOW_REQUEST_MS with their repeated-query
+    fingerprints, slowest statements and EXPLAIN plans.
+Query parameters are never logged: they carry patient data.
+"""
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar("request_metrics", default=None)
+_IN_LIST = re.compile(r"\bIN \((?:%s, )*%s\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql):
+    # Statement shape, whatever the parameters or IN-list length
+    return _WHITESPACE.sub(" ", _IN_LIST.sub("IN (...)", sql)).strip()
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = []  # (alias, sql, params, many, seconds)
+        self.timers = {}  # kind -> seconds
+        self._running = set()
+
+    @property
+    def db_time(self):
+        return sum(query[4] for query in self.queries)
+
+    def duplicates(self):
+        # Statements repeating an earlier one with the same parameters
+        seen = Counter((sql, repr(params)) for _, sql, params, _, _ in self.queries)
+        return sum(count - 1 for count in seen.values())
+
+    def repeated(self):
+        # [(fingerprint, count)] for statement shapes run more than once, most frequent first
+        shapes = Counter(fingerprint(sql) for _, sql, _, _, _ in self.queries)
+        return [(shape, count) for shape, count in shapes.most_common() if count > 1]
+
+    def server_timing(self, total):
+        entries = [f'db;dur={self.db_time * 1000:.1f};desc="{len(self.queries)} queries"']
+        duplicates = self.duplicates()
+        if duplicates:
+            entries.append(f'db-dup;desc="{duplicates} duplicate"')
+        similar = sum(count - 1 for _, count in self.repeated())
+        if similar:
+            entries.append(f'db-similar;desc="{similar} repeated shape"')
+        for kind, seconds in sorted(self.timers.items()):
+            entries.append(f"{kind};dur={seconds * 1000:.1f}")
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+class timed:
+    """
+    `with timed("aes"):` adds the block's wall time to the current request's
+    timer of that kind. Nested blocks of one kind count once, and outside an
+    instrumented request (or in pool threads) it does nothing.
+    """
+    __slots__ = ("kind", "metrics", "start")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.metrics = None
+
+    def __enter__(self):
+        metrics = _current.get()
+        if metrics is not None and self.kind not in metrics._running:
+            metrics._running.add(self.kind)
+            self.metrics = metrics
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        metrics = self.metrics
+        if metrics is not None:
+            metrics._running.discard(self.kind)
+            metrics.timers[self.kind] = metrics.timers.get(self.kind, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+def _recorder(metrics, alias):
+    def record(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            metrics.queries.append((alias, sql, params, many, time.perf_counter() - start))
+    return record
+
+
+def explain(alias, sql, params):
+    # Plan rows for a SELECT, run after the request so it isn't recorded
+    if not sql.lstrip().upper().startswith("SELECT"):
+        return []
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}", params)
+            return [" ".join(str(column) for column in row) for row in cursor.fetchall()]
+    except DatabaseError as exc:
+        return [f"EXPLAIN failed: {exc}"]
+
+
+def log_slow_request(request, response, metrics, total):
+    match = request.resolver_match
+    lines = [
+        f"Slow request {request.method} {request.path} ({match.route if match else '-'}) -> "
+        f"{response.status_code}: {total * 1000:.1f}ms, {len(metrics.queries)} queries in "
+        f"{metrics.db_time * 1000:.1f}ms, {metrics.duplicates()} duplicate"
+        + "".join(f", {kind} {seconds * 1000:.1f}ms" for kind, seconds in sorted(metrics.timers.items()))
+    ]
+    for shape, count in metrics.repeated()[:5]:
+        lines.append(f"  x{count}: {shape[:300]}")
+    slowest = sorted(metrics.queries, key=lambda query: query[4], reverse=True)
+    for alias, sql, params, many, seconds in slowest[:getattr(settings, "SLOW_REQUEST_TOP_QUERIES", 5)]:
+        lines.append(f"  {seconds * 1000:.1f}ms [{alias}] {sql[:1000]}")
+        if getattr(settings, "SLOW_REQUEST_EXPLAIN", True) and not many:
+            lines.extend(f"      {row}" for row in explain(alias, sql, params))
+    logger.warning("\n".join(lines))
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Outermost middleware, so its timings cover the whole request. Turned
+    off entirely with SQL_INSTRUMENTATION = False.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "SQL_INSTRUMENTATION", True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(_recorder(metrics, alias)))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        total = time.perf_counter() - metrics.started
+
+        if getattr(settings, "SERVER_TIMING_HEADERS", False):
+            response["Server-Timing"] = metrics.server_timing(total)
+        threshold = getattr(settings, "SLOW_REQUEST_MS", None)
+        if threshold is not None and total * 1000 >= threshold:
+            log_slow_request(request, response, metrics, total)
+        return response
@@ -0,0 +1,119 @@
+# utils/keyring.py
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet, MultiFernet
+from django.conf import settings
+from utils.encryption import DEFAULT_KEY_VERSION, DataKey
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_TTL_SECONDS = 300
+
+
+def _zeroize(buf: bytearray):
+    # Overwrite key material in place before dropping the reference
+    for i in range(len(buf)):
+        buf[i] = 0
+
+
+class UserKeyRing:
+    """
+    Process-wide LRU cache of unwrapped user AES keys.
+
+    Entries are keyed by user id and remember the wrapped value they were
+    unwrapped from, so a regenerated ``user_key`` never serves a stale key.
+    Expired or evicted keys are zeroized. Keys are returned as DataKey, with
+    any retired versions still needed mid-rotation.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, wrapped, unwrap):
+        """
+        Return the raw key for ``user_id``, calling ``unwrap(wrapped)`` only
+        when there is no fresh cached entry for that exact wrapped value.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                cached_wrapped, buffers, version, expires_at = entry
+                if cached_wrapped == wrapped and expires_at > now:
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    retired = {v: bytes(buf) for v, buf in buffers.items() if v != version}
+                    return DataKey(bytes(buffers[version]), version, retired)
+                self._discard(user_id)
+            self.misses += 1
+
+        key = unwrap(wrapped)
+        version = getattr(key, "version", DEFAULT_KEY_VERSION)
+        buffers = {v: bytearray(k) for v, k in getattr(key, "retired", {}).items()}
+        buffers[version] = bytearray(key)
+        with self._lock:
+            self._discard(user_id)
+            self._entries[user_id] = (wrapped, buffers, version, now + self.ttl)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+        return key
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def clear(self):
+        with self._lock:
+            for user_id in list(self._entries):
+                self._discard(user_id)
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _discard(self, user_id):
+        # Caller must hold the lock
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            for buf in entry[1].values():
+                _zeroize(buf)
+
+
+user_keyring = UserKeyRing(
+    max_size=getattr(settings, "USER_KEY_CACHE_SIZE", DEFAULT_MAX_SIZE),
+    ttl=getattr(settings, "USER_KEY_CACHE_TTL", DEFAULT_TTL_SECONDS),
+)
+
+
+def master_keys():
+    # Newest first: the first key wraps, every key can unwrap
+    return list(getattr(settings, "MASTER_KEYS", None) or [settings.MASTER_KEY])
+
+
+def master_key_id(key: str) -> str:
+    # Short fingerprint recorded next to each wrapped user key
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def current_master_key_id() -> str:
+    return master_key_id(master_keys()[0])
+
+
+@functools.lru_cache(maxsize=4)
+def _multi_fernet(keys: tuple) -> MultiFernet:
+    return MultiFernet([Fernet(key.encode()) for key in keys])
+
+
+def master_fernet() -> MultiFernet:
+    return _multi_fernet(tuple(master_keys()))
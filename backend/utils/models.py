@@ -0,0 +1,217 @@
+from django.contrib.auth import get_user_model
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.query import ModelIterable
+from utils.encryption import DECRYPTION_ERROR, AESCipher, decrypt_many_by_key, is_encrypted, keywords, search_tokens
+
+KEY_RESOLUTION_CHUNK_SIZE = 500
+
+
+def decrypt_instances(instances, fields):
+    """
+    Decrypt `fields` on a page of model instances with one decrypt_many call
+    per distinct user key, split over the decryption pool for big pages.
+    Plaintexts are cached on each instance so the `*_decrypted` properties
+    don't decrypt again.
+    """
+    groups = {}
+    for obj in instances:
+        key = obj._get_user_key_bytes()
+        if key:
+            groups.setdefault(bytes(key), (key, []))[1].append(obj)
+
+    jobs = [(key, [getattr(obj, field) for obj in objs for field in fields]) for key, objs in groups.values()]
+    results = decrypt_many_by_key(jobs, errors="replace")
+    for (key, objs), decrypted in zip(groups.values(), results):
+        plaintexts = iter(decrypted)
+        for obj in objs:
+            cache = obj.__dict__.setdefault("_decrypted_values", {})
+            for field in fields:
+                value = getattr(obj, field)
+                plaintext = next(plaintexts)
+                if value:
+                    cache[value] = plaintext
+
+
+class KeyedModelIterable(ModelIterable):
+    """
+    Yields model instances with the owning user's AES key attached.
+    Owners are fetched in one query per chunk of rows, and each distinct key
+    is unwrapped once however many rows share it.
+    """
+
+    def __iter__(self):
+        keys = {}
+        chunk = []
+        for obj in super().__iter__():
+            chunk.append(obj)
+            if len(chunk) >= KEY_RESOLUTION_CHUNK_SIZE:
+                yield from self._attach_keys(chunk, keys)
+                chunk = []
+        yield from self._attach_keys(chunk, keys)
+
+    def _attach_keys(self, chunk, keys):
+        missing = {obj._key_owner_id for obj in chunk} - keys.keys() - {None}
+        if missing:
+            owners = get_user_model().objects.filter(pk__in=missing).only(*get_user_model().KEY_FIELDS)
+            for owner in owners:
+                keys[owner.pk] = owner.get_user_key()
+        for obj in chunk:
+            obj.attach_user_key(keys.get(obj._key_owner_id))
+        return chunk
+
+
+class EncryptedQuerySet(models.QuerySet):
+    def with_decryption_keys(self):
+        # Resolve every row's decryption key in bulk instead of walking the owner per row
+        clone = self.annotate(_key_owner_id=F(f"{self.model.KEY_OWNER}_id"))
+        clone._iterable_class = KeyedModelIterable
+        return clone
+
+
+class EncryptedModelMixin:
+    """
+    Shared encryption behaviour for models whose ENCRYPTED_FIELDS are sealed
+    with the owning user's key. KEY_OWNER is the lookup path to that user,
+    e.g. "patient__user". Models listing SEARCH_FIELDS also need a
+    `search_tokens = GenericRelation("patients.SearchToken")`; their keyword
+    index is rebuilt on save whenever one of those fields was assigned.
+    """
+    ENCRYPTED_FIELDS = []
+    KEY_OWNER = "user"
+    SEARCH_FIELDS = []
+
+    @property
+    def key_owner(self):
+        owner = self
+        for attr in self.KEY_OWNER.split("__"):
+            owner = getattr(owner, attr, None)
+            if owner is None:
+                return None
+        return owner
+
+    @property
+    def key_owner_id(self):
+        # Annotated by with_decryption_keys(), else read off the last foreign key on the path
+        self._drop_stale_key()
+        if "_key_owner_id" in self.__dict__:
+            return self._key_owner_id
+        *path, last = self.KEY_OWNER.split("__")
+        owner = self
+        for attr in path:
+            owner = getattr(owner, attr, None)
+            if owner is None:
+                return None
+        return getattr(owner, f"{last}_id", None)
+
+    def attach_user_key(self, key):
+        # Cache the owner's key, remembering which owner it belongs to
+        self._user_key = key
+        self._user_key_link = self._owner_link()
+
+    def _owner_link(self):
+        # Id held by the first foreign key on KEY_OWNER
+        return getattr(self, f"{self.KEY_OWNER.split('__')[0]}_id", None)
+
+    def _drop_stale_key(self):
+        # Reassigning the owner foreign key invalidates the cached key and owner id
+        if "_user_key_link" in self.__dict__ and self._user_key_link != self._owner_link():
+            for attr in ("_user_key", "_user_key_link", "_key_owner_id"):
+                self.__dict__.pop(attr, None)
+
+    def _get_user_key_bytes(self) -> bytes:
+        # Key attached by with_decryption_keys(), else unwrap via the owner
+        self._drop_stale_key()
+        key = self.__dict__.get("_user_key")
+        if key is None:
+            owner = self.key_owner
+            key = owner.get_user_key() if owner is not None else None
+            if key is not None:
+                self.attach_user_key(key)
+        return key
+
+    def encrypt_fields(self):
+        # Encrypt any plaintext ENCRYPTED_FIELDS values in one batch
+        key = self._get_user_key_bytes()
+        pending = [field for field in self.ENCRYPTED_FIELDS
+                   if getattr(self, field, None) and not is_encrypted(getattr(self, field))]
+        if not key:
+            if pending and self.key_owner is not None:
+                # The owner's key was shredded: never store their data in the clear
+                raise ValueError(f"{type(self).__name__} owner has no encryption key; refusing to save plaintext.")
+            # no owner to take a key from; values stay as they are
+            return
+        ciphertexts = AESCipher(key).encrypt_many([getattr(self, field) for field in pending])
+        for field, ciphertext in zip(pending, ciphertexts):
+            setattr(self, field, ciphertext)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if cls.SEARCH_FIELDS:
+            # Search fields loaded with a value, so clearing one is noticed on save
+            instance._indexed_fields = {field for field in cls.SEARCH_FIELDS if instance.__dict__.get(field)}
+        return instance
+
+    def save(self, *args, **kwargs):
+        words = self.search_keywords() if self._search_index_stale(kwargs.get("update_fields")) else None
+        self.encrypt_fields()
+        if words is None:
+            super().save(*args, **kwargs)
+            return
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.index_search_tokens(words, replace=not adding)
+        self._indexed_fields = {field for field in self.SEARCH_FIELDS if getattr(self, field)}
+
+    def _search_index_stale(self, update_fields):
+        # Values loaded from the database are envelopes, so a plaintext one was
+        # assigned; an empty one only matters if it replaced a loaded value
+        fields = [field for field in self.SEARCH_FIELDS if update_fields is None or field in update_fields]
+        indexed = self.__dict__.get("_indexed_fields", set())
+        for field in fields:
+            value = getattr(self, field)
+            if not is_encrypted(value) if value else field in indexed:
+                return True
+        return False
+
+    def search_keywords(self):
+        words = set()
+        for field in self.SEARCH_FIELDS:
+            value = getattr(self, field)
+            if is_encrypted(value):
+                value = self._decrypt_field(value)
+            if value and value != DECRYPTION_ERROR:
+                words |= keywords(value)
+        return words
+
+    def index_search_tokens(self, words, replace=True):
+        # Replace this record's tokens (a new record has none to delete); without an owner key nothing is indexed
+        if replace:
+            self.search_tokens.all().delete()
+        key = self._get_user_key_bytes()
+        if not key or not words:
+            return
+        owner_id = self.key_owner_id
+        SearchToken = self.search_tokens.model
+        SearchToken.objects.bulk_create([
+            SearchToken(user_id=owner_id, record=self, token=token)
+            for token in search_tokens(key, words).values()
+        ])
+
+    # decrypted values (never modify DB)
+    def _decrypt_field(self, encrypted_value):
+        # Serve values already decrypted in bulk by decrypt_instances()
+        cached = getattr(self, "_decrypted_values", {})
+        if encrypted_value in cached:
+            return cached[encrypted_value]
+        key = self._get_user_key_bytes()
+        if not encrypted_value or not key:
+            return None
+        cipher = AESCipher(key)
+        try:
+            return cipher.decrypt(encrypted_value)
+        except Exception:
+            # MAC check failed or corrupted value
+            return DECRYPTION_ERROR
@@ -0,0 +1,118 @@
+# utils/pagination.py
+"""
+Default list pagination. Cursor (keyset) pages seek on the view's ordering,
+so every page costs one indexed range read however deep the client goes and
+rows inserted meanwhile are neither skipped nor repeated. Views order by a
+timeline column with id as tie-breaker, e.g. ordering = ["-date", "-id"].
+
+DRF's CursorPagination seeks on the first ordering column only and steps
+over ties with an OFFSET, which breaks down on columns like last_name. Here
+id is always appended and the cursor carries the whole (column..., id) tuple,
+so the seek is exact whichever ordering the client picks.
+"""
+import json
+
+from django.conf import settings
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+
+TIE_BREAKER = "id"
+
+
+class KeysetPagination(CursorPagination):
+    ordering = "-id"
+    page_size_query_param = "page_size"  # defaults to REST_FRAMEWORK["PAGE_SIZE"]
+
+    @property
+    def max_page_size(self):
+        # ?page_size= above this is clamped, not rejected
+        return getattr(settings, "MAX_PAGE_SIZE", 200)
+
+    def get_ordering(self, request, queryset, view):
+        # A view's own `ordering` applies even without an OrderingFilter
+        if getattr(view, "ordering", None) and not any(
+                issubclass(backend, OrderingFilter) for backend in getattr(view, "filter_backends", [])):
+            ordering = tuple(view.ordering)
+        else:
+            ordering = tuple(super().get_ordering(request, queryset, view))
+        if not any(field.lstrip("-") in (TIE_BREAKER, "pk") for field in ordering):
+            # Same direction as the leading column, so "-date" pages newest first all the way
+            ordering += ("-" + TIE_BREAKER if ordering[0].startswith("-") else TIE_BREAKER,)
+        return ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        offset, reverse, current_position = self.cursor or (0, False, None)
+
+        related = {self._alias(field): F(field.lstrip("-")) for field in self.ordering if "__" in field}
+        if related:
+            # Read patient__last_name off the joined row rather than a lazy FK per item
+            queryset = queryset.annotate(**related)
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if current_position is not None:
+            queryset = queryset.filter(self._seek(ordering, current_position))
+
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = results[:self.page_size]
+        if len(results) > len(self.page):
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+        else:
+            following_position = None
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = current_position is not None or offset > 0
+            self.has_previous = following_position is not None
+            self.next_position = current_position
+            self.previous_position = following_position
+        else:
+            self.has_next = following_position is not None
+            self.has_previous = current_position is not None or offset > 0
+            self.next_position = following_position
+            self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    @staticmethod
+    def _alias(field):
+        name = field.lstrip("-")
+        return f"_keyset_{name}" if "__" in name else name
+
+    def _get_position_from_instance(self, instance, ordering):
+        return json.dumps([str(getattr(instance, self._alias(field))) for field in ordering])
+
+    def _seek(self, ordering, position):
+        """
+        Rows strictly after `position` in `ordering`:
+        a >= x and (a > x or (a = x and b > y) ...). The redundant leading
+        bound gives the planner an index range to seek on.
+        """
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        # Every orderable column is NOT NULL, so plain comparisons cover it
+        after, tied = Q(), Q()
+        for field, value in zip(ordering, values):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            after |= tied & Q(**{f"{name}__{lookup}": value})
+            tied &= Q(**{name: value})
+        leading = ordering[0]
+        bound = "lte" if leading.startswith("-") else "gte"
+        return Q(**{f"{leading.lstrip('-')}__{bound}": values[0]}) & after
@@ -0,0 +1,19 @@
+# utils/parsers.py
+from django.conf import settings
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    application/x-ndjson bodies, one JSON document per line. Parsing is lazy:
+    request.data is an iterator over the non-blank lines, read from the
+    request stream as the view consumes it, and callers decode each line so
+    one bad line can be reported without rejecting the rest.
+    """
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return iter(())
+        encoding = (parser_context or {}).get("encoding", settings.DEFAULT_CHARSET)
+        return (line.decode(encoding) for line in iter(stream.readline, b"") if line.strip())
@@ -15,5 +15,6 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        # Write permissions allowed only to the object's owner (assuming `user` field)
-        return getattr(obj, "user", None) == request.user
+        # Write permissions allowed only to the object's owner (assuming `user` field);
+        # compare ids so the owner row isn't fetched
+        return getattr(obj, "user_id", None) == request.user.pk
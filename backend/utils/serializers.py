@@ -0,0 +1,45 @@
+from django.db import models
+from rest_framework import serializers
+from utils.models import decrypt_instances
+
+
+class BatchDecryptListSerializer(serializers.ListSerializer):
+    """
+    List serializer for encrypted models: decrypts the whole page in one
+    pass (see decrypt_instances) before the child serializer renders rows.
+    """
+
+    def to_representation(self, data):
+        rows = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        fields = [f for f in self.child.Meta.model.ENCRYPTED_FIELDS if f in self.child.fields]
+        decrypt_instances(rows, fields)
+        return super().to_representation(rows)
+
+
+def sparse_fieldset(request):
+    """
+    Parse ?fields=a,b and ?omit=c,d from a read request.
+    Returns (fields or None, omit set).
+    """
+    if request is None or request.method not in ("GET", "HEAD"):
+        return None, set()
+    fields = request.query_params.get("fields")
+    omit = request.query_params.get("omit")
+    fields = {name.strip() for name in fields.split(",") if name.strip()} if fields else None
+    omit = {name.strip() for name in omit.split(",") if name.strip()} if omit else set()
+    return fields, omit
+
+
+class SparseFieldsMixin:
+    """
+    Lets read requests choose the rendered fields with ?fields= / ?omit=.
+    Fields that are dropped here are never decrypted.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        wanted, omit = sparse_fieldset(self.context.get("request"))
+        for name in list(fields):
+            if (wanted is not None and name not in wanted) or name in omit:
+                fields.pop(name)
+        return fields
@@ -0,0 +1,175 @@
+# utils/testing.py
+"""
+Query-budget harness for the API. Every viewset action routed in an app's
+urls.py declares `query_budget = {action: max_queries}` on its viewset, and
+the app's tests.py gives each route a case. A case is run once with N rows
+and again with 10N; the query count must not grow and must stay within the
+budget, so an N+1 regression fails the suite.
+"""
+import itertools
+from datetime import date
+from importlib import import_module
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+PASSWORD = "budget-pass-1234"
+_ids = itertools.count(1)
+
+
+def iter_endpoints(urlconf):
+    # (route, http method, viewset, action) for every viewset route in urlconf.
+    # DRF adds "head" to a view's actions on its first request; it mirrors "get".
+    for pattern in import_module(urlconf).urlpatterns:
+        viewset = getattr(pattern.callback, "cls", None)
+        for method, action in list(getattr(pattern.callback, "actions", {}).items()):
+            if method != "head":
+                yield str(pattern.pattern), method, viewset, action
+
+
+def _letters(n):
+    # Names in this API may only contain letters
+    return "".join("abcdefghij"[int(d)] for d in str(n)).capitalize()
+
+
+def unique_name(prefix):
+    return f"{prefix} {_letters(next(_ids))}"
+
+
+def unique_email(prefix="user"):
+    return f"{prefix}{next(_ids)}@example.com"
+
+
+def make_user(role="patient", **extra):
+    from users.models import CustomUser
+    extra = {"is_active": True, "is_verified": True, **extra}
+    return CustomUser.objects.create_user(unique_email(role), PASSWORD, role=role, **extra)
+
+
+def make_patient(user=None):
+    from patients.models import Patient
+    n = next(_ids)
+    patient = Patient(user=user or make_user("patient"), first_name="Asha", last_name=_letters(n),
+                      date_of_birth=date(1990, 1, 1), gender="female",
+                      contact_number="98%08d" % n, aadhar_number="1234%08d" % n)
+    patient.save()
+    return patient
+
+
+def make_doctor(user=None):
+    from doctors.models import Doctor
+    return Doctor.objects.create(user=user or make_user("doctor"), name=unique_name("Dr"),
+                                 specialty="General", contact_number="9876500000", hospital="City Hospital")
+
+
+def grant_access(doctor, patient, approved=True):
+    from doctors.models import AccessRequest
+    return AccessRequest.objects.create(doctor=doctor, patient=patient, is_approved=approved)
+
+
+def make_family(head):
+    from families.models import Family
+    return Family.objects.create(name=unique_name("Family"), head_of_family=head)
+
+
+def add_member(family, patient=None, verified=True):
+    from families.models import FamilyMember
+    return FamilyMember.objects.create(family=family, patient=patient or make_patient(), relationship="child",
+                                       is_verified=verified)
+
+
+def make_encounter(patient, doctor):
+    from doctors.models import Encounter
+    encounter = Encounter(patient=patient, doctor=doctor, reason="Persistent cough", summary="Asthma suspected")
+    encounter.save()
+    return encounter
+
+
+def make_note(encounter):
+    from doctors.models import ClinicalNote
+    note = ClinicalNote(encounter=encounter, subjective="Wheezing at night", objective="Rhonchi",
+                        assessment="Bronchial asthma", plan="Salbutamol inhaler", note="Review in two weeks")
+    note.save()
+    return note
+
+
+def make_history(patient):
+    from patients.models import MedicalHistory
+    history = MedicalHistory(patient=patient, type_of="allergy", description="Peanut allergy",
+                             status="active", event_date=date(2020, 1, 1), notes="Carries epinephrine")
+    history.save()
+    return history
+
+
+def make_vital(patient, **values):
+    from patients.models import Vital
+    return Vital.objects.create(patient=patient, **{"height_cm": 170, "weight_kg": 70, "heart_rate_bpm": 72, **values})
+
+
+# No slow-request logging: its EXPLAIN queries would count against the budgets.
+# Budgets assume a shared cache (CACHE_URL), where access grants are cached.
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"], SLOW_REQUEST_MS=None,
+                   ACCESS_GRANT_CACHE_TTL=300)
+class QueryBudgetTestCase(APITestCase):
+    """
+    Subclasses set `urlconf`, set `self.user` in setUp() (each case starts
+    logged in as that user) and override budget_cases() to return
+    {(route, method): case}, where a case is a dict with
+      request: callable(*args) -> response
+      grow:    callable(n) adding n rows the request could scale with
+      setup:   optional callable returning args for request; run (uncounted)
+               before every call, e.g. to create the row a DELETE removes.
+    """
+    N = 2
+    urlconf = None
+    user = None
+
+    def login(self, user=None):
+        # Real JWT authentication, so the user is loaded once per request as in production
+        if user is None:
+            self.client.credentials()
+        else:
+            self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {RefreshToken.for_user(user).access_token}")
+
+    def budget_cases(self):
+        # No cases: every endpoint of `urlconf` is then reported as missing one
+        return {}
+
+    def cold_cache(self):
+        # setup for cached endpoints: budget the cache-miss path
+        cache.clear()
+        return ()
+
+    def test_query_budgets(self):
+        if self.urlconf is None:
+            self.skipTest("base class; subclasses set urlconf")
+        cases = self.budget_cases()
+        for route, method, viewset, action in list(iter_endpoints(self.urlconf)):
+            label = f"{method.upper()} {route} ({viewset.__name__}.{action})"
+            self.login(self.user)
+            with self.subTest(label):
+                self.assertIn((route, method), cases, f"No query-budget case for {label}")
+                self.assertIn(action, getattr(viewset, "query_budget", {}), f"No query budget declared for {label}")
+                self.assertQueryBudget(label, viewset.query_budget[action], **cases[(route, method)])
+
+    def assertQueryBudget(self, label, budget, request, grow, setup=None):
+        def count():
+            args = setup() if setup else ()
+            with CaptureQueriesContext(connection) as ctx:
+                response = request(*args)
+                # A streamed body runs its queries while it is consumed
+                body = b"".join(response.streaming_content) if response.streaming else response.content
+            self.assertLess(response.status_code, 400, f"{label}: {response.status_code} {body[:200]}")
+            return len(ctx.captured_queries)
+
+        grow(self.N)
+        count()  # warm per-process caches (content types, user keys)
+        small = count()
+        grow(9 * self.N)
+        large = count()
+        self.assertEqual(small, large, f"{label}: {small} queries with {self.N} rows, {large} with {10 * self.N}")
+        self.assertLessEqual(large, budget, f"{label}: {large} queries, budget is {budget}")
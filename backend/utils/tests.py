@@ -0,0 +1,303 @@
+import base64
+import multiprocessing
+import os
+import time
+import warnings
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core import serializers
+from django.test import SimpleTestCase, TestCase, override_settings
+from patients.models import Patient
+from utils import encryption, testing
+from utils.encryption import AESCipher, DataKey
+from utils.keyring import UserKeyRing
+
+# Stand-in for the optional zstandard package, so the zstd flag is covered without it
+fake_zstandard = SimpleNamespace(
+    ZstdCompressor=lambda level: SimpleNamespace(compress=lambda data: b"zstd" + zlib.compress(data)),
+    ZstdDecompressor=lambda: SimpleNamespace(decompress=lambda data: zlib.decompress(data[4:])),
+)
+
+
+def seal(key, header, plaintext):
+    # An envelope as older releases wrote it: header (the AAD, empty for legacy) + nonce + tag + ciphertext
+    nonce = os.urandom(encryption.NONCE_SIZE)
+    sealed = AESGCM(key).encrypt(nonce, plaintext, header or None)
+    return header + nonce + sealed[-encryption.TAG_SIZE:] + sealed[:-encryption.TAG_SIZE]
+
+
+def _decrypt_in_child(key, values):
+    # Exit status 0 only if the child's pool actually ran the decryption
+    result = encryption.decrypt_many_by_key([(key, values)], threshold=0)
+    os._exit(0 if result == [["secret"] * len(values)] else 1)
+
+
+class DecryptionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.keys = [os.urandom(32) for _ in range(3)]
+        self.jobs = [(key, AESCipher(key).encrypt_many([f"{i}-{j}" for j in range(5)]))
+                     for i, key in enumerate(self.keys)]
+        self.expected = [[f"{i}-{j}" for j in range(5)] for i in range(3)]
+
+    def test_pool_off_by_default(self):
+        with override_settings(DECRYPTION_POOL_SIZE=0):
+            self.assertIsNone(encryption.get_decryption_executor())
+
+    def test_small_requests_stay_on_the_calling_thread(self):
+        executor = Mock()
+        self.assertEqual(encryption.decrypt_many_by_key(self.jobs, executor=executor, workers=2, threshold=100),
+                         self.expected)
+        executor.submit.assert_not_called()
+
+    def test_large_requests_split_across_workers(self):
+        with ThreadPoolExecutor(max_workers=2) as pool, patch.object(pool, "submit", wraps=pool.submit) as submit:
+            result = encryption.decrypt_many_by_key(self.jobs, executor=pool, workers=2, threshold=10)
+        self.assertEqual(result, self.expected)
+        # 15 values over 2 workers: chunks of 8, so one per key
+        self.assertEqual(submit.call_count, 3)
+
+    def test_parallel_errors_are_replaced(self):
+        key, values = self.jobs[0]
+        jobs = [(key, values + AESCipher(os.urandom(32)).encrypt_many(["lost"]))]
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            [result] = encryption.decrypt_many_by_key(jobs, executor=pool, workers=2, threshold=0)
+        self.assertEqual(result, self.expected[0] + [encryption.DECRYPTION_ERROR])
+
+    @override_settings(DECRYPTION_POOL_SIZE=2)
+    def test_forked_child_gets_its_own_pool(self):
+        key = os.urandom(32)
+        values = AESCipher(key).encrypt_many(["secret"] * 4)
+        executor = encryption.get_decryption_executor()
+        # Start every pool thread, as a busy server would have before forking
+        list(executor.map(time.sleep, [0.05] * 2))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)  # fork() with threads running
+            child = multiprocessing.get_context("fork").Process(target=_decrypt_in_child, args=(key, values))
+            child.start()
+        child.join(timeout=10)
+        if child.exitcode is None:
+            child.kill()
+        self.assertEqual(child.exitcode, 0)
+        self.assertIs(encryption.get_decryption_executor(), executor)
+
+
+class EnvelopeTests(SimpleTestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+
+    def test_header(self):
+        value = AESCipher(encryption.DataKey(self.key, version=7), compression=("none", 0)).encrypt("Asthma")
+        self.assertEqual(value[:encryption.HEADER_SIZE], encryption.ENVELOPE_MAGIC + bytes([2, 7, 0]))
+        self.assertEqual(len(value), encryption.HEADER_SIZE + encryption.NONCE_SIZE + encryption.TAG_SIZE + 6)
+        self.assertEqual(encryption.key_version_of(value), 7)
+
+    def test_header_is_authenticated(self):
+        key = encryption.DataKey(self.key, version=2, retired={1: self.key})
+        value = bytearray(AESCipher(key).encrypt("Asthma"))
+        value[3] = 1  # same key bytes under another version
+        self.assertEqual(AESCipher(key).decrypt_many([bytes(value)], errors="replace"), [encryption.DECRYPTION_ERROR])
+
+    def test_is_encrypted(self):
+        cipher = AESCipher(self.key)
+        v1 = seal(self.key, encryption.ENVELOPE_MAGIC + bytes([encryption.ENVELOPE_V1, 1]), b"Asthma")
+        legacy = seal(self.key, b"", b"Asthma")
+        self.assertTrue(encryption.is_encrypted(cipher.encrypt("Asthma")))
+        self.assertTrue(encryption.is_encrypted(v1))
+        for value in (legacy, b"", None, "Asthma", base64.b64encode(v1).decode()):
+            self.assertFalse(encryption.is_encrypted(value), value)
+        self.assertEqual(cipher.decrypt_many([v1, legacy]), ["Asthma", "Asthma"])
+
+
+class BatchCipherTests(SimpleTestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+
+    def test_round_trip_keeps_order_and_none(self):
+        values = ["Asthma", None, "", "Penicillin allergy", "नमस्ते"]
+        for engine in encryption.ENGINES.values():
+            with self.subTest(engine.name):
+                sealed = AESCipher(self.key, engine=engine).encrypt_many(values)
+                self.assertIsNone(sealed[1])
+                self.assertEqual(AESCipher(self.key, engine=engine).decrypt_many(sealed),
+                                 values)
+
+    def test_engines_read_each_other(self):
+        pycryptodome, cryptography = encryption.ENGINES["pycryptodome"], encryption.ENGINES["cryptography"]
+        self.assertEqual(AESCipher(self.key, engine=cryptography).decrypt(
+            AESCipher(self.key, engine=pycryptodome).encrypt("Asthma")), "Asthma")
+        self.assertEqual(AESCipher(self.key, engine=pycryptodome).decrypt(
+            AESCipher(self.key, engine=cryptography).encrypt("Asthma")), "Asthma")
+
+    def test_empty_values_decrypt_to_none(self):
+        # decrypt() used to raise on an empty value; it now returns None like decrypt_many()
+        cipher = AESCipher(self.key)
+        self.assertIsNone(cipher.decrypt(b""))
+        self.assertIsNone(cipher.decrypt(None))
+
+    def test_errors(self):
+        cipher = AESCipher(self.key)
+        good = cipher.encrypt("Asthma")
+        bad = AESCipher(os.urandom(32)).encrypt("Asthma")
+        self.assertEqual(cipher.decrypt_many([good, bad], errors="replace"), ["Asthma", encryption.DECRYPTION_ERROR])
+        with self.assertRaises(Exception):
+            cipher.decrypt_many([good, bad])
+
+    def test_engine_choice(self):
+        with patch.object(encryption, "_selected_engine", None), override_settings(AES_ENGINE="cryptography"):
+            self.assertIs(encryption.get_engine(), encryption.ENGINES["cryptography"])
+        timings = {"pycryptodome": 1.0, "cryptography": 2.0}
+        with patch.object(encryption, "_selected_engine", None), override_settings(AES_ENGINE="auto"), \
+                patch.object(encryption, "benchmark_engines", return_value=timings):
+            self.assertIs(encryption.get_engine(), encryption.ENGINES["pycryptodome"])
+            # Benchmarked once per process
+            timings["pycryptodome"] = 3.0
+            self.assertIs(encryption.get_engine(), encryption.ENGINES["pycryptodome"])
+        with patch.object(encryption, "_selected_engine", None), override_settings(AES_ENGINE="rot13"):
+            with self.assertRaisesMessage(ValueError, "Unknown AES engine"):
+                encryption.get_engine()
+
+
+class CompressionTests(SimpleTestCase):
+    text = "Type 2 diabetes, managed with metformin. " * 20
+
+    def setUp(self):
+        self.key = os.urandom(32)
+
+    def flags(self, value):
+        return value[encryption.HEADER_SIZE - 1]
+
+    @override_settings(ENCRYPTION_COMPRESSION="zlib")
+    def test_compressed_round_trip(self):
+        cipher = AESCipher(self.key)
+        long, short = cipher.encrypt_many([self.text, "short"])
+        self.assertEqual((self.flags(long), self.flags(short)), (encryption.FLAG_ZLIB, 0))
+        self.assertLess(len(long), len(self.text))
+        self.assertEqual(cipher.decrypt_many([long, short]), [self.text, "short"])
+
+    def test_threshold_default_matches_settings(self):
+        with self.settings():
+            del settings.ENCRYPTION_COMPRESSION_THRESHOLD
+            self.assertEqual(encryption.get_compression()[1], 256)
+
+    @override_settings(ENCRYPTION_COMPRESSION="zlib", ENCRYPTION_COMPRESSION_THRESHOLD=10_000)
+    def test_below_threshold_stays_uncompressed(self):
+        self.assertEqual(self.flags(AESCipher(self.key).encrypt(self.text)), 0)
+
+    @override_settings(ENCRYPTION_COMPRESSION="auto")
+    def test_zstd_flag_byte(self):
+        with patch.object(encryption, "zstandard", fake_zstandard):
+            value = AESCipher(self.key).encrypt(self.text)
+            self.assertEqual(self.flags(value), encryption.FLAG_ZSTD)
+            self.assertEqual(AESCipher(self.key).decrypt(value), self.text)
+        with patch.object(encryption, "zstandard", None), self.assertRaisesMessage(RuntimeError, "zstandard"):
+            AESCipher(self.key).decrypt(value)
+
+    def test_flags_are_authenticated(self):
+        value = bytearray(AESCipher(self.key, compression=("zlib", 0)).encrypt(self.text))
+        value[encryption.HEADER_SIZE - 1] = 0
+        self.assertEqual(AESCipher(self.key).decrypt_many([bytes(value)], errors="replace"),
+                         [encryption.DECRYPTION_ERROR])
+
+    def test_reads_v1_and_legacy_values(self):
+        v1 = seal(self.key, encryption.ENVELOPE_MAGIC + bytes([encryption.ENVELOPE_V1, 1]), b"v1 value")
+        legacy = seal(self.key, b"", b"legacy value")
+        # Rows from before binary storage hold the envelope as base64 text
+        text = base64.b64encode(v1).decode()
+        self.assertTrue(text.startswith(encryption.ENVELOPE_PREFIX))
+        self.assertEqual(AESCipher(self.key).decrypt_many([v1, legacy, text]), ["v1 value", "legacy value", "v1 value"])
+
+
+class EncryptedBinaryFieldTests(TestCase):
+    def setUp(self):
+        self.patient = testing.make_patient()
+        self.field = Patient._meta.get_field("contact_number")
+
+    def test_reads_base64_text_left_by_older_rows(self):
+        # Only v1 envelopes were ever stored as text
+        v1 = seal(bytes(self.patient.user.get_user_key()),
+                  encryption.ENVELOPE_MAGIC + bytes([encryption.ENVELOPE_V1, 1]), b"9800000000")
+        Patient.objects.filter(pk=self.patient.pk).update(contact_number=base64.b64encode(v1).decode())
+        patient = Patient.objects.get(pk=self.patient.pk)
+        self.assertEqual(patient.contact_number, v1)
+        self.assertEqual(patient.contact_number_decrypted, "9800000000")
+
+    def test_input_that_looks_like_an_envelope_is_encrypted(self):
+        envelope = seal(bytes(self.patient.user.get_user_key()),
+                        encryption.ENVELOPE_MAGIC + bytes([encryption.ENVELOPE_V1, 1]), b"0000000000")
+        forged = base64.b64encode(envelope).decode()
+        self.assertEqual(self.field.to_python(forged), forged)
+        patient = Patient.objects.get(pk=self.patient.pk)
+        patient.contact_number = self.field.to_python(forged)
+        patient.save()
+        patient = Patient.objects.get(pk=self.patient.pk)
+        self.assertNotEqual(patient.contact_number, envelope)
+        self.assertEqual(patient.contact_number_decrypted, forged)
+
+    def test_fixture_round_trip(self):
+        value = Patient.objects.get(pk=self.patient.pk).contact_number
+        fixture = serializers.serialize("json", Patient.objects.filter(pk=self.patient.pk))
+        Patient.objects.filter(pk=self.patient.pk).update(contact_number=None)
+        for obj in serializers.deserialize("json", fixture):
+            obj.save()
+        self.assertEqual(Patient.objects.get(pk=self.patient.pk).contact_number, value)
+
+
+class UserKeyRingTests(SimpleTestCase):
+    def setUp(self):
+        self.unwrapped = []
+
+    def unwrap(self, wrapped):
+        self.unwrapped.append(wrapped)
+        return DataKey(wrapped.encode().ljust(32, b"k"), version=2, retired={1: b"r" * 32})
+
+    def buffers(self, ring, user_id):
+        return list(ring._entries[user_id][1].values())
+
+    def test_unwraps_once_per_wrapped_value(self):
+        ring = UserKeyRing(max_size=4)
+        key = ring.get(1, "a", self.unwrap)
+        cached = ring.get(1, "a", self.unwrap)
+        self.assertEqual((bytes(cached), cached.version, cached.retired), (bytes(key), 2, {1: b"r" * 32}))
+        # A regenerated user_key is unwrapped afresh
+        ring.get(1, "b", self.unwrap)
+        self.assertEqual(self.unwrapped, ["a", "b"])
+        self.assertEqual(ring.stats(), {"size": 1, "hits": 1, "misses": 2})
+
+    def test_evicts_least_recently_used_and_zeroizes(self):
+        ring = UserKeyRing(max_size=2)
+        ring.get(1, "a", self.unwrap)
+        ring.get(2, "b", self.unwrap)
+        evicted = self.buffers(ring, 2)
+        ring.get(1, "a", self.unwrap)  # 2 is now the least recently used
+        ring.get(3, "c", self.unwrap)
+        self.assertEqual(list(ring._entries), [1, 3])
+        self.assertTrue(all(not any(buf) for buf in evicted))
+
+    def test_expires_after_ttl(self):
+        ring = UserKeyRing(ttl=60)
+        with patch("utils.keyring.time.monotonic", return_value=1000):
+            ring.get(1, "a", self.unwrap)
+            expired = self.buffers(ring, 1)
+        with patch("utils.keyring.time.monotonic", return_value=1059):
+            ring.get(1, "a", self.unwrap)
+        with patch("utils.keyring.time.monotonic", return_value=1061):
+            ring.get(1, "a", self.unwrap)
+        self.assertEqual(self.unwrapped, ["a", "a"])
+        self.assertTrue(all(not any(buf) for buf in expired))
+
+    def test_invalidate_and_clear_zeroize(self):
+        ring = UserKeyRing()
+        ring.get(1, "a", self.unwrap)
+        ring.get(2, "b", self.unwrap)
+        first, second = self.buffers(ring, 1), self.buffers(ring, 2)
+        ring.invalidate(1)
+        self.assertTrue(all(not any(buf) for buf in first))
+        self.assertTrue(all(any(buf) for buf in second))
+        ring.clear()
+        self.assertTrue(all(not any(buf) for buf in second))
+        self.assertEqual(ring.stats(), {"size": 0, "hits": 0, "misses": 0})
@@ -0,0 +1,25 @@
+class DecryptionKeysMixin:
+    """
+    For viewsets over EncryptedModelMixin models: resolve every row's
+    decryption key in bulk (EncryptedQuerySet.with_decryption_keys) so
+    serializers decrypt without further DB or Fernet work.
+    """
+
+    def filter_queryset(self, queryset):
+        return super().filter_queryset(queryset).with_decryption_keys()
+
+
+class SparseFieldsetMixin:
+    """
+    Pairs with utils.serializers.SparseFieldsMixin: encrypted columns the
+    serializer won't render on a read are deferred in SQL.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method in ("GET", "HEAD"):
+            rendered = self.get_serializer().fields
+            skipped = [f for f in queryset.model.ENCRYPTED_FIELDS if f not in rendered]
+            if skipped:
+                queryset = queryset.defer(*skipped)
+        return queryset